@@ -0,0 +1,91 @@
+"""
+Memory used by the public functions for catalogs and customers of increasing size, measured with tracemalloc.
+
+    python benchmarks/bench_memory.py [comma separated sizes]
+
+Responses are recorded once from the local Stripe stand-in and replayed from a cassette, so only allocations made by
+the Stripe library and this library are counted. Peak is the most memory allocated while the function runs and
+retained is the memory still allocated afterwards while the result is held, both per object returned.
+Exits with status 1 if any function uses more than its budget, so the benchmark can fail a CI run.
+"""
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+import stripe
+
+import subscriptions
+from subscriptions import cassette, scheduler
+
+from fake_stripe import FakeStripe
+
+from typing import Any, Callable, Dict, Tuple
+
+
+user = subscriptions.User(1, 'user@example.com', 'cus_1')
+
+functions: Dict[str, Callable[[], Any]] = {
+    'get_active_prices': lambda: subscriptions.get_active_prices(),
+    'get_active_products': lambda: subscriptions.get_active_products(),
+    'get_subscription_products_and_prices': lambda: subscriptions.get_subscription_products_and_prices(user),
+    'list_payment_methods': lambda: list(subscriptions.list_payment_methods(user, types=['card'])),
+}
+
+# Bytes per object returned: (peak, retained)
+budgets: Dict[str, Tuple[int, int]] = {
+    'get_active_prices': (9000, 1200),
+    'get_active_products': (6500, 800),
+    'get_subscription_products_and_prices': (9000, 1400),
+    'list_payment_methods': (5500, 4700),
+}
+
+
+def count(result: Any) -> int:
+    if isinstance(result, list) and result and 'prices' in result[0]:
+        return sum(len(product['prices']) for product in result)
+    return len(result)
+
+
+def measure(f: Callable[[], Any]) -> Tuple[int, int, int]:
+    """
+    Return the peak and retained bytes allocated by f and the number of objects it returned.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = f()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, retained, count(result)
+
+
+def main() -> int:
+    sizes = [int(size) for size in (sys.argv[1] if len(sys.argv) > 1 else '100,1000,10000').split(',')]
+    stripe.api_key = 'sk_test_memory'
+    scheduler.configure('sync')
+    over_budget = []
+    print(f"{'function':<40}{'size':>8}{'peak KiB':>12}{'retained KiB':>14}{'peak/obj':>10}{'kept/obj':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f'{size}.json')
+            with FakeStripe(latency=0, prices=size, products=max(size // 10, 1), payment_methods=size), \
+                    cassette.recording(path):
+                for f in functions.values():
+                    f()
+            with cassette.replaying(path, latency_scale=0):
+                for name, f in functions.items():
+                    f()
+                    peak, retained, n = measure(f)
+                    peak_budget, retained_budget = budgets[name]
+                    print(f'{name:<40}{size:>8}{peak / 1024:>12.1f}{retained / 1024:>14.1f}'
+                          f'{peak // n:>10}{retained // n:>10}')
+                    if peak > peak_budget * n or retained > retained_budget * n:
+                        over_budget.append(f'{name} with {size} objects')
+    for failure in over_budget:
+        print(f'Over budget: {failure}')
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
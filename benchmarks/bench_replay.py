@@ -0,0 +1,47 @@
+"""
+Time library functions against a cassette of recorded Stripe responses, for before and after comparisons without
+network access.
+
+    STRIPE_TEST_SECRET_KEY=sk_test_... python benchmarks/bench_replay.py record cassette.json.gz cus_123
+    python benchmarks/bench_replay.py replay cassette.json.gz cus_123 [latency scale]
+
+The customer should have at least one subscription. Replays use the recorded latencies unless a scale is given.
+"""
+import os
+import statistics
+import sys
+import time
+import stripe
+
+import subscriptions
+from subscriptions import cassette
+
+functions = {
+    'get_subscription_products_and_prices': lambda user: subscriptions.get_subscription_products_and_prices(user),
+    'get_subscription_prices': lambda user: subscriptions.get_subscription_prices(user),
+    'is_subscribed': lambda user: subscriptions.is_subscribed(user, product_id='prod_unknown'),
+}
+
+
+def main(mode: str, path: str, customer_id: str, latency_scale: float = 1.0, repeat: int = 20) -> None:
+    user = subscriptions.User(1, 'benchmark@example.com', customer_id)
+    if mode == 'record':
+        stripe.api_key = os.environ['STRIPE_TEST_SECRET_KEY']
+        with cassette.recording(path) as recorded:
+            for f in functions.values():
+                f(user)
+        print(f'Recorded {len(recorded.interactions)} requests to {path}')
+        return
+    stripe.api_key = 'sk_test_replay'
+    with cassette.replaying(path, latency_scale=latency_scale):
+        for name, f in functions.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                f(user)
+                times.append(time.perf_counter() - start)
+            print(f'{name}: median {statistics.median(times) * 1000:.1f}ms, max {max(times) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3], *(float(arg) for arg in sys.argv[4:5]))
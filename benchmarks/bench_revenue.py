@@ -0,0 +1,73 @@
+"""
+Benchmark of the revenue metrics over generated subscriptions, 1M by default.
+
+    python benchmarks/bench_revenue.py [number of subscriptions]
+"""
+import sys
+import time
+import numpy as np
+
+from subscriptions import revenue
+from subscriptions.export import Categories, Chunk, schemas
+
+
+def generate(n: int, seed: int = 0) -> Chunk:
+    """
+    An export of n subscriptions spread over 3 years, across 100 prices, 20 products and 3 currencies.
+    """
+    rng = np.random.default_rng(seed)
+    categories = {name: Categories() for name, dtype in schemas['subscription'].items() if dtype == 'category'}
+    for name, values in {'sub_id': (f'sub_{i}' for i in range(n)),
+                         'item_id': (f'si_{i}' for i in range(n)),
+                         'customer_id': (f'cus_{i}' for i in range(n // 2)),
+                         'status': ('active', 'canceled', 'past_due', 'trialing'),
+                         'price_id': (f'price_{i}' for i in range(100)),
+                         'product_id': (f'prod_{i}' for i in range(20)),
+                         'currency': ('eur', 'usd', 'gbp'),
+                         'interval': ('month', 'year', 'week')}.items():
+        categories[name].encode(list(values))
+    start = np.datetime64('2019-01-01', 's').astype(np.int64)
+    created = start + rng.integers(0, 3 * 365 * 86400, n)
+    canceled = rng.random(n) < 0.3
+    canceled_at = np.where(canceled, created + rng.integers(0, 365 * 86400, n), 0).astype('datetime64[s]')
+    canceled_at[~canceled] = np.datetime64('NaT')
+    price = rng.integers(0, 100, n).astype(np.int32)
+    columns = {'sub_id': np.arange(n, dtype=np.int32),
+               'item_id': np.arange(n, dtype=np.int32),
+               'customer_id': rng.integers(0, n // 2, n).astype(np.int32),
+               'status': np.where(canceled, 1, rng.choice([0, 2, 3], n, p=[0.9, 0.05, 0.05])).astype(np.int32),
+               'price_id': price,
+               'product_id': price % 20,
+               'currency': price % 3,
+               'interval': (price % 10 == 0).astype(np.int32) + (price % 33 == 0),
+               'interval_count': np.ones(n, dtype=np.int32),
+               'quantity': rng.integers(1, 5, n),
+               'amount': (price.astype(np.int64) + 1) * 100,
+               'created': created.astype('datetime64[s]'),
+               'cancel_at': np.full(n, np.datetime64('NaT'), dtype='datetime64[s]'),
+               'canceled_at': canceled_at,
+               'current_period_end': (created + 30 * 86400).astype('datetime64[s]')}
+    return Chunk(columns, categories)
+
+
+def timed(name: str, f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    print(f'{name}: {(time.perf_counter() - start) * 1000:.1f}ms')
+    return result
+
+
+def main(n: int = 1000000) -> None:
+    subs = timed(f'generate {n} subscriptions', generate, n)
+    buckets = revenue.month_starts('2019-01', '2021-12')
+    timed('monthly_amount', revenue.monthly_amount, subs)
+    timed('metrics by currency, 36 months', revenue.metrics, subs, buckets)
+    result = timed('metrics by currency and product, 36 months', revenue.metrics, subs, buckets,
+                   by=('currency', 'product_id'))
+    print(f"groups: {len(result['groups'])}, final MRR: {result['mrr'][:, -1].sum() / 100:.2f}")
+    later = generate(n, seed=1)
+    timed('movements', revenue.movements, subs, later)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
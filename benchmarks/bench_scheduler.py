@@ -0,0 +1,49 @@
+"""
+Compare the overhead and fan-out latency of the scheduler backends.
+
+    python benchmarks/bench_scheduler.py
+
+For each backend, submits tasks which do nothing to measure the cost of scheduling, then fans out 10 simulated
+20ms Stripe requests and waits for them as get_subscription_products_and_prices does. The gevent backend is only
+included if gevent is installed and uses gevent.sleep for the simulated requests.
+"""
+import asyncio
+import threading
+import time
+
+from subscriptions import scheduler
+
+
+def overhead(sched: scheduler.Scheduler, n: int = 10000) -> float:
+    start = time.perf_counter()
+    for future in [sched.submit(int) for _ in range(n)]:
+        future.result()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def fan_out(sched: scheduler.Scheduler, sleep, requests: int = 10, latency: float = 0.02, repeat: int = 10) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for future in [sched.submit(sleep, latency) for _ in range(requests)]:
+            future.result()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    backends = [(scheduler.ThreadScheduler(), time.sleep),
+                (scheduler.SynchronousScheduler(), time.sleep),
+                (scheduler.AsyncioScheduler(loop), time.sleep)]
+    if scheduler.gevent:
+        backends.append((scheduler.GeventScheduler(), scheduler.gevent.sleep))
+    print(f'{"backend":<10}{"overhead per task":>20}{"10 x 20ms fan-out":>20}')
+    for sched, sleep in backends:
+        print(f'{sched.name:<10}{overhead(sched):>17.1f}us{fan_out(sched, sleep):>18.1f}ms')
+        sched.shutdown()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == '__main__':
+    main()
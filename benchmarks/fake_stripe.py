@@ -0,0 +1,130 @@
+"""
+A local stand-in for the Stripe API with configurable latency, for load tests and benchmarks without network access.
+Only the endpoints used by the high-level functions are implemented and every customer has the same subscription.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import stripe
+
+from typing import Any, Dict, Optional
+
+
+def _list(url: str, data: list) -> Dict[str, Any]:
+    return {'object': 'list', 'url': url, 'has_more': False, 'data': data}
+
+
+def _price(i: int, products: int = 5) -> Dict[str, Any]:
+    return {'id': f'price_{i}', 'object': 'price', 'active': True, 'product': f'prod_{i % products}',
+            'type': 'recurring',
+            'currency': 'usd', 'unit_amount': 1000 * (i + 1), 'unit_amount_decimal': str(1000 * (i + 1)),
+            'nickname': None, 'metadata': {}, 'recurring': {'interval': 'month', 'interval_count': 1}}
+
+
+def _product(i: int) -> Dict[str, Any]:
+    return {'id': f'prod_{i}', 'object': 'product', 'active': True, 'images': [], 'type': 'service',
+            'name': f'Product {i}', 'shippable': None, 'unit_label': None, 'url': None, 'metadata': {}}
+
+
+def _payment_method(customer_id: str, i: int = 0) -> Dict[str, Any]:
+    return {'id': f'pm_{customer_id}' + (f'_{i}' if i else ''), 'object': 'payment_method', 'type': 'card',
+            'customer': customer_id, 'card': {'brand': 'visa', 'last4': '4242'}}
+
+
+def _subscription(customer_id: str) -> Dict[str, Any]:
+    now = int(time.time())
+    return {'id': f'sub_{customer_id}', 'object': 'subscription', 'customer': customer_id, 'status': 'active',
+            'plan': {'id': 'price_0', 'object': 'plan', 'product': 'prod_0', 'amount': 1000, 'currency': 'usd',
+                     'interval': 'month', 'interval_count': 1},
+            'default_payment_method': f'pm_{customer_id}', 'cancel_at': None, 'current_period_end': now + 86400,
+            'created': now - 86400}
+
+
+class FakeStripe:
+    """
+    Serve the fake API on a local port and point the Stripe library at it while active.
+    Each response is delayed by latency seconds, varied randomly by up to jitter as a fraction of latency.
+    prices, products and payment_methods are the numbers of each returned by the list endpoints.
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.2, prices: int = 10, products: int = 5,
+                 payment_methods: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.prices = [_price(i, products) for i in range(prices)]
+        self.products = [_product(i) for i in range(products)]
+        self.payment_methods = payment_methods
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._api_base = stripe.api_base
+
+    def respond(self, method: str, path: str, params: Dict[str, str]) -> Dict[str, Any]:
+        customer_id = params.get('customer', 'cus_1')
+        if method == 'POST' and path == '/v1/checkout/sessions':
+            return {'id': f'cs_{random.getrandbits(32)}', 'object': 'checkout.session', 'status': 'open',
+                    'customer': customer_id, 'expires_at': int(time.time()) + 86400, 'url': 'http://localhost'}
+        if path == '/v1/subscriptions':
+            return _list(path, [_subscription(customer_id)])
+        if path == '/v1/prices':
+            return _list(path, self.prices)
+        if path == '/v1/products':
+            return _list(path, self.products)
+        if path == '/v1/payment_methods':
+            return _list(path, [_payment_method(customer_id, i) for i in range(self.payment_methods)])
+        match = re.match(r'/v1/(prices|products|customers)/(\w+)$', path)
+        if match:
+            kind, obj_id = match.groups()
+            if kind == 'customers':
+                return {'id': obj_id, 'object': 'customer',
+                        'invoice_settings': {'default_payment_method': f'pm_{obj_id}'}}
+            objs = self.prices if kind == 'prices' else self.products
+            return next(obj for obj in objs if obj['id'] == obj_id)
+        raise KeyError(path)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                parsed = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                params = dict(pair.split('=', 1) for pair in '&'.join(filter(None, [parsed.query, body])).split('&')
+                              if '=' in pair)
+                with fake._lock:
+                    fake.requests += 1
+                time.sleep(fake.latency * (1 + random.uniform(-fake.jitter, fake.jitter)))
+                try:
+                    status, response = 200, fake.respond(self.command, parsed.path, params)
+                except (KeyError, StopIteration):
+                    status, response = 404, {'error': {'type': 'invalid_request_error', 'message': 'Not found'}}
+                content = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('Request-Id', 'req_fake')
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_DELETE = _handle
+        return Handler
+
+    def __enter__(self) -> 'FakeStripe':
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        stripe.api_base = f'http://127.0.0.1:{self._server.server_address[1]}'
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        stripe.api_base = self._api_base
+        self._server.shutdown()
+        self._server.server_close()
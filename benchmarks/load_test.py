@@ -0,0 +1,141 @@
+"""
+Load test of the pricing, account and checkout pages with simulated concurrent users against a local Stripe
+stand-in, to find how many users one worker can serve.
+
+    python benchmarks/load_test.py --concurrency 1,8,32 --workers 4,16 --latency 0.05 --duration 5 [--pool]
+
+For each combination of concurrency and executor size, reports pages served per second, page latency percentiles,
+the largest and mean number of tasks waiting for an executor thread and the largest number of threads in the process.
+"""
+import argparse
+import random
+import threading
+import time
+import stripe
+
+import subscriptions
+from subscriptions import http, scheduler
+from subscriptions.cache import request_cache
+
+from fake_stripe import FakeStripe
+
+from typing import Callable, Dict, List
+
+
+def pricing_page(user: subscriptions.User) -> None:
+    subscriptions.get_subscription_products_and_prices(user)
+    subscriptions.is_subscribed(user, product_id='prod_0')
+
+
+def account_page(user: subscriptions.User) -> None:
+    list(subscriptions.list_payment_methods(user, types=['card']))
+
+
+def checkout(user: subscriptions.User) -> None:
+    subscriptions.create_subscription_checkout(user, 'price_0', success_url='http://localhost',
+                                               cancel_url='http://localhost/cancel')
+
+
+pages: Dict[str, Callable[[subscriptions.User], None]] = {
+    'pricing': pricing_page,
+    'account': account_page,
+    'checkout': checkout,
+}
+
+weights = {'pricing': 6, 'account': 3, 'checkout': 1}
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+class Sampler:
+    """
+    Samples the scheduler's queue length and the process's thread count every interval seconds.
+    """
+    def __init__(self, sched: scheduler.Scheduler, interval: float = 0.01):
+        self.scheduler = sched
+        self.interval = interval
+        self.queued: List[int] = []
+        self.threads: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.queued.append(self.scheduler.queued())
+            self.threads.append(threading.active_count())
+
+    def __enter__(self) -> 'Sampler':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run(concurrency: int, workers: int, duration: float, pool: bool) -> Dict[str, float]:
+    sched = scheduler.configure('thread', max_workers=workers)
+    if pool:
+        http.install_connection_pool()
+    latencies: Dict[str, List[float]] = {name: [] for name in pages}
+    errors = []
+    stop = time.monotonic() + duration
+    names = [name for name, weight in weights.items() for _ in range(weight)]
+
+    def simulated_user(i: int) -> None:
+        user = subscriptions.User(i, f'user{i}@example.com', f'cus_{i}')
+        while time.monotonic() < stop:
+            name = random.choice(names)
+            start = time.perf_counter()
+            try:
+                with request_cache():
+                    pages[name](user)
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies[name].append(time.perf_counter() - start)
+
+    with Sampler(sched) as sampler:
+        threads = [threading.Thread(target=simulated_user, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    return {'concurrency': concurrency, 'workers': workers,
+            'throughput': len(all_latencies) / duration,
+            'p50': percentile(all_latencies, 50) * 1000,
+            'p95': percentile(all_latencies, 95) * 1000,
+            'p99': percentile(all_latencies, 99) * 1000,
+            'queued_max': max(sampler.queued, default=0),
+            'queued_mean': sum(sampler.queued) / max(len(sampler.queued), 1),
+            'threads_max': max(sampler.threads, default=0),
+            'errors': len(errors)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma separated numbers of simulated users')
+    parser.add_argument('--workers', default='4,16', help='Comma separated executor sizes')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of the Stripe stand-in in seconds')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run each combination for')
+    parser.add_argument('--pool', action='store_true', help='Use the shared connection pool')
+    args = parser.parse_args()
+    stripe.api_key = 'sk_test_load'
+    stripe.max_network_retries = 0
+    columns = ['concurrency', 'workers', 'throughput', 'p50', 'p95', 'p99', 'queued_max', 'queued_mean',
+               'threads_max', 'errors']
+    print(''.join(f'{column:>13}' for column in columns))
+    with FakeStripe(latency=args.latency):
+        for workers in (int(w) for w in args.workers.split(',')):
+            for concurrency in (int(c) for c in args.concurrency.split(',')):
+                result = run(concurrency, workers, args.duration, args.pool)
+                print(''.join(f'{result[column]:>13.1f}' if isinstance(result[column], float)
+                              else f'{result[column]:>13}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,19 @@
+import contextvars
 import stripe
-from concurrent.futures import ThreadPoolExecutor
-from .decorators import customer_id_required
-from .exceptions import StripeCustomerIdRequired, DefaultPaymentMethodRequired, StripeWrongCustomer
+from concurrent.futures import Future
+from .cache import (request_memoize, clears_request_cache, ttl_memoize, catalog, _freeze, TTLCache,
+                    negative_memoize, no_subscriptions, owners)
+from .checkout import checkout_sessions
+from .client import AccountClient, request_params
+from .circuit import fallback_to_last_known_good
+from .writethrough import write_through, writes_through
+from .decorators import customer_id_required, subscription_required
+from .exceptions import (
+    StripeCustomerIdRequired, DefaultPaymentMethodRequired, StripeWrongCustomer, StripeSubscriptionRequired
+)
 import itertools
-from . import tests
+from . import tests, profiling, scheduler, deadline
+from .deadline import accepts_deadline
 from .types import (
     UserProtocol, PaymentMethodType, ProductSubscription, ProductIsSubscribed, Price, PriceSubscription,
     ProductPriceSubscription, Product, ProductDetail, PriceNoProductSubscriptionInfo
@@ -19,7 +29,41 @@ app_url = "https://github.com/primal100/stripe-subscriptions"
 stripe.set_app_info(app_name, version=version, url=app_url)
 
 
-executor = ThreadPoolExecutor()
+executor = scheduler.executor
+
+_in_scheduler: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_in_scheduler', default=False)
+
+_caller_runs = scheduler.SynchronousScheduler()
+
+
+def _submit(fn, *args, **kwargs) -> Future:
+    """
+    Run a function with the configured scheduler in a copy of the caller's context, so the request cache and other
+    context variables set by the caller are also available in the executor thread.
+    A function submitted by another function already running in the scheduler, such as a bulk job's task, runs
+    straight away in the same thread, so tasks waiting for tasks they submitted cannot take up every worker and wait
+    forever for tasks queued behind them.
+    """
+    ctx = contextvars.copy_context()
+    runner = _caller_runs if _in_scheduler.get() else scheduler.current
+    ctx.run(_in_scheduler.set, True)
+    future = runner.submit(ctx.run, profiling.queued(fn, _name(fn)), *args, **kwargs)
+    deadline.track(future)
+    return future
+
+
+def _result(future: Future, name: str) -> Any:
+    """
+    Wait for the result of a function submitted with _submit, until the current deadline if there is one.
+    The wait is recorded if profiling is active.
+    """
+    with profiling.span(f'wait {name}', 'wait'):
+        return deadline.wait(future, name)
+
+
+def _name(fn) -> str:
+    owner = getattr(fn, '__self__', None)
+    return f'{owner.__name__}.{fn.__name__}' if isinstance(owner, type) else fn.__name__
 
 
 class User(UserProtocol):
@@ -31,6 +75,7 @@ class User(UserProtocol):
 
 # Customer
 
+@accepts_deadline
 def create_customer(user: UserProtocol, **kwargs) -> stripe.Customer:
     """
     Creates a new customer over the stripe API using the user data. The customer id is set on the user object but not saved.
@@ -38,11 +83,14 @@ def create_customer(user: UserProtocol, **kwargs) -> stripe.Customer:
     """
     metadata = kwargs.pop('metadata', {})
     metadata['id'] = user.id
-    customer = stripe.Customer.create(email=user.email, name=str(user), metadata=metadata, **kwargs)
+    customer = stripe.Customer.create(email=user.email, name=str(user), metadata=metadata, **request_params(),
+                                      **kwargs)
     user.stripe_customer_id = customer['id']
     return customer
 
 
+@accepts_deadline
+@clears_request_cache
 @customer_id_required
 def delete_customer(user: UserProtocol) -> stripe.Customer:
     """
@@ -50,12 +98,13 @@ def delete_customer(user: UserProtocol) -> stripe.Customer:
     The customer id must be saved to the database after this function is called, e.g. by calling user.save().
     An exception will be raised if the user does already not have a customer id set.
     """
-    response = stripe.Customer.delete(user.stripe_customer_id)
+    response = stripe.Customer.delete(user.stripe_customer_id, **request_params())
     user.stripe_customer_id = None
     return response
 
 
 # Checkouts
+@accepts_deadline
 @customer_id_required
 def create_checkout(user: UserProtocol, mode: str, line_items: List[Dict[str, Any]] = None,
                     **kwargs) -> stripe.checkout.Session:
@@ -63,15 +112,23 @@ def create_checkout(user: UserProtocol, mode: str, line_items: List[Dict[str, An
     Creates a new Stripe checkout session for this user.
     Recommended to call create_subscription_checkout or create_setup_checkout instead.
     An exception will be raised if the user does already not have a customer id set.
+    If checkout session reuse is enabled by setting checkout_sessions.ttl, an open session created with the same
+    arguments is returned instead of creating a new one, including by concurrent calls.
     """
+    if checkout_sessions.ttl:
+        key = _freeze((user.stripe_customer_id, mode, line_items, kwargs))
+        return checkout_sessions.find_or_create(key, lambda: stripe.checkout.Session.create(
+            customer=user.stripe_customer_id, mode=mode, line_items=line_items, **request_params(), **kwargs))
     return stripe.checkout.Session.create(
         customer=user.stripe_customer_id,
         mode=mode,
         line_items=line_items,
+        **request_params(),
         **kwargs
     )
 
 
+@accepts_deadline
 def create_subscription_checkout(user: UserProtocol, price_id: str, **kwargs) -> stripe.checkout.Session:
     """
     Creates a new Stripe subscription checkout session for this user for the given price.
@@ -85,6 +142,7 @@ def create_subscription_checkout(user: UserProtocol, price_id: str, **kwargs) ->
         ], **kwargs)
 
 
+@accepts_deadline
 def create_setup_checkout(user: UserProtocol, subscription_id: str = None, **kwargs) -> stripe.checkout.Session:
     """
     Creates a new Stripe setup checkout session for this user, allowing them to add a new payment method for future use.
@@ -106,13 +164,24 @@ def allow_if_owned_by_user(user: Optional[UserProtocol], obj_class,
     If user tries to access an object belonging to another user, StripeWrongCustomer exception is raised.
     The action word is included in the exception.
     """
-    obj = obj_class.retrieve(obj_id)
+    obj = obj_class.retrieve(obj_id, **request_params())
     if not user or obj['customer'] != user.stripe_customer_id:
         msg = f"Customer {user.stripe_customer_id} cannot {action} {obj['object']} {obj_id} as they do not own it."
         raise StripeWrongCustomer(msg)
+    owners.set((obj['object'], obj_id), obj['customer'])
     return obj
 
 
+def _check_owner(user: Optional[UserProtocol], obj_class, obj_id: str, action: str) -> None:
+    """
+    Same as allow_if_owned_by_user but the object is not retrieved if the ownership cache shows the user owns it.
+    """
+    if user and user.stripe_customer_id and owners.get((obj_class.OBJECT_NAME, obj_id)) == user.stripe_customer_id:
+        return
+    allow_if_owned_by_user(user, obj_class, obj_id, action)
+
+
+@accepts_deadline
 def retrieve(user: UserProtocol, obj_cls, obj_id: str, action="retrieve") -> Mapping[str, Any]:
     """
     Retrieve an object over Stripe API for the given obj_id and obj_cls.
@@ -123,44 +192,55 @@ def retrieve(user: UserProtocol, obj_cls, obj_id: str, action="retrieve") -> Map
     return allow_if_owned_by_user(user, obj_cls, obj_id, action)
 
 
+@accepts_deadline
+@writes_through
 def delete(user: UserProtocol, obj_cls, obj_id: str, action: str = "delete"):
     """
     Delete an object over Stripe API with given obj_id for obj_cls.
     obj_cls could be stripe.Subscription, stripe.PaymentMethod, stripe.Invoice, etc.
-    It is needed to retrieve the obj first to check the customer id.
+    It is needed to retrieve the obj first to check the customer id, unless the ownership cache shows the user owns it.
     If a customer attempts to delete an object belonging to another customer, StripeWrongCustomer exception is raised.
     The action word if provided is included in StripeWrongCustomer exception if raised.
     """
-    obj = retrieve(user, obj_cls, obj_id, action=action)
-    return obj_cls.delete(obj)
+    _check_owner(user, obj_cls, obj_id, action)
+    return obj_cls.delete(obj_id, **request_params())
 
 
+@accepts_deadline
+@writes_through
 def modify(user: UserProtocol, obj_cls, obj_id: str, action: str = "modify",
            **kwargs) -> Union[Mapping[str, Any], stripe.Subscription]:
     """
     Modify an object over Stripe API with given obj_id for obj_cls.
     obj_cls could be stripe.Subscription, stripe.PaymentMethod, stripe.Invoice, etc.
-    It is needed to retrieve the obj first to check the customer id.
+    It is needed to retrieve the obj first to check the customer id, unless the ownership cache shows the user owns it.
     If a customer attempts to modify an object belonging to another customer, StripeWrongCustomer exception is raised.
     kwargs are the parameters to be modified.
     The action word if provided is included in StripeWrongCustomer exception if raised.
     """
-    obj = retrieve(user, obj_cls, obj_id, action=action)
-    return obj_cls.modify(obj["id"], **kwargs)
+    _check_owner(user, obj_cls, obj_id, action)
+    return obj_cls.modify(obj_id, **request_params(), **kwargs)
 
 
 # Manage Subscriptions
 
+@accepts_deadline
+@request_memoize
+@negative_memoize(no_subscriptions)
+@fallback_to_last_known_good
 def list_subscriptions(user: Optional[UserProtocol], **kwargs) -> List[stripe.Subscription]:
     """
     List all subscriptions for a user. Filters can be applied with kwargs according to the Stripe API.
     """
     if user and user.stripe_customer_id:
-        subscriptions = stripe.Subscription.list(customer=user.stripe_customer_id, **kwargs)
+        subscriptions = stripe.Subscription.list(customer=user.stripe_customer_id, **request_params(), **kwargs)
+        for sub in subscriptions['data']:
+            owners.set(('subscription', sub['id']), user.stripe_customer_id)
         return subscriptions['data']
     return []
 
 
+@accepts_deadline
 def list_active_subscriptions(user: Optional[UserProtocol], **kwargs) -> List[stripe.Subscription]:
     """
     List all active subscriptions for a user.
@@ -168,6 +248,7 @@ def list_active_subscriptions(user: Optional[UserProtocol], **kwargs) -> List[st
     return list_subscriptions(user, status='active', **kwargs)
 
 
+@accepts_deadline
 def cancel_subscription(user: UserProtocol, subscription_id: str) -> stripe.Subscription:
     """
     Allow a user to cancel their subscription by subscription_id.
@@ -176,34 +257,42 @@ def cancel_subscription(user: UserProtocol, subscription_id: str) -> stripe.Subs
     return delete(user, stripe.Subscription, subscription_id)
 
 
+@accepts_deadline
 def cancel_subscription_for_product(user: UserProtocol, product_id: str) -> bool:
     """
     Allow a user to cancel their subscription by the id of the product they are subscribed to, if such a subscription exists.
     Returns True if the subscription exists for that user, otherwise False.
+    The canceled subscriptions are written through to the local caches.
     """
     sub_cancelled = False
     for sub in list_subscriptions(user):
         if _check_subscription_product_id(sub) == product_id:
             sub_id = sub['id']
-            stripe.Subscription.delete(sub_id)
+            write_through(user.stripe_customer_id, stripe.Subscription.delete(sub_id, **request_params()))
             sub_cancelled = True
     return sub_cancelled
 
 
+@accepts_deadline
 @customer_id_required
+@writes_through
 def update_default_payment_method_all_subscriptions(user: UserProtocol, default_payment_method: str) -> stripe.Customer:
     """
     Change the default payment method for the user and for all subscriptions belonging to that user.
+    The changed subscriptions and customer are written through to the local caches.
     """
-    customer_fut = executor.submit(stripe.Customer.modify, user.stripe_customer_id, invoice_settings={
-        'default_payment_method': default_payment_method})
+    customer_fut = _submit(stripe.Customer.modify, user.stripe_customer_id, invoice_settings={
+        'default_payment_method': default_payment_method}, **request_params())
     subs = list_subscriptions(user)
-    fs = [executor.submit(stripe.Subscription.modify, sub["id"], default_payment_method=default_payment_method)
+    fs = [_submit(stripe.Subscription.modify, sub["id"], default_payment_method=default_payment_method,
+                  **request_params())
           for sub in subs if sub['default_payment_method'] != default_payment_method]
-    [f.result() for f in fs]
-    return customer_fut.result()
+    for f in fs:
+        write_through(user.stripe_customer_id, _result(f, 'Subscription.modify'))
+    return _result(customer_fut, 'Customer.modify')
 
 
+@accepts_deadline
 def modify_subscription(user: UserProtocol, subscription_id: str,
                         set_as_default_payment_method: bool = False, **kwargs) -> stripe.Subscription:
     """
@@ -229,20 +318,29 @@ def _check_default_payment_method_kwargs(set_as_default_payment_method: bool,
     return set_as_default_payment_method
 
 
+@accepts_deadline
+@writes_through
 @customer_id_required
-def create_subscription(user: UserProtocol, price_id: str,
-                        set_as_default_payment_method: bool = False, **kwargs) -> stripe.Subscription:
+def create_subscription(user: UserProtocol, price_id: Optional[str] = None,
+                        set_as_default_payment_method: bool = False, quantity: Optional[int] = None,
+                        items: Optional[List[Dict[str, Any]]] = None, **kwargs) -> stripe.Subscription:
     """
     Create a new subscription. A payment method must already be created.
     If set_as_default_payment_method is true, the given payment method will be set as the default for this customer.
+    quantity is the quantity of price_id, e.g. the number of seats.
+    items is a list of further items such as {"price": price_id, "quantity": 5} for a subscription to several prices.
     kwargs is a list of parameters to provide to stripe.Subscription.create in the Stripe API.
     """
     _check_default_payment_method_kwargs(set_as_default_payment_method, **kwargs)
+    subscription_items = list(items or [])
+    if price_id:
+        subscription_items.insert(0, {"price": price_id, **({"quantity": quantity} if quantity else {})})
+    if not subscription_items:
+        raise ValueError("A price_id or items are required to create a subscription")
     sub = stripe.Subscription.create(
         customer=user.stripe_customer_id,
-        items=[
-            {"price": price_id},
-        ],
+        items=subscription_items,
+        **request_params(),
         **kwargs
     )
     if set_as_default_payment_method:
@@ -256,29 +354,59 @@ def _check_subscription_product_id(sub: stripe.Subscription) -> str:
     """
     Easy way to get the product_id a subscription is for
     """
-    return sub.get('plan', {}).get('product', None)
+    return (sub.get('plan') or {}).get('product', None)
 
 
 def _check_subscription_price_id(sub: stripe.Subscription) -> str:
     """
     Easy way to get the price_id a subscription is for
     """
-    return sub.get('plan', {}).get('id', None)
+    return (sub.get('plan') or {}).get('id', None)
+
+
+def _subscription_info(sub: Mapping[str, Any]) -> ProductSubscription:
+    """
+    Flat data for a single subscription, as returned by list_products_prices_subscribed_to.
+    """
+    return {'sub_id': sub['id'],
+            'product_id': _check_subscription_product_id(sub),
+            'price_id': _check_subscription_price_id(sub),
+            'cancel_at': sub.get('cancel_at', None),
+            'current_period_end': sub.get('current_period_end', None)
+            }
 
 
+def _subscription_items_info(sub: Mapping[str, Any]) -> List[ProductSubscription]:
+    """
+    Flat data for each price of a subscription. Subscriptions to several prices have no plan so each item is listed.
+    Items are either as returned by Stripe or as stored by the local store, with the price id and product id.
+    """
+    items = sub.get('items') or []
+    if isinstance(items, Mapping):
+        items = items.get('data', [])
+    if len(items) <= 1:
+        return [_subscription_info(sub)]
+    infos = []
+    for item in items:
+        price = item['price']
+        infos.append({'sub_id': sub['id'],
+                      'product_id': price['product'] if isinstance(price, Mapping) else item.get('product'),
+                      'price_id': price['id'] if isinstance(price, Mapping) else price,
+                      'cancel_at': sub.get('cancel_at', None),
+                      'current_period_end': sub.get('current_period_end', None)})
+    return infos
+
+
+@accepts_deadline
 def list_products_prices_subscribed_to(user: UserProtocol, **kwargs) -> List[ProductSubscription]:
     """
     Flat data for each active subscription to quickly check which products a user is subscribed to.
     """
     subscriptions = list_active_subscriptions(user, **kwargs)
-    return [{'sub_id': sub['id'],
-             'product_id': _check_subscription_product_id(sub),
-             'price_id': _check_subscription_price_id(sub),
-             'cancel_at': sub.get('cancel_at', None),
-             'current_period_end': sub.get('current_period_end', None)
-             } for sub in subscriptions]
+    return [info for sub in subscriptions for info in _subscription_items_info(sub)]
 
 
+@accepts_deadline
 def is_subscribed_and_cancelled_time(user: UserProtocol, product_id: Optional[str] = None,
                                      price_id: Optional[str] = None, **kwargs) -> ProductIsSubscribed:
     """
@@ -291,6 +419,7 @@ def is_subscribed_and_cancelled_time(user: UserProtocol, product_id: Optional[st
     return {'sub_id': None, 'cancel_at': None, 'current_period_end': None, 'product_id': None, 'price_id': None}
 
 
+@accepts_deadline
 def is_subscribed(user: UserProtocol, product_id: str = None, price_id: str = None) -> bool:
     """
     Returns a simple true or false to check if a user subscribed to the given product or price.
@@ -298,50 +427,77 @@ def is_subscribed(user: UserProtocol, product_id: str = None, price_id: str = No
     return bool(is_subscribed_and_cancelled_time(user, product_id, price_id)['sub_id'])
 
 
+def _to_dict(value: Any) -> Any:
+    """
+    Nested Stripe objects keep the whole API response they came from in memory, so are converted to plain dicts.
+    """
+    return value.to_dict_recursive() if isinstance(value, stripe.stripe_object.StripeObject) else value
+
+
+def _consume(objs: List[Any]) -> Generator[Any, None, None]:
+    """
+    Yield the objects in a list in order, removing each one from the list so it can be freed once the caller is done
+    with it, instead of holding every object until the whole list has been processed.
+    """
+    objs.reverse()
+    while objs:
+        yield objs.pop()
+
+
 def _minimize_price(price: Dict[str, Any]) -> Price:
     """
     Return only the keys and values of a price the end user would be interested in.
     """
     keys = ['id', 'recurring', 'type', 'currency', 'unit_amount', 'unit_amount_decimal', 'nickname',
             'product', 'metadata']
-    return {k: price[k] for k in keys}
+    return {k: _to_dict(price[k]) for k in keys}
 
 
+@accepts_deadline
+@request_memoize
+@ttl_memoize(catalog)
+@fallback_to_last_known_good
 def get_active_prices(**kwargs) -> List[Price]:
     """
     List all active prices
     kwargs is a list of filters to provide to stripe.Price.list as in the Stripe API.
     """
-    response = stripe.Price.list(active=True, **kwargs)
-    return [_minimize_price(p) for p in response['data']]
+    response = stripe.Price.list(active=True, **request_params(), **kwargs)
+    with profiling.span('minimize prices'):
+        return [_minimize_price(p) for p in _consume(response['data'])]
 
 
+@accepts_deadline
+@profiling.profiled
 def get_subscription_prices(user: Optional[UserProtocol] = None, **kwargs) -> List[PriceSubscription]:
     """
     Makes multiple requests to Stripe API to return the list of active prices with subscription data for each one for the given user.
     kwargs is a list of filters to provide to stripe.Price.list as in the Stripe API.
     """
-    price_future = executor.submit(get_active_prices, **kwargs)
-    subscribed_prices_future = executor.submit(list_products_prices_subscribed_to, user)
-    prices = price_future.result()
-    subscribed_prices = subscribed_prices_future.result()
+    price_future = _submit(get_active_prices, **kwargs)
+    subscribed_prices_future = _submit(list_products_prices_subscribed_to, user)
+    prices = _result(price_future, 'get_active_prices')
+    subscribed_prices = _result(subscribed_prices_future, 'list_products_prices_subscribed_to')
     p: PriceSubscription
-    for p in prices:
-        p['subscription_info'] = {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
-        for s in subscribed_prices:
-            if s['price_id'] == p['id']:
-                p['subscription_info'] = {'sub_id': s['sub_id'], 'cancel_at': s['cancel_at'],
-                                          'current_period_end': s['current_period_end']}
+    with profiling.span('join prices and subscriptions'):
+        for p in prices:
+            p['subscription_info'] = {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
+            for s in subscribed_prices:
+                if s['price_id'] == p['id']:
+                    p['subscription_info'] = {'sub_id': s['sub_id'], 'cancel_at': s['cancel_at'],
+                                              'current_period_end': s['current_period_end']}
     return prices
 
 
+@accepts_deadline
+@profiling.profiled
 def retrieve_price(user: Optional[UserProtocol], price_id: str) -> PriceSubscription:
     """
     Retrieve a single price with subscription info
     """
-    price_future = executor.submit(stripe.Price.retrieve, price_id)
+    price_future = _submit(stripe.Price.retrieve, price_id, **request_params())
     subscription_info = is_subscribed_and_cancelled_time(user, price_id=price_id)
-    price = _minimize_price(price_future.result())
+    price = _minimize_price(_result(price_future, 'Price.retrieve'))
     price["subscription_info"] = {
         'sub_id': subscription_info['sub_id'],
         'current_period_end': subscription_info['current_period_end'],
@@ -355,18 +511,25 @@ def _minimize_product(product: stripe.Product) -> Product:
     Return only the keys and values of a product the end user would be interested in.
     """
     keys = ['id', 'images', 'type', 'name', 'shippable', 'unit_label', 'url', 'metadata']
-    return {k: product[k] for k in keys}
+    return {k: _to_dict(product[k]) for k in keys}
 
 
+@accepts_deadline
+@request_memoize
+@ttl_memoize(catalog)
+@fallback_to_last_known_good
 def get_active_products(**kwargs) -> List[Product]:
     """
     Get a list of active products with the most important keys for the end user to see.
     kwargs is a list of filters to provide to stripe.Product.list as in Stripe API.
     """
-    response = stripe.Product.list(active=True, **kwargs)
-    return [_minimize_product(product) for product in response]
+    response = stripe.Product.list(active=True, **request_params(), **kwargs)
+    with profiling.span('minimize products'):
+        return [_minimize_product(product) for product in _consume(response['data'])]
 
 
+@accepts_deadline
+@profiling.profiled
 def get_subscription_products_and_prices(user: Optional[UserProtocol] = None,
                                          price_kwargs: Optional[Dict[str, Any]] = None,
                                          **kwargs) -> List[ProductDetail]:
@@ -375,36 +538,39 @@ def get_subscription_products_and_prices(user: Optional[UserProtocol] = None,
     kwargs is a list of filters product to stripe.Product.list.
     price_kwargs is a list of filters provided to stripe.Price.list
     """
-    products_future = executor.submit(get_active_products, **kwargs)
+    products_future = _submit(get_active_products, **kwargs)
     price_kwargs = price_kwargs or {}
     prices = get_subscription_prices(user, **price_kwargs)
     product: ProductDetail
-    products = products_future.result()
-    for product in products:
-        product['prices'] = []
-        product['subscription_info'] = {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
-    price: PriceNoProductSubscriptionInfo
-    for price in prices:
-        product_id = price.pop('product', None)
-        if product_id:
-            for product in products:
-                if product_id == product['id']:
-                    product['prices'].append(price)
-                    if price['subscription_info']['sub_id']:
-                        product['subscription_info'] = price['subscription_info']
+    products = _result(products_future, 'get_active_products')
+    with profiling.span('join products and prices'):
+        for product in products:
+            product['prices'] = []
+            product['subscription_info'] = {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
+        price: PriceNoProductSubscriptionInfo
+        for price in prices:
+            product_id = price.pop('product', None)
+            if product_id:
+                for product in products:
+                    if product_id == product['id']:
+                        product['prices'].append(price)
+                        if price['subscription_info']['sub_id']:
+                            product['subscription_info'] = price['subscription_info']
     return products
 
 
+@accepts_deadline
+@profiling.profiled
 def retrieve_product(user: Optional[UserProtocol], product_id: str,
                      price_kwargs: Optional[Dict[str, Any]] = None) -> ProductDetail:
     """
     Retrieve a single product with prices and subscription information included in the result.
     price_kwargs is a list of filters provided to stripe.Price.list
     """
-    product_future = executor.submit(stripe.Product.retrieve, product_id)
+    product_future = _submit(stripe.Product.retrieve, product_id, **request_params())
     price_kwargs = price_kwargs or {}
     prices = get_subscription_prices(user, product=product_id, **price_kwargs)
-    product: ProductDetail = _minimize_product(product_future.result())
+    product: ProductDetail = _minimize_product(_result(product_future, 'Product.retrieve'))
     product['prices'] = prices
     product['subscription_info'] = {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
     price: PriceNoProductSubscriptionInfo
@@ -416,25 +582,90 @@ def retrieve_product(user: Optional[UserProtocol], product_id: str,
 
 
 # Setup Intents
+precreated_setup_intents = TTLCache(ttl=3600)
+
+
+def _setup_intent_kwargs(user: UserProtocol, payment_method_types: Optional[List[PaymentMethodType]],
+                         kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    setup_intent_kwargs = {
+        'customer': user.stripe_customer_id,
+        'confirm': False,
+        'payment_method_types': payment_method_types,
+        'usage': "off_session"}
+    setup_intent_kwargs.update(kwargs)
+    return setup_intent_kwargs
+
+
+def _find_open_setup_intent(setup_intent_kwargs: Dict[str, Any]) -> Optional[stripe.SetupIntent]:
+    """
+    The customer's most recent setup intent which is still waiting for a payment method and was created with the
+    same payment method types, usage and any other given values.
+    """
+    intents = stripe.SetupIntent.list(customer=setup_intent_kwargs['customer'], limit=10, **request_params())
+    expected = {k: v for k, v in setup_intent_kwargs.items() if k not in ('customer', 'confirm') and v is not None}
+    for intent in intents['data']:
+        if intent['status'] == 'requires_payment_method' and all(intent.get(k) == v for k, v in expected.items()):
+            return intent
+    return None
+
+
+def _open_or_new_setup_intent(setup_intent_kwargs: Dict[str, Any]) -> stripe.SetupIntent:
+    return (_find_open_setup_intent(setup_intent_kwargs)
+            or stripe.SetupIntent.create(**request_params(), **setup_intent_kwargs))
+
+
+@accepts_deadline
 @customer_id_required
 def create_setup_intent(user: UserProtocol, payment_method_types: List[PaymentMethodType] = None,
-                        **kwargs) -> stripe.SetupIntent:
+                        reuse: bool = False, **kwargs) -> stripe.SetupIntent:
     """
      Create a setup intent, the first step in adding a payment method which can later be used for paying subscriptions.
      price_kwargs is a list of filters provided to stripe.SetupIntent.create
+     If reuse is True, a setup intent created by precreate_setup_intent with the same arguments is returned if there is
+     one, otherwise the customer's open setup intent with the same payment method types and usage, so a new one is
+     only created if neither exists.
 
      Raises an exception if the user does not have a customer id
      """
-    setup_intent_kwargs = {
-        'customer': user.stripe_customer_id,
-        'confirm': False,
-        'payment_method_types': payment_method_types,
-        'usage': "off_session"}
-    setup_intent_kwargs.update(kwargs)
-    return stripe.SetupIntent.create(**setup_intent_kwargs)
+    setup_intent_kwargs = _setup_intent_kwargs(user, payment_method_types, kwargs)
+    if reuse:
+        key = _freeze(setup_intent_kwargs)
+        future = precreated_setup_intents.get(key)
+        if future is not None:
+            precreated_setup_intents.delete(key)
+            try:
+                return _result(future, 'precreate_setup_intent')
+            except stripe.error.StripeError:
+                pass
+        intent = _find_open_setup_intent(setup_intent_kwargs)
+        if intent is not None:
+            return intent
+    return stripe.SetupIntent.create(**request_params(), **setup_intent_kwargs)
+
+
+@accepts_deadline
+@customer_id_required
+def precreate_setup_intent(user: UserProtocol, payment_method_types: List[PaymentMethodType] = None,
+                           **kwargs) -> Future:
+    """
+    Start creating a setup intent in the background, for example when the user opens their account settings, so a
+    later call to create_setup_intent with the same arguments and reuse=True does not wait for Stripe.
+    The customer's open setup intent is used if there is one. Unused setup intents are forgotten after
+    precreated_setup_intents.ttl seconds.
+    """
+    setup_intent_kwargs = _setup_intent_kwargs(user, payment_method_types, kwargs)
+    key = _freeze(setup_intent_kwargs)
+    future = precreated_setup_intents.get(key)
+    if future is None:
+        future = _submit(_open_or_new_setup_intent, setup_intent_kwargs)
+        precreated_setup_intents.set(key, future)
+    return future
 
 
 # Payment Methods
+@accepts_deadline
+@request_memoize
+@fallback_to_last_known_good
 def list_payment_methods(user: Optional[UserProtocol], types: List[PaymentMethodType],
                          **kwargs) -> Generator[stripe.PaymentMethod, None, None]:
     """
@@ -446,35 +677,41 @@ def list_payment_methods(user: Optional[UserProtocol], types: List[PaymentMethod
     if not user or not user.stripe_customer_id or len(types) == 0:
         yield from []
     else:
-        customer_future = executor.submit(stripe.Customer.retrieve, user.stripe_customer_id)
-        futures = [executor.submit(stripe.PaymentMethod.list,
-                                   customer=user.stripe_customer_id, type=payment_type, **kwargs)
+        customer_future = _submit(stripe.Customer.retrieve, user.stripe_customer_id, **request_params())
+        futures = [_submit(stripe.PaymentMethod.list,
+                           customer=user.stripe_customer_id, type=payment_type, **request_params(), **kwargs)
                    for payment_type in types]
-        customer = customer_future.result()
+        customer = _result(customer_future, 'Customer.retrieve')
         default_payment_method = customer['invoice_settings']['default_payment_method']
-        for payment_method in itertools.chain(*[f.result() for f in futures]):
+        pages = (_result(f, 'PaymentMethod.list') for f in _consume(futures))
+        for payment_method in itertools.chain.from_iterable(pages):
             payment_method['default'] = payment_method['id'] == default_payment_method
+            owners.set(('payment_method', payment_method['id']), user.stripe_customer_id)
             yield payment_method
 
 
+@accepts_deadline
+@writes_through
 def detach_payment_method(user: Optional[UserProtocol], payment_method_id: str) -> stripe.PaymentMethod:
     """
     Detach a user's payment method.
-    It is needed to retrieve the payment method first to check the customer id.
+    It is needed to retrieve the payment method first to check the customer id, unless the ownership cache shows the
+    user owns it.
     If a customer attempts to detach an object belonging to another customer, StripeWrongCustomer exception is raised.
     """
-    obj = retrieve(user, stripe.PaymentMethod, payment_method_id, action="detach")
-    return stripe.PaymentMethod.detach(obj["id"])
+    _check_owner(user, stripe.PaymentMethod, payment_method_id, action="detach")
+    return stripe.PaymentMethod.detach(payment_method_id, **request_params())
 
 
+@accepts_deadline
+@writes_through
 def detach_all_payment_methods(user: Optional[UserProtocol], types: List[PaymentMethodType],
                                **kwargs) -> List[stripe.PaymentMethod]:
     """
     Detach all of a user's payment methods.
     """
     if user and user.stripe_customer_id:
-        futures = [executor.submit(stripe.PaymentMethod.detach,
-                                   payment_type)
+        futures = [_submit(stripe.PaymentMethod.detach, payment_type, **request_params())
                    for payment_type in list_payment_methods(user, types, **kwargs)]
-        return [f.result() for f in futures]
+        return [_result(f, 'PaymentMethod.detach') for f in futures]
     return []
@@ -0,0 +1,417 @@
+import itertools
+import json
+import os
+import queue
+import stripe
+import threading
+import time
+from concurrent.futures import Future
+from .cache import current_request_cache, no_subscriptions, owners
+from .checkpoint import Checkpoint
+from .entitlements import entitlements
+from .exceptions import BaseStripeSubscriptionsError
+from .ratelimit import RateLimiter
+from .stats import stats
+from .types import (UserProtocol, BulkResult, PaymentMethodType, PurgeResult, SubscriptionItemChange,
+                    SubscriptionItemsResult)
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def run_bulk(items: Iterable[T], func: Callable[[T], R], name: str, max_workers: int = 8,
+             checkpoint: Optional[Checkpoint] = None, checkpoint_every: int = 100) -> Iterator[R]:
+    """
+    Call func for each item with the configured scheduler and yield the results in the order they complete.
+    No more than max_workers items are run at once, so a bulk job leaves the rest of the scheduler's workers to other
+    callers, and items are read from the iterable lazily so no more than max_workers items are held in memory at once.
+    Progress is saved in the checkpoint under name as the number of items from the start of the iterable which have
+    all completed. If the same items are given again with the same checkpoint, those items are skipped.
+    func is expected to handle its own errors and record them in its result.
+    The number of completed items, and the throughput in items per second, are recorded in stats under name.
+    """
+    from . import _submit
+    checkpoint = checkpoint or Checkpoint()
+    completed_up_to = checkpoint.get(name, 0)
+    completed = set()
+    pending: Dict[int, Future] = {}
+    results: 'queue.Queue[Tuple[int, Any, Optional[BaseException]]]' = queue.Queue()
+    started = time.monotonic()
+    count = 0
+
+    def run(index: int, item: T) -> None:
+        try:
+            results.put((index, func(item), None))
+        except BaseException as e:
+            results.put((index, None, e))
+
+    def collect() -> R:
+        nonlocal completed_up_to, count
+        index, result, error = results.get()
+        del pending[index]
+        if error is not None:
+            raise error
+        completed.add(index)
+        count += 1
+        while completed_up_to in completed:
+            completed.remove(completed_up_to)
+            completed_up_to += 1
+        stats.incr(f'{name}.completed')
+        stats.gauge(f'{name}.throughput', count / max(time.monotonic() - started, 1e-9))
+        if count % checkpoint_every == 0:
+            checkpoint.set(name, completed_up_to)
+        return result
+
+    try:
+        for index, item in itertools.islice(enumerate(items), completed_up_to, None):
+            if len(pending) >= max_workers:
+                yield collect()
+            pending[index] = _submit(run, index, item)
+        while pending:
+            yield collect()
+    finally:
+        for future in pending.values():
+            future.cancel()
+    checkpoint.clear(name)
+
+
+def _list_all(limiter: RateLimiter, obj_cls, **params) -> List[Any]:
+    """
+    Every object of a list request, fetched 100 at a time, waiting for the limiter before each page.
+    """
+    limiter.acquire()
+    page = obj_cls.list(limit=100, **params)
+    objs = list(page['data'])
+    while page['has_more'] and objs:
+        limiter.acquire()
+        page = obj_cls.list(limit=100, starting_after=objs[-1]['id'], **params)
+        objs += page['data']
+    return objs
+
+
+def _update_default_payment_method(limiter: RateLimiter, user: UserProtocol,
+                                   default_payment_method: str) -> BulkResult:
+    """
+    Same as update_default_payment_method_all_subscriptions but only sends updates for the customer and subscriptions
+    which do not already have the payment method as default.
+    The customer is expanded in the subscription list to avoid retrieving it separately.
+    """
+    result: BulkResult = {'user_id': user.id, 'customer_id': user.stripe_customer_id, 'status': 'skipped',
+                          'subscriptions_updated': 0, 'error': None}
+    start = time.monotonic()
+    try:
+        if not user.stripe_customer_id:
+            raise ValueError(f"User {user.id} does not have a customer id")
+        subs = _list_all(limiter, stripe.Subscription, customer=user.stripe_customer_id, expand=['data.customer'])
+        if subs:
+            customer = subs[0]['customer']
+        else:
+            limiter.acquire()
+            customer = stripe.Customer.retrieve(user.stripe_customer_id)
+        if customer['invoice_settings']['default_payment_method'] != default_payment_method:
+            limiter.acquire()
+            stripe.Customer.modify(user.stripe_customer_id,
+                                   invoice_settings={'default_payment_method': default_payment_method})
+            result['status'] = 'updated'
+        for sub in subs:
+            if sub['default_payment_method'] != default_payment_method:
+                limiter.acquire()
+                stripe.Subscription.modify(sub['id'], default_payment_method=default_payment_method)
+                result['subscriptions_updated'] += 1
+                result['status'] = 'updated'
+    except (stripe.error.StripeError, BaseStripeSubscriptionsError, ValueError) as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    stats.incr(f'bulk.default_payment_method.{result["status"]}')
+    stats.timing('bulk.default_payment_method.duration', time.monotonic() - start)
+    return result
+
+
+def bulk_update_default_payment_method(users_payment_methods: Iterable[Tuple[UserProtocol, str]],
+                                       max_workers: int = 8, rate: float = 25,
+                                       checkpoint: Optional[Checkpoint] = None) -> Iterator[BulkResult]:
+    """
+    Change the default payment method for many customers and all their subscriptions, e.g. when migrating to a new
+    card processor. users_payment_methods is an iterable of (user, payment_method_id) and is read lazily.
+    Customers are processed concurrently by max_workers threads and no more than rate Stripe requests per second are
+    made in total. Customers and subscriptions which already have the payment method as default are not updated.
+    A result is yielded for each user with status updated, skipped or failed.
+    Pass a Checkpoint with a path and the same users_payment_methods to resume an interrupted migration.
+    Counts of each status, timings and throughput are recorded in stats under "bulk.default_payment_method".
+    """
+    limiter = RateLimiter(rate)
+    return run_bulk(users_payment_methods, lambda item: _update_default_payment_method(limiter, *item),
+                    'bulk.default_payment_method', max_workers=max_workers, checkpoint=checkpoint)
+
+
+def _forget_customer(customer_id: str, owned: Iterable[Tuple[str, str]]) -> None:
+    """
+    Remove what the local caches hold for a customer who was deleted, or partly purged, along with the ownership of
+    the subscriptions and payment methods removed from them.
+    """
+    entitlements.delete(customer_id)
+    no_subscriptions.delete(customer_id)
+    for key in owned:
+        owners.delete(key)
+    cache = current_request_cache()
+    if cache:
+        cache.forget(customer_id)
+
+
+def _purge_customer(limiter: RateLimiter, user: Union[UserProtocol, str], cancel_subscriptions: bool,
+                    payment_method_types: Sequence[PaymentMethodType]) -> PurgeResult:
+    """
+    Delete one customer, first cancelling their subscriptions and detaching their payment methods if asked.
+    A customer which no longer exists is skipped.
+    """
+    customer_id = user if isinstance(user, str) else user.stripe_customer_id
+    result: PurgeResult = {'user_id': None if isinstance(user, str) else user.id, 'customer_id': customer_id,
+                           'status': 'deleted', 'subscriptions_canceled': 0, 'payment_methods_detached': 0,
+                           'error': None}
+    owned: List[Tuple[str, str]] = []
+    start = time.monotonic()
+    try:
+        if not customer_id:
+            raise ValueError(f"User {result['user_id']} does not have a customer id")
+        if cancel_subscriptions:
+            for sub in _list_all(limiter, stripe.Subscription, customer=customer_id):
+                limiter.acquire()
+                stripe.Subscription.delete(sub['id'])
+                owned.append(('subscription', sub['id']))
+                result['subscriptions_canceled'] += 1
+        for payment_method_type in payment_method_types:
+            for payment_method in _list_all(limiter, stripe.PaymentMethod, customer=customer_id,
+                                            type=payment_method_type):
+                limiter.acquire()
+                stripe.PaymentMethod.detach(payment_method['id'])
+                owned.append(('payment_method', payment_method['id']))
+                result['payment_methods_detached'] += 1
+        limiter.acquire()
+        stripe.Customer.delete(customer_id)
+    except stripe.error.InvalidRequestError as e:
+        if e.code != 'resource_missing' or result['subscriptions_canceled'] or result['payment_methods_detached']:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        else:
+            result['status'] = 'skipped'
+    except (stripe.error.StripeError, BaseStripeSubscriptionsError, ValueError) as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    if customer_id:
+        _forget_customer(customer_id, owned)
+    if result['status'] != 'failed':
+        if not isinstance(user, str):
+            user.stripe_customer_id = None
+    stats.incr(f'bulk.purge.{result["status"]}')
+    stats.timing('bulk.purge.duration', time.monotonic() - start)
+    return result
+
+
+def _read_purge_log(path: str) -> Dict[str, PurgeResult]:
+    results = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['customer_id']] = result
+    return results
+
+
+def purge_customers(users: Iterable[Union[UserProtocol, str]], cancel_subscriptions: bool = False,
+                    payment_method_types: Sequence[PaymentMethodType] = (), max_workers: int = 8, rate: float = 25,
+                    log_path: Optional[str] = None) -> Iterator[PurgeResult]:
+    """
+    Delete many customers, e.g. for a GDPR purge or to clean up a test account. users is an iterable of users or
+    customer ids and is read lazily. Subscriptions are cancelled first if cancel_subscriptions is True and payment
+    methods of the given types are detached first. Deleting a customer also cancels their subscriptions straight away.
+    Customers are processed concurrently by max_workers threads and no more than rate Stripe requests per second are
+    made in total. A result is yielded for each user with status deleted, skipped if the customer did not exist or
+    failed. stripe_customer_id is set to None on users which were deleted or skipped.
+    If log_path is given, each result is appended to it as a line of JSON. Running again with the same log_path skips
+    customers which the log shows were already deleted or skipped, so an interrupted purge can be resumed.
+    Counts of each status and timings are recorded in stats under "bulk.purge".
+    """
+    limiter = RateLimiter(rate)
+    previous = _read_purge_log(log_path) if log_path else {}
+    done = {customer_id for customer_id, result in previous.items() if result['status'] != 'failed'}
+    lock = threading.Lock()
+    log = open(log_path, 'a') if log_path else None
+
+    def purge(user: Union[UserProtocol, str]) -> PurgeResult:
+        customer_id = user if isinstance(user, str) else user.stripe_customer_id
+        if customer_id in done:
+            if not isinstance(user, str):
+                user.stripe_customer_id = None
+            return {**previous[customer_id], 'user_id': getattr(user, 'id', None)}
+        result = _purge_customer(limiter, user, cancel_subscriptions, payment_method_types)
+        if log:
+            with lock:
+                log.write(json.dumps(result) + '\n')
+                log.flush()
+        return result
+
+    try:
+        yield from run_bulk(users, purge, 'bulk.purge', max_workers=max_workers)
+    finally:
+        if log:
+            log.close()
+
+
+def batches(results: Iterable[T], size: int = 500) -> Iterator[List[T]]:
+    """
+    Group results into lists of up to size, e.g. to clear the stripe_customer_id of purged users with one database
+    update per batch.
+    """
+    iterator = iter(results)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def _coalesce_item_changes(changes: Sequence[SubscriptionItemChange]) -> List[SubscriptionItemChange]:
+    """
+    Merge changes to the same item of a subscription, later changes taking precedence.
+    Items are identified by item_id, or by price_id for changes without an item_id.
+    """
+    merged: Dict[Tuple[str, str], SubscriptionItemChange] = {}
+    for change in changes:
+        if not change.get('item_id') and not change.get('price_id'):
+            raise ValueError(f"Change to subscription {change['subscription_id']} has no item_id or price_id")
+        key = ('item', change['item_id']) if change.get('item_id') else ('price', change['price_id'])
+        merged.setdefault(key, {}).update(change)
+    return list(merged.values())
+
+
+def _resolve_price_items(changes: Sequence[SubscriptionItemChange],
+                         price_items: Dict[str, str]) -> List[SubscriptionItemChange]:
+    """
+    Give changes which have a price_id but no item_id the id of the subscription's item for that price, so they are
+    merged with other changes to the same item.
+    """
+    resolved = []
+    for change in changes:
+        item_id = None if change.get('item_id') else price_items.get(change.get('price_id'))
+        if item_id:
+            change = {k: v for k, v in change.items() if k != 'price_id'}
+            change['item_id'] = item_id
+        resolved.append(change)
+    return resolved
+
+
+def _update_subscription_items(limiter: RateLimiter, subscription_id: str, changes: Sequence[SubscriptionItemChange],
+                               **kwargs) -> SubscriptionItemsResult:
+    """
+    Apply all changes to the items of one subscription with a single request.
+    If any change gives a price_id without an item_id, the subscription is retrieved first to find the item for that
+    price, so the existing item is changed instead of the price being added again and changes given by item_id and
+    by price_id for the same item are merged.
+    """
+    result: SubscriptionItemsResult = {'subscription_id': subscription_id, 'customer_id': None, 'status': 'updated',
+                                       'changes': len(changes), 'items_updated': 0, 'error': None}
+    start = time.monotonic()
+    try:
+        price_items: Dict[str, str] = {}
+        if any(not change.get('item_id') for change in changes):
+            limiter.acquire()
+            sub = stripe.Subscription.retrieve(subscription_id)
+            price_items = {item['price']['id']: item['id'] for item in sub['items']['data']}
+        item_changes = _coalesce_item_changes(_resolve_price_items(changes, price_items))
+        items: List[Dict[str, Any]] = []
+        for change in item_changes:
+            item_id = change.get('item_id')
+            if not item_id and change.get('deleted'):
+                continue
+            item: Dict[str, Any] = {'id': item_id} if item_id else {'price': change['price_id']}
+            if change.get('item_id') and change.get('price_id'):
+                item['price'] = change['price_id']
+            if 'quantity' in change:
+                item['quantity'] = change['quantity']
+            if change.get('deleted'):
+                item['deleted'] = True
+            items.append(item)
+        if items:
+            limiter.acquire()
+            sub = stripe.Subscription.modify(subscription_id, items=items, **kwargs)
+            result['customer_id'] = sub['customer'] if isinstance(sub['customer'], str) else sub['customer']['id']
+            result['items_updated'] = len(items)
+            entitlements.delete(result['customer_id'])
+    except (stripe.error.StripeError, BaseStripeSubscriptionsError, ValueError) as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    stats.incr(f'bulk.subscription_items.{result["status"]}')
+    stats.timing('bulk.subscription_items.duration', time.monotonic() - start)
+    return result
+
+
+def _group_by_subscription(changes: Iterable[SubscriptionItemChange],
+                           window: int) -> Iterator[Tuple[str, List[SubscriptionItemChange]]]:
+    for batch in batches(changes, window):
+        grouped: Dict[str, List[SubscriptionItemChange]] = {}
+        for change in batch:
+            grouped.setdefault(change['subscription_id'], []).append(change)
+        yield from grouped.items()
+
+
+def _in_subscription_order(groups: Iterable[Tuple[str, List[SubscriptionItemChange]]], func: Callable[..., R],
+                           skip: int = 0) -> Iterator[Callable[[], R]]:
+    """
+    Wrap func for each group so a group only runs once the previous group for the same subscription has finished,
+    as changes to a subscription from different windows would otherwise be sent concurrently in any order.
+    Groups are submitted in order, so the group waited for has always been submitted first.
+    The first skip groups, already completed by a run being resumed, are yielded as placeholders which are never run
+    and never waited for.
+    """
+    lock = threading.Lock()
+    last: Dict[str, threading.Event] = {}
+    for index, (subscription_id, changes) in enumerate(groups):
+        if index < skip:
+            yield lambda: None
+            continue
+        done = threading.Event()
+        with lock:
+            previous = last.get(subscription_id)
+            last[subscription_id] = done
+
+        def run(subscription_id=subscription_id, changes=changes, previous=previous, done=done) -> R:
+            try:
+                if previous is not None:
+                    previous.wait()
+                return func(subscription_id, changes)
+            finally:
+                done.set()
+                with lock:
+                    if last.get(subscription_id) is done:
+                        del last[subscription_id]
+        yield run
+
+
+def update_subscription_items(changes: Iterable[SubscriptionItemChange], max_workers: int = 8, rate: float = 25,
+                              window: int = 1000, checkpoint: Optional[Checkpoint] = None,
+                              **kwargs) -> Iterator[SubscriptionItemsResult]:
+    """
+    Change the items of many subscriptions, e.g. to update seat quantities nightly. changes is an iterable of dicts
+    with a subscription_id and an item_id or price_id, plus the new quantity, a new price_id for the item or deleted
+    set to True. A price_id without an item_id changes the subscription's item for that price, or adds the price if the
+    subscription does not have it yet. Later changes to the same item take precedence.
+    changes is read lazily, window at a time. All changes to the same subscription within a window are sent as one
+    request, so sort changes by subscription to send a single request for each. Requests for the same subscription
+    from different windows are sent one after another, in order. Subscriptions are updated concurrently
+    by max_workers threads and no more than rate Stripe requests per second are made in total.
+    kwargs such as proration_behavior are passed to stripe.Subscription.modify.
+    A result is yielded for each request with status updated or failed, in the order they complete.
+    Pass a Checkpoint with a path and the same changes to resume an interrupted run.
+    Counts of each status and timings are recorded in stats under "bulk.subscription_items".
+    """
+    limiter = RateLimiter(rate)
+    checkpoint = checkpoint or Checkpoint()
+    groups = _in_subscription_order(
+        _group_by_subscription(changes, window),
+        lambda subscription_id, group: _update_subscription_items(limiter, subscription_id, group, **kwargs),
+        skip=checkpoint.get('bulk.subscription_items', 0))
+    return run_bulk(groups, lambda run: run(), 'bulk.subscription_items', max_workers=max_workers,
+                    checkpoint=checkpoint)
@@ -0,0 +1,380 @@
+import contextvars
+import copy
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import wraps
+from . import webhooks
+from .client import account_id
+
+from typing import Any, Callable, Dict, Hashable, Iterator, Mapping, Optional, Set, Tuple
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    Convert a function argument to something hashable so it can be part of a cache key.
+    Users are identified by their customer id.
+    """
+    if hasattr(value, 'stripe_customer_id'):
+        return 'user', value.stripe_customer_id
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def make_key(f: Callable, args: tuple, kwargs: Dict[str, Any]) -> Hashable:
+    """
+    Cache key for a call to f with the given arguments, for the account whose client is active if any.
+    """
+    return account_id(), f.__qualname__, _freeze(args), _freeze(kwargs)
+
+
+class TTLCache:
+    """
+    Thread-safe cache shared across requests where values expire ttl seconds after being set.
+    Once maxsize is reached the least recently set values are evicted. A ttl of 0 disables the cache.
+    If per_account is True, keys are kept apart for each account whose client is active, for caches keyed by ids
+    rather than by make_key.
+    """
+    def __init__(self, ttl: float, maxsize: int = 10000, per_account: bool = False):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.per_account = per_account
+        self._lock = threading.Lock()
+        self._data: 'OrderedDict[Hashable, Tuple[Any, float]]' = OrderedDict()
+        self._accounts: Set[Optional[str]] = {None}
+
+    def _key(self, key: Hashable) -> Hashable:
+        return (account_id(), key) if self.per_account else key
+
+    def get(self, key: Hashable, default: Any = None, max_age: Optional[float] = None) -> Any:
+        """
+        Return the value for key if it was set less than max_age seconds ago. max_age defaults to the cache's ttl.
+        A larger max_age can be given to allow an expired value to be used, for example when Stripe cannot be reached.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._data.get(self._key(key))
+        if entry is None or time.monotonic() - entry[1] >= max_age:
+            return default
+        return entry[0]
+
+    def age(self, key: Hashable) -> Optional[float]:
+        """
+        Seconds since the value for key was set, or None if there is no value.
+        """
+        with self._lock:
+            entry = self._data.get(self._key(key))
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store value for key. Nothing is stored while the cache's ttl is 0 unless a ttl is given, for callers which
+        read the value back with their own max_age.
+        """
+        if not (self.ttl if ttl is None else ttl):
+            return
+        key = self._key(key)
+        with self._lock:
+            if self.per_account:
+                self._accounts.add(key[0])
+            self._data.pop(key, None)
+            self._data[key] = (value, time.monotonic())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(self._key(key), None)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Delete the value for key for every account, such as when a webhook reports a change without saying which
+        account's client made the request.
+        """
+        with self._lock:
+            if not self.per_account:
+                self._data.pop(key, None)
+                return
+            for account in self._accounts:
+                self._data.pop((account, key), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._accounts = {None}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+catalog = TTLCache(ttl=0)
+
+
+class NegativeCache(TTLCache):
+    """
+    Per customer, the arguments of calls which found nothing, such as listing the subscriptions of a customer who has
+    never subscribed. Entries are removed for a customer when something is created for them, so the cache can be used
+    with a long ttl. A ttl of 0 disables the cache. Entries are kept apart for each account.
+    """
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        super().__init__(ttl, maxsize, per_account=True)
+        self._update_lock = threading.Lock()
+
+    def contains(self, customer_id: str, key: Hashable) -> bool:
+        return key in self.get(customer_id, frozenset())
+
+    def add(self, customer_id: str, key: Hashable) -> None:
+        with self._update_lock:
+            self.set(customer_id, self.get(customer_id, frozenset()) | {key})
+
+
+no_subscriptions = NegativeCache(ttl=0)
+
+owners = TTLCache(ttl=0, per_account=True)
+
+
+def negative_memoize(cache: NegativeCache):
+    """
+    Decorator for a function taking a user and keyword arguments and returning a list, to remember which customers
+    had nothing for the given arguments and return an empty list for them without calling the function again.
+    """
+    def decorator(f: Callable):
+        @wraps(f)
+        def wrapper(user: Any, **kwargs):
+            customer_id = getattr(user, 'stripe_customer_id', None)
+            if not cache.ttl or not customer_id:
+                return f(user, **kwargs)
+            key = (f.__qualname__, _freeze(kwargs))
+            if cache.contains(customer_id, key):
+                return []
+            result = f(user, **kwargs)
+            if not result and not getattr(result, 'stale', False):
+                cache.add(customer_id, key)
+            return result
+        return wrapper
+    return decorator
+
+
+@webhooks.on('customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted',
+             'checkout.session.completed', 'customer.deleted')
+def _invalidate_negative_cache(event: Mapping[str, Any]) -> None:
+    obj = event['data']['object']
+    customer_id = obj['id'] if obj.get('object') == 'customer' else obj.get('customer')
+    if customer_id:
+        no_subscriptions.invalidate(customer_id)
+
+
+def ttl_memoize(cache: TTLCache):
+    """
+    Decorator to store results of a function in a TTLCache shared across requests, while its ttl is not 0.
+    Copies of the cached result are returned so callers can modify them. Stale results are not cached.
+    """
+    def decorator(f: Callable):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not cache.ttl:
+                return f(*args, **kwargs)
+            key = make_key(f, args, kwargs)
+            result = cache.get(key)
+            if result is None:
+                result = f(*args, **kwargs)
+                if getattr(result, 'stale', False):
+                    return result
+                cache.set(key, copy.deepcopy(result))
+                return result
+            return copy.deepcopy(result)
+        return wrapper
+    return decorator
+
+
+class RequestCache:
+    """
+    Results of the calls made while handling a single request.
+    Each result is stored as a Future as soon as the first call starts so concurrent calls with the same arguments,
+    from other threads or asyncio tasks, wait for the first one to finish instead of making the same Stripe request.
+    Failed calls are not cached. Once the request has ended, calls which were still queued, such as prefetches, are
+    no longer cached.
+    """
+    def __init__(self, prefetch_subscriptions: bool = True):
+        self.prefetch_subscriptions = prefetch_subscriptions
+        self._lock = threading.Lock()
+        self._futures: Dict[Hashable, Future] = {}
+        self._prefetched: Set[str] = set()
+        self._closed = False
+
+    def call(self, f: Callable, *args, **kwargs) -> Any:
+        key = make_key(f, args, kwargs)
+        with self._lock:
+            closed = self._closed
+            future = self._futures.get(key)
+            is_first_call = future is None
+            if is_first_call and not closed:
+                future = self._futures[key] = Future()
+        if closed:
+            return f(*args, **kwargs)
+        if is_first_call:
+            try:
+                future.set_result(f(*args, **kwargs))
+            except BaseException as e:
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+                raise
+        return copy.deepcopy(future.result())
+
+    def prefetch(self, user: Any) -> None:
+        """
+        Start fetching a user's active subscriptions in the background the first time the user is seen in this request,
+        as almost every function which takes a user needs them.
+        """
+        customer_id = getattr(user, 'stripe_customer_id', None)
+        if not self.prefetch_subscriptions or not customer_id:
+            return
+        with self._lock:
+            if customer_id in self._prefetched:
+                return
+            self._prefetched.add(customer_id)
+        from . import _submit
+        _submit(self._prefetch, user)
+
+    def _prefetch(self, user: Any) -> None:
+        from . import list_active_subscriptions
+        if not self._closed:
+            list_active_subscriptions(user)
+
+    def update(self, f: Callable, customer_id: str, update: Callable[[Dict[str, Any], tuple, Any], Any]) -> None:
+        """
+        Replace the memoized results of f for a customer with update(kwargs, args, result), so a change made by this
+        request can be applied to its cached results without fetching them again. Results which update cannot
+        change, shown by it returning None, or which are still being fetched are discarded.
+        """
+        with self._lock:
+            for key, future in list(self._futures.items()):
+                account, qualname, args, kwargs = key
+                if (account != account_id() or qualname != f.__qualname__ or not args
+                        or args[0] != ('user', customer_id)):
+                    continue
+                result = None
+                if future.done() and not future.exception():
+                    result = update(dict(kwargs), args, future.result())
+                if result is None:
+                    del self._futures[key]
+                else:
+                    self._futures[key] = Future()
+                    self._futures[key].set_result(result)
+
+    def forget(self, customer_id: str) -> None:
+        """
+        Discard the memoized results of every function for a customer, such as after the customer is deleted.
+        """
+        with self._lock:
+            for key in list(self._futures):
+                account, qualname, args, kwargs = key
+                if account == account_id() and args and args[0] == ('user', customer_id):
+                    del self._futures[key]
+            self._prefetched.discard(customer_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._futures.clear()
+            self._prefetched.clear()
+
+    def close(self) -> None:
+        """
+        Discard the cached results at the end of the request, and stop caching and prefetching.
+        """
+        with self._lock:
+            self._closed = True
+            self._futures.clear()
+            self._prefetched.clear()
+
+
+_request_cache: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_request_cache', default=None)
+
+
+def current_request_cache() -> Optional[RequestCache]:
+    return _request_cache.get()
+
+
+@contextmanager
+def request_cache(prefetch_subscriptions: bool = True) -> Iterator[RequestCache]:
+    """
+    Memoize calls to Stripe made inside this context, such as is_subscribed or list_payment_methods for the same user
+    and arguments. The cache is discarded when the context exits so it should wrap a single web request.
+    If prefetch_subscriptions is True, the user's active subscriptions are fetched as soon as the first function is
+    called for that user.
+    If a request cache is already active, it is reused.
+    """
+    cache = _request_cache.get()
+    if cache:
+        yield cache
+        return
+    cache = RequestCache(prefetch_subscriptions=prefetch_subscriptions)
+    token = _request_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _request_cache.reset(token)
+        cache.close()
+
+
+def request_memoize(f: Callable):
+    """
+    Decorator to memoize a function for the duration of the active request_cache context.
+    Outside of a request_cache context, the function is called as normal.
+    Generator functions are memoized as a list of the values they yield.
+    """
+    if inspect.isgeneratorfunction(f):
+        @wraps(f)
+        def generator_wrapper(*args, **kwargs):
+            cache = _request_cache.get()
+            if not cache:
+                yield from f(*args, **kwargs)
+                return
+            if args:
+                cache.prefetch(args[0])
+            yield from cache.call(_list_generator(f), *args, **kwargs)
+        return generator_wrapper
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        cache = _request_cache.get()
+        if not cache:
+            return f(*args, **kwargs)
+        if args:
+            cache.prefetch(args[0])
+        return cache.call(f, *args, **kwargs)
+    return wrapper
+
+
+def _list_generator(f: Callable) -> Callable:
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return list(f(*args, **kwargs))
+    return wrapper
+
+
+def clears_request_cache(f: Callable):
+    """
+    Decorator for functions which change data in Stripe. Results memoized in the active request_cache context are
+    discarded after the function is called so later reads in the same request see the change.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        finally:
+            cache = _request_cache.get()
+            if cache:
+                cache.clear()
+    return wrapper
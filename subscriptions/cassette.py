@@ -0,0 +1,141 @@
+import gzip
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlparse
+from stripe.http_client import HTTPClient
+from .exceptions import StripeCassetteMiss
+from .http import WrappedHTTPClient, base_client, default_client, install, uninstall, set_base_client
+
+from typing import Any, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+def _normalise(method: str, url: str, post_data: Optional[str], ignore_params: Sequence[str] = ()) -> str:
+    """
+    Key used to match a request with a recorded one: the method, path and sorted parameters from the query string
+    and body, leaving out ignore_params.
+    """
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    if post_data:
+        params += parse_qsl(post_data if isinstance(post_data, str) else post_data.decode(), keep_blank_values=True)
+    params = sorted((k, v) for k, v in params if k not in ignore_params)
+    return f"{method.upper()} {parsed.path}?{'&'.join(f'{k}={v}' for k, v in params)}"
+
+
+class Cassette:
+    """
+    Stripe requests and their responses and latencies, saved to a JSON file which is gzipped if the path ends with .gz.
+    """
+    def __init__(self, path: str, ignore_params: Sequence[str] = ()):
+        self.path = path
+        self.ignore_params = tuple(ignore_params)
+        self.interactions: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _open(self, mode: str):
+        return gzip.open(self.path, mode + 't') if self.path.endswith('.gz') else open(self.path, mode)
+
+    def load(self) -> 'Cassette':
+        with self._open('r') as f:
+            self.interactions = json.load(f)['interactions']
+        return self
+
+    def save(self) -> None:
+        with self._lock, self._open('w') as f:
+            json.dump({'version': 1, 'interactions': self.interactions}, f, separators=(',', ':'))
+
+    def record(self, method: str, url: str, post_data: Optional[str], status: int, content: Any,
+               headers: Any, latency: float) -> None:
+        if isinstance(content, bytes):
+            content = content.decode()
+        with self._lock:
+            self.interactions.append({'request': _normalise(method, url, post_data, self.ignore_params),
+                                      'status': status, 'body': content, 'latency': round(latency, 6),
+                                      'headers': {k: v for k, v in dict(headers).items()
+                                                  if k.lower() in ('request-id', 'stripe-should-retry')}})
+
+
+class RecordingHTTPClient(WrappedHTTPClient):
+    """
+    HTTP client which adds each request to Stripe and its response and latency to a cassette.
+    """
+    def __init__(self, client: Optional[HTTPClient] = None, cassette: Optional[Cassette] = None):
+        super().__init__(client)
+        self.cassette = cassette
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        start = time.perf_counter()
+        content, status, response_headers = self.client.request_with_retries(method, url, headers, post_data)
+        self.cassette.record(method, url, post_data, status, content, response_headers, time.perf_counter() - start)
+        return content, status, response_headers
+
+
+class ReplayHTTPClient(HTTPClient):
+    """
+    HTTP client which answers requests from a cassette without a network connection.
+    Recorded responses for the same request are returned in the order they were recorded and the last one is repeated
+    once they run out. Each response is delayed by its recorded latency multiplied by latency_scale, so 0 replays as
+    fast as possible. StripeCassetteMiss is raised for a request which was not recorded.
+    """
+    name = 'replay'
+
+    def __init__(self, cassette: Cassette, latency_scale: float = 1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._responses: Dict[str, Deque[Dict[str, Any]]] = {}
+        for interaction in cassette.interactions:
+            self._responses.setdefault(interaction['request'], deque()).append(interaction)
+
+    def _next(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise StripeCassetteMiss(f'No recorded response for {key}')
+            return responses.popleft() if len(responses) > 1 else responses[0]
+
+    def request_with_retries(self, method, url, headers, post_data=None) -> Tuple[str, int, Dict[str, str]]:
+        interaction = self._next(_normalise(method, url, post_data, self.cassette.ignore_params))
+        if self.latency_scale:
+            time.sleep(interaction['latency'] * self.latency_scale)
+        return interaction['body'], interaction['status'], interaction['headers']
+
+    def request(self, method, url, headers, post_data=None):
+        return self.request_with_retries(method, url, headers, post_data)
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def recording(path: str, ignore_params: Sequence[str] = ()) -> Iterator[Cassette]:
+    """
+    Record all requests made to Stripe inside this context and save them to a cassette file at path.
+    """
+    cassette = Cassette(path, ignore_params)
+    client = install(RecordingHTTPClient, cassette=cassette)
+    try:
+        yield cassette
+    finally:
+        uninstall(client)
+        cassette.save()
+
+
+@contextmanager
+def replaying(path: str, latency_scale: float = 1.0, ignore_params: Sequence[str] = ()) -> Iterator[Cassette]:
+    """
+    Answer all requests made to Stripe inside this context from the cassette file at path, e.g. to run benchmarks in
+    CI without network access. Other wrapping clients such as the circuit breaker and profiler still see each request.
+    ignore_params should be the same as when recording.
+    """
+    cassette = Cassette(path, ignore_params).load()
+    previous = base_client() or default_client()
+    set_base_client(ReplayHTTPClient(cassette, latency_scale))
+    try:
+        yield cassette
+    finally:
+        set_base_client(previous)
@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import Future
+from .cache import TTLCache
+from .stats import stats
+from . import deadline, webhooks
+
+from typing import Any, Callable, Dict, Hashable, Mapping, Optional
+
+
+class CheckoutSessionIndex(TTLCache):
+    """
+    Open checkout sessions by customer, mode, line items and other arguments such as the success and cancel urls,
+    so a user who clicks twice or reloads the page is sent to the session already created for them.
+    A session is only reused while it is open and more than min_remaining seconds from expiring.
+    Sessions are removed when a checkout.session.completed or checkout.session.expired event is passed to
+    subscriptions.webhooks.handle_event. A ttl of 0 disables reuse.
+    """
+    def __init__(self, ttl: float = 0, maxsize: int = 10000, min_remaining: float = 300):
+        super().__init__(ttl, maxsize)
+        self.min_remaining = min_remaining
+        self._creating: Dict[Hashable, Future] = {}
+        self._creating_lock = threading.Lock()
+
+    def find(self, key: Hashable) -> Optional[Mapping[str, Any]]:
+        session = self.get(key)
+        if session is None:
+            return None
+        if session.get('status', 'open') != 'open' or session['expires_at'] - time.time() < self.min_remaining:
+            self.evict(session['id'])
+            return None
+        stats.incr('checkout.reused')
+        return session
+
+    def add(self, key: Hashable, session: Mapping[str, Any]) -> None:
+        stats.incr('checkout.created')
+        self.set(key, session)
+        self.set(('session', session['id']), key)
+
+    def find_or_create(self, key: Hashable, create: Callable[[], Mapping[str, Any]]) -> Mapping[str, Any]:
+        """
+        Return the open session for key, or create one with create and add it. Calls for the same key made while a
+        session is being created wait for that session instead of creating another.
+        """
+        with self._creating_lock:
+            future = self._creating.get(key)
+            owner = future is None
+            if owner:
+                session = self.find(key)
+                if session is not None:
+                    return session
+                future = self._creating[key] = Future()
+                future.set_running_or_notify_cancel()
+        if not owner:
+            stats.incr('checkout.waited')
+            return deadline.wait(future, 'create_checkout')
+        try:
+            session = create()
+            self.add(key, session)
+            future.set_result(session)
+            return session
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._creating_lock:
+                del self._creating[key]
+
+    def evict(self, session_id: str) -> None:
+        key = self.get(('session', session_id))
+        self.delete(('session', session_id))
+        if key is not None:
+            session = self.get(key)
+            if session is not None and session['id'] == session_id:
+                self.delete(key)
+
+
+checkout_sessions = CheckoutSessionIndex()
+
+
+@webhooks.on('checkout.session.completed', 'checkout.session.expired')
+def _evict_checkout_session(event: Mapping[str, Any]) -> None:
+    checkout_sessions.evict(event['data']['object']['id'])
@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+
+class Checkpoint:
+    """
+    A small JSON file used to record progress of long running jobs so they can be restarted where they left off.
+    If path is None, progress is only kept in memory for the lifetime of the object.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._data = json.load(f)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Record a value and write the checkpoint file. The file is replaced atomically so a crash mid-write leaves the previous checkpoint intact.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._save()
+
+    def clear(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._data, f)
+        os.replace(tmp_path, self.path)
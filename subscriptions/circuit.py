@@ -0,0 +1,250 @@
+import contextvars
+import copy
+import inspect
+import threading
+import time
+import stripe
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from .cache import TTLCache, make_key, _list_generator
+from .client import account_id
+from .exceptions import StripeCircuitOpen
+from .http import WrappedHTTPClient, install, uninstall
+from .stats import stats
+
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Stops requests being sent to Stripe while it is failing or too slow.
+    Requests which fail with a connection error, a 5xx or 429 response, or take longer than latency_threshold seconds,
+    count as failures. If at least min_requests were made in the last window seconds and failure_ratio of them
+    failed, the circuit opens and requests raise StripeCircuitOpen immediately for open_for seconds.
+    After that, half_open_requests trial requests are let through; once all of them succeed the circuit closes again
+    and if any fails it opens again. Only the results of trial requests count while half open, so requests which were
+    sent before the circuit opened do not close it.
+    The state and transitions are recorded in stats under stats_prefix.
+    """
+    def __init__(self, failure_ratio: float = 0.5, min_requests: int = 10, window: float = 30,
+                 latency_threshold: float = 5, open_for: float = 30, half_open_requests: int = 1,
+                 stats_prefix: str = 'circuit'):
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.window = window
+        self.latency_threshold = latency_threshold
+        self.open_for = open_for
+        self.half_open_requests = half_open_requests
+        self.stats_prefix = stats_prefix
+        self._lock = threading.Lock()
+        self._results: Deque[Tuple[float, bool]] = deque()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self._generation = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_for:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str) -> None:
+        self._state = state
+        self._trials = 0
+        self._trial_successes = 0
+        self._generation += 1
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._results.clear()
+        stats.incr(f'{self.stats_prefix}.transitions.{state}')
+        stats.gauge(f'{self.stats_prefix}.state', _state_values[state])
+
+    def before_request(self) -> Optional[int]:
+        """
+        Raise StripeCircuitOpen if a request should not be sent now.
+        Returns a trial token if the request is let through as a trial while half open, to pass to record.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return None
+            if state == HALF_OPEN and self._trials < self.half_open_requests:
+                self._trials += 1
+                return self._generation
+        stats.incr(f'{self.stats_prefix}.rejected')
+        raise StripeCircuitOpen(f"Requests to Stripe are suspended for up to {self.open_for} seconds after "
+                                f"too many errors or slow responses.")
+
+    def record(self, success: bool, latency: float, trial: Optional[int] = None) -> None:
+        """
+        Record the result of a request. trial is the token before_request returned for it.
+        """
+        failed = not success or latency > self.latency_threshold
+        if failed:
+            stats.incr(f'{self.stats_prefix}.failures')
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                if trial is None or trial != self._generation:
+                    return
+                if failed:
+                    self._transition(OPEN)
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_requests:
+                        self._transition(CLOSED)
+                return
+            if state == OPEN:
+                return
+            now = time.monotonic()
+            self._results.append((now, failed))
+            while self._results[0][0] < now - self.window:
+                self._results.popleft()
+            failures = sum(1 for _, f in self._results if f)
+            if len(self._results) >= self.min_requests and failures >= self.failure_ratio * len(self._results):
+                self._transition(OPEN)
+
+
+class CircuitBreakerHTTPClient(WrappedHTTPClient):
+    """
+    HTTP client which sends requests through a CircuitBreaker.
+    Requests made while an AccountClient is active go through a breaker of that account's own, created with
+    breaker_kwargs, so an account which is failing or rate limited does not suspend requests for the others.
+    """
+    def __init__(self, client=None, breaker: Optional[CircuitBreaker] = None, **breaker_kwargs):
+        super().__init__(client)
+        self.breaker = breaker or CircuitBreaker(**breaker_kwargs)
+        self.breaker_kwargs = breaker_kwargs
+        self._account_breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker_for(self, account: Optional[str]) -> CircuitBreaker:
+        """
+        The breaker for requests made for the account with the given id, or for requests made without an account.
+        """
+        if account is None:
+            return self.breaker
+        with self._lock:
+            breaker = self._account_breakers.get(account)
+            if breaker is None:
+                breaker = self._account_breakers[account] = CircuitBreaker(
+                    stats_prefix=f'circuit.accounts.{account}', **self.breaker_kwargs)
+            return breaker
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        breaker = self.breaker_for(account_id())
+        trial = breaker.before_request()
+        start = time.monotonic()
+        try:
+            response = self.client.request_with_retries(method, url, headers, post_data)
+        except stripe.error.APIConnectionError:
+            breaker.record(False, time.monotonic() - start, trial)
+            raise
+        status_code = response[1]
+        breaker.record(status_code < 500 and status_code != 429, time.monotonic() - start, trial)
+        return response
+
+
+_client: Optional[CircuitBreakerHTTPClient] = None
+
+last_known_good = TTLCache(ttl=86400)
+
+
+def install_circuit_breaker(**kwargs) -> CircuitBreaker:
+    """
+    Send all Stripe requests through a circuit breaker, with one for each account used through an AccountClient.
+    kwargs are passed to CircuitBreaker.
+    While it is open, functions which read data return the last result they successfully fetched, marked as stale.
+    Functions which write data raise StripeCircuitOpen.
+    """
+    global _client
+    if _client:
+        uninstall(_client)
+    _client = install(CircuitBreakerHTTPClient, **kwargs)
+    return _client.breaker
+
+
+def uninstall_circuit_breaker() -> None:
+    global _client
+    if _client:
+        uninstall(_client)
+        _client = None
+    last_known_good.clear()
+
+
+class StaleList(list):
+    """
+    A list result served from the last known good cache while the circuit breaker is open.
+    """
+    stale = True
+
+
+_stale_reads: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_stale_reads', default=None)
+
+
+@contextmanager
+def track_stale() -> Iterator[List[str]]:
+    """
+    Collect the names of functions which returned stale data inside this context, including in executor threads.
+    Useful when a result such as is_subscribed cannot be marked as stale itself.
+    """
+    stale: List[str] = []
+    token = _stale_reads.set(stale)
+    try:
+        yield stale
+    finally:
+        _stale_reads.reset(token)
+
+
+def _call_with_fallback(f: Callable, *args, **kwargs) -> list:
+    key = make_key(f, args, kwargs)
+    try:
+        result = f(*args, **kwargs)
+    except StripeCircuitOpen:
+        cached = last_known_good.get(key)
+        if cached is None:
+            raise
+        stats.incr('circuit.stale_reads')
+        stale = _stale_reads.get()
+        if stale is not None:
+            stale.append(f.__qualname__)
+        return StaleList(copy.deepcopy(cached))
+    last_known_good.set(key, copy.deepcopy(result))
+    return result
+
+
+def fallback_to_last_known_good(f: Callable):
+    """
+    Decorator for functions which read a list from Stripe. When a circuit breaker is installed, the last successful
+    result for the same arguments is stored and returned as a StaleList while the circuit is open.
+    Generator functions are stored as a list of the values they yield.
+    """
+    if inspect.isgeneratorfunction(f):
+        @wraps(f)
+        def generator_wrapper(*args, **kwargs):
+            if not _client:
+                yield from f(*args, **kwargs)
+                return
+            yield from _call_with_fallback(_list_generator(f), *args, **kwargs)
+        return generator_wrapper
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not _client:
+            return f(*args, **kwargs)
+        return _call_with_fallback(f, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,150 @@
+import contextvars
+import hashlib
+import inspect
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from stripe.http_client import HTTPClient
+from .http import WrappedHTTPClient, base_client, default_client, set_base_client
+from .ratelimit import RateLimiter
+from .scheduler import iterate_in_context
+from .stats import stats
+
+from typing import Any, Callable, Dict, Iterator, Optional
+
+try:
+    from .http import PooledRequestsClient
+except ImportError:
+    PooledRequestsClient = None
+
+
+_account: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_account', default=None)
+
+
+def current_account() -> Optional['AccountClient']:
+    return _account.get()
+
+
+def account_id() -> Optional[str]:
+    """
+    Identifier of the account whose client is active, used to keep cached results for each account apart.
+    """
+    account = _account.get()
+    return None if account is None else account.id
+
+
+def request_params() -> Dict[str, str]:
+    """
+    The api_key and stripe_account of the active account to pass to calls to the Stripe library, so requests for the
+    account are built with its own key instead of stripe.api_key. Empty if no account is active.
+    """
+    account = _account.get()
+    if account is None:
+        return {}
+    params = {}
+    if account.api_key:
+        params['api_key'] = account.api_key
+    if account.stripe_account:
+        params['stripe_account'] = account.stripe_account
+    return params
+
+
+class AccountHTTPClient(WrappedHTTPClient):
+    """
+    Sends requests made while an AccountClient is active with that account's API key and Stripe-Account header,
+    through its own connection pool and within its own rate limit. Other requests go to the wrapped client.
+    """
+    def request_with_retries(self, method, url, headers, post_data=None):
+        account = _account.get()
+        if account is None:
+            return self.client.request_with_retries(method, url, headers, post_data)
+        headers = dict(headers)
+        if account.api_key:
+            headers['Authorization'] = f'Bearer {account.api_key}'
+        if account.stripe_account:
+            headers['Stripe-Account'] = account.stripe_account
+        waited = account.limiter.acquire()
+        if waited:
+            stats.timing('account.rate_limit_wait', waited)
+        return (account.http_client or self.client).request_with_retries(method, url, headers, post_data)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _install() -> None:
+    """
+    Put AccountHTTPClient directly around the client which sends requests, so other wrappers such as the circuit
+    breaker still see requests for every account and later calls to set_base_client replace the client it wraps.
+    """
+    global _installed
+    with _install_lock:
+        if not _installed:
+            set_base_client(AccountHTTPClient(base_client() or default_client()))
+            _installed = True
+
+
+class AccountClient:
+    """
+    The library's functions scoped to one Stripe account, so several accounts can be served at the same time from one
+    process without changing stripe.api_key.
+    Give api_key to use another account's secret key, or stripe_account to act on a connected account with the
+    platform's key, in which case stripe.api_key must be set to the platform's key.
+    Each client has its own pool of max_connections connections, rate limit of rate requests per second and circuit
+    breaker if one is installed. Cached results, such as those in the request cache, catalog cache, last known good
+    cache, entitlements cache, negative cache and ownership cache, are kept separately for each account.
+    Functions of the subscriptions module are available as methods, e.g. client.is_subscribed(user, product_id).
+    """
+    def __init__(self, api_key: Optional[str] = None, stripe_account: Optional[str] = None,
+                 max_connections: int = 10, rate: float = 25, timeout: float = 80,
+                 http_client: Optional[HTTPClient] = None):
+        if not api_key and not stripe_account:
+            raise ValueError('An api_key or stripe_account is required')
+        self.api_key = api_key
+        self.stripe_account = stripe_account
+        self.id = stripe_account or 'key_' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        self.limiter = RateLimiter(rate)
+        if http_client is None and PooledRequestsClient:
+            http_client = PooledRequestsClient(maxsize=max_connections, timeout=timeout)
+        self.http_client = http_client
+        _install()
+
+    def __repr__(self) -> str:
+        return f'AccountClient({self.id})'
+
+    @contextmanager
+    def activate(self) -> Iterator['AccountClient']:
+        """
+        Make all calls to Stripe inside this context, including in executor threads, for this account.
+        """
+        token = _account.set(self)
+        try:
+            yield self
+        finally:
+            _account.reset(token)
+
+    def __getattr__(self, name: str) -> Callable:
+        import subscriptions
+        f = getattr(subscriptions, name, None)
+        if name.startswith('_') or not inspect.isfunction(f) or f.__module__ != subscriptions.__name__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        if inspect.isgeneratorfunction(f):
+            @wraps(f)
+            def generator_wrapper(*args, **kwargs) -> Iterator[Any]:
+                def run() -> Iterator[Any]:
+                    with self.activate():
+                        yield from f(*args, **kwargs)
+                return (yield from iterate_in_context(contextvars.copy_context(), run()))
+            return generator_wrapper
+
+        @wraps(f)
+        def wrapper(*args, **kwargs) -> Any:
+            with self.activate():
+                return f(*args, **kwargs)
+        return wrapper
+
+    def close(self) -> None:
+        if self.http_client:
+            self.http_client.close()
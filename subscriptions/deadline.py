@@ -0,0 +1,186 @@
+import contextvars
+import inspect
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+import stripe
+from stripe.http_client import RequestsClient
+from .exceptions import StripeDeadlineExceeded
+from .http import WrappedHTTPClient, base_client, install, set_base_client
+from .scheduler import iterate_in_context
+from .stats import stats
+
+from typing import Any, Callable, Iterator, List, Optional
+
+
+class Deadline:
+    """
+    The time by which a call must finish and the futures submitted while it runs, so the ones still pending can be
+    cancelled when it passes.
+    """
+    def __init__(self, budget: float, expires: Optional[float] = None):
+        self.budget = budget
+        self.expires = expires if expires is not None else time.monotonic() + budget
+        self.futures: List[Future] = []
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def track(self, future: Future) -> None:
+        with self._lock:
+            self.futures = [f for f in self.futures if not f.done()] + [future]
+
+    def cancel_pending(self) -> int:
+        """
+        Cancel the futures which have not started yet and return how many were cancelled.
+        Requests which have already started stop at the deadline as it is also their HTTP timeout.
+        """
+        with self._lock:
+            futures, self.futures = self.futures, []
+        return sum(1 for f in futures if f.cancel())
+
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_deadline', default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the current deadline, or None if there is no deadline.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+class DeadlineHTTPClient(WrappedHTTPClient):
+    """
+    Refuses to send requests to Stripe once the current deadline has passed and reports requests which timed out
+    because of the deadline as StripeDeadlineExceeded.
+    """
+    def request_with_retries(self, method, url, headers, post_data=None):
+        deadline = _deadline.get()
+        if deadline is None:
+            return self.client.request_with_retries(method, url, headers, post_data)
+        call = f'{method.upper()} {urlparse(url).path}'
+        if deadline.remaining() <= 0:
+            stats.incr('deadline.exceeded')
+            raise StripeDeadlineExceeded(call, deadline.budget)
+        try:
+            return self.client.request_with_retries(method, url, headers, post_data)
+        except stripe.error.APIConnectionError as e:
+            if deadline.remaining() <= 0:
+                stats.incr('deadline.exceeded')
+                raise StripeDeadlineExceeded(call, deadline.budget) from e
+            raise
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _install() -> None:
+    """
+    Wrap the HTTP client with DeadlineHTTPClient and, if Stripe's default requests client is used, replace it with one
+    which cuts the timeout of each request to the time left before the deadline.
+    Only an instance of RequestsClient itself is replaced, as replacing an instance of a subclass would lose what the
+    subclass changes. Other clients keep their own timeout, so a request they have already sent when the deadline
+    passes runs until that timeout. Subclass DeadlineRequestsClient instead of RequestsClient, or use
+    request_timeout, for their requests to stop at the deadline too.
+    """
+    global _installed
+    with _install_lock:
+        if not _installed:
+            install(DeadlineHTTPClient)
+            client = base_client()
+            if type(client) is RequestsClient:
+                from .http import DeadlineRequestsClient
+                set_base_client(DeadlineRequestsClient(timeout=client._timeout, session=client._session,
+                                                       verify_ssl_certs=client._verify_ssl_certs, proxy=stripe.proxy))
+            _installed = True
+
+
+@contextmanager
+def within(seconds: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """
+    Calls to Stripe made inside this context, including in executor threads, must finish within seconds.
+    A deadline inside another one never extends it. With seconds None, the current deadline is kept.
+    """
+    outer = _deadline.get()
+    if seconds is None:
+        yield outer
+        return
+    _install()
+    expires = time.monotonic() + seconds
+    if outer is not None and outer.expires <= expires:
+        inner = Deadline(outer.budget, outer.expires)
+    else:
+        inner = Deadline(seconds, expires)
+    token = _deadline.set(inner)
+    try:
+        yield inner
+    except StripeDeadlineExceeded:
+        inner.cancel_pending()
+        raise
+    finally:
+        _deadline.reset(token)
+
+
+def track(future: Future) -> None:
+    """
+    Remember a future submitted to the scheduler so it is cancelled if the current deadline passes.
+    """
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.track(future)
+
+
+def wait(future: Future, call: str) -> Any:
+    """
+    Wait for the result of a future until the current deadline. If the deadline passes first, the futures still pending
+    are cancelled and StripeDeadlineExceeded is raised with call as the sub-call which used up the budget.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(deadline.remaining(), 0))
+    except TimeoutError:
+        if future.done():
+            raise
+        deadline.cancel_pending()
+        stats.incr('deadline.exceeded')
+        raise StripeDeadlineExceeded(call, deadline.budget) from None
+
+
+def accepts_deadline(f: Callable):
+    """
+    Decorator adding a deadline keyword argument: the number of seconds the function and all the Stripe requests it
+    makes have to finish, as with within.
+    For generator functions the deadline covers every step but is only set while a step runs, not in the caller
+    between steps.
+    """
+    if inspect.isgeneratorfunction(f):
+        @wraps(f)
+        def generator_wrapper(*args, deadline: Optional[float] = None, **kwargs):
+            if deadline is None:
+                return (yield from f(*args, **kwargs))
+
+            def run():
+                with within(deadline):
+                    yield from f(*args, **kwargs)
+            return (yield from iterate_in_context(contextvars.copy_context(), run()))
+        return generator_wrapper
+
+    @wraps(f)
+    def wrapper(*args, deadline: Optional[float] = None, **kwargs):
+        with within(deadline):
+            return f(*args, **kwargs)
+    return wrapper
+
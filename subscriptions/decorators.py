@@ -1,6 +1,7 @@
 from functools import wraps
-from .exceptions import StripeCustomerIdRequired
-from typing import Callable
+from .entitlements import is_subscribed_cached
+from .exceptions import StripeCustomerIdRequired, StripeSubscriptionRequired
+from typing import Callable, Optional
 from .types import UserProtocol
 
 
@@ -18,3 +19,22 @@ def customer_id_required(f: Callable):
             "It is required to first create this customer in stripe using the create_customer method, and save changes to the stripe_customer_id field")
     return wrapper
 
+
+def subscription_required(product_id: Optional[str] = None, price_id: Optional[str] = None,
+                          ttl: Optional[float] = None, negative_ttl: float = 30, grace_period: float = 3600):
+    """
+    Decorator for views which require the user to be subscribed to the given product or price.
+    If not, StripeSubscriptionRequired is raised.
+    The user's subscriptions are checked against the local entitlements cache first so Stripe is only called on a
+    cache miss. See entitlements.is_subscribed_cached for the meaning of ttl, negative_ttl and grace_period.
+    """
+    def decorator(f: Callable):
+        @wraps(f)
+        def wrapper(user: UserProtocol, *args, **kwargs):
+            if is_subscribed_cached(user, product_id=product_id, price_id=price_id, ttl=ttl,
+                                    negative_ttl=negative_ttl, grace_period=grace_period):
+                return f(user, *args, **kwargs)
+            raise StripeSubscriptionRequired(
+                f"A subscription to {product_id or price_id} is required")
+        return wrapper
+    return decorator
@@ -0,0 +1,63 @@
+import stripe
+import time
+from .cache import TTLCache
+from .types import UserProtocol, ProductSubscription
+
+from typing import List, Optional
+
+
+entitlements = TTLCache(ttl=0, per_account=True)
+
+
+def _find_subscription(subscribed_to: List[ProductSubscription], product_id: Optional[str] = None,
+                       price_id: Optional[str] = None) -> Optional[ProductSubscription]:
+    for sub in subscribed_to:
+        if sub['product_id'] == product_id or sub['price_id'] == price_id:
+            return sub
+    return None
+
+
+def _is_current(sub: ProductSubscription, grace_period: float = 0) -> bool:
+    """
+    Whether a cached subscription is still known to be valid without asking Stripe.
+    After cancel_at or current_period_end the subscription may have ended or been renewed so it must be checked again.
+    grace_period allows a subscription to be used for longer after current_period_end when Stripe cannot be reached.
+    """
+    now = time.time()
+    return ((sub['cancel_at'] is None or sub['cancel_at'] > now) and
+            (sub['current_period_end'] is None or sub['current_period_end'] + grace_period > now))
+
+
+def is_subscribed_cached(user: Optional[UserProtocol], product_id: Optional[str] = None,
+                         price_id: Optional[str] = None, ttl: Optional[float] = None,
+                         negative_ttl: float = 30, grace_period: float = 3600) -> bool:
+    """
+    Same as is_subscribed but using the user's subscriptions from the local entitlements cache if possible.
+    A cached subscription is used for up to ttl seconds (defaults to the entitlements cache ttl) unless its
+    cancel_at or current_period_end has passed.
+    A cached result showing the user is not subscribed is used for up to negative_ttl seconds.
+    Otherwise the subscriptions are fetched from Stripe and cached. If Stripe cannot be reached, cached subscriptions
+    up to grace_period seconds old are used instead.
+    Nothing is cached while the entitlements cache ttl is 0, the default, unless ttl is given.
+    """
+    if not user or not user.stripe_customer_id:
+        return False
+    from . import list_products_prices_subscribed_to
+    key = user.stripe_customer_id
+    subscribed_to = entitlements.get(key, max_age=ttl)
+    if subscribed_to is not None:
+        sub = _find_subscription(subscribed_to, product_id, price_id)
+        if sub and _is_current(sub):
+            return True
+        if not sub and entitlements.get(key, max_age=negative_ttl) is not None:
+            return False
+    try:
+        subscribed_to = list_products_prices_subscribed_to(user)
+    except (stripe.error.APIConnectionError, stripe.error.APIError):
+        subscribed_to = entitlements.get(key, max_age=grace_period)
+        if subscribed_to is None:
+            raise
+        sub = _find_subscription(subscribed_to, product_id, price_id)
+        return bool(sub) and _is_current(sub, grace_period)
+    entitlements.set(key, subscribed_to, ttl=ttl)
+    return bool(_find_subscription(subscribed_to, product_id, price_id))
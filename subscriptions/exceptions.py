@@ -1,4 +1,9 @@
-class BaseStripeSubscriptionsError(BaseException):
+import stripe
+
+from typing import Optional
+
+
+class BaseStripeSubscriptionsError(Exception):
     pass
 
 
@@ -10,5 +15,42 @@ class StripeWrongCustomer(BaseStripeSubscriptionsError):
     pass
 
 
+class StripeSubscriptionRequired(BaseStripeSubscriptionsError):
+    pass
+
+
+class StripeCassetteMiss(BaseStripeSubscriptionsError):
+    pass
+
+
 class DefaultPaymentMethodRequired(BaseStripeSubscriptionsError):
     message = "set_as_default_payment_type is True but default_payment_method was not provided."
+
+
+class StripeCircuitOpen(BaseStripeSubscriptionsError, stripe.error.APIConnectionError):
+    """
+    Raised instead of sending a request to Stripe while the circuit breaker is open.
+    It is a subclass of stripe.error.APIConnectionError so it is handled in the same way as Stripe being unreachable,
+    including by except Exception.
+    """
+    pass
+
+
+class StripeDeadlineExceeded(BaseStripeSubscriptionsError):
+    """
+    Raised when the deadline for a call passes before it finishes.
+    call is the Stripe request or function which was being waited for and budget is the number of seconds the deadline
+    allowed.
+    """
+    def __init__(self, call: str, budget: Optional[float] = None):
+        super().__init__(f'Deadline of {budget}s exceeded waiting for {call}' if budget else
+                         f'Deadline exceeded waiting for {call}')
+        self.call = call
+        self.budget = budget
+
+
+class StripeUsageBackpressure(BaseStripeSubscriptionsError):
+    """
+    Raised when usage is recorded while too many usage totals are already waiting to be sent to Stripe.
+    """
+    pass
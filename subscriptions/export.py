@@ -0,0 +1,268 @@
+import numpy as np
+from . import _subscription_info
+from .store import SubscriptionStore
+from .sync import sources
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+CATEGORY = 'category'
+DATETIME = 'datetime64[s]'
+
+
+def _id(value: Any) -> Optional[str]:
+    """
+    The id of an object which may or may not have been expanded.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return value['id']
+
+
+def _item_price(item: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    The price of a subscription item, either as returned by Stripe or as kept by the store.
+    """
+    price = item['price']
+    if isinstance(price, Mapping):
+        recurring = price.get('recurring') or {}
+        return {'price_id': price['id'],
+                'product_id': _id(price.get('product')),
+                'currency': price.get('currency'),
+                'interval': recurring.get('interval'),
+                'interval_count': recurring.get('interval_count'),
+                'amount': price.get('unit_amount')}
+    return {'price_id': price,
+            'product_id': item.get('product'),
+            'currency': item.get('currency'),
+            'interval': item.get('interval'),
+            'interval_count': item.get('interval_count'),
+            'amount': item.get('amount')}
+
+
+def _subscription_rows(sub: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    """
+    One row for each item of a subscription. Subscriptions to a single price use the subscription's plan.
+    """
+    items = sub.get('items') or []
+    if isinstance(items, Mapping):
+        items = items.get('data', [])
+    subscription = {'sub_id': sub['id'],
+                    'customer_id': _id(sub.get('customer')),
+                    'status': sub.get('status'),
+                    'created': sub.get('created'),
+                    'cancel_at': sub.get('cancel_at'),
+                    'canceled_at': sub.get('canceled_at'),
+                    'current_period_end': sub.get('current_period_end')}
+    if len(items) <= 1:
+        info = _subscription_info(sub)
+        plan = sub.get('plan') or {}
+        return [{**subscription,
+                 'item_id': items[0]['id'] if items else None,
+                 'price_id': info['price_id'],
+                 'product_id': info['product_id'],
+                 'currency': plan.get('currency'),
+                 'interval': plan.get('interval'),
+                 'interval_count': plan.get('interval_count'),
+                 'quantity': sub.get('quantity'),
+                 'amount': plan.get('amount')}]
+    return [{**subscription, **_item_price(item), 'item_id': item['id'], 'quantity': item.get('quantity')}
+            for item in items]
+
+
+def _price_rows(price: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    recurring = price.get('recurring') or {}
+    return [{'price_id': price['id'],
+            'product_id': _id(price.get('product')),
+            'active': price.get('active', True),
+            'currency': price.get('currency'),
+            'interval': recurring.get('interval'),
+            'interval_count': recurring.get('interval_count'),
+            'amount': price.get('unit_amount')}]
+
+
+def _product_rows(product: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    return [{'product_id': product['id'],
+             'name': product.get('name'),
+             'active': product.get('active', True)}]
+
+
+schemas: Dict[str, Dict[str, str]] = {
+    'subscription': {'sub_id': CATEGORY, 'item_id': CATEGORY, 'customer_id': CATEGORY, 'status': CATEGORY, 'price_id': CATEGORY,
+                     'product_id': CATEGORY, 'currency': CATEGORY, 'interval': CATEGORY, 'interval_count': 'int32',
+                     'quantity': 'int64', 'amount': 'int64', 'created': DATETIME, 'cancel_at': DATETIME,
+                     'canceled_at': DATETIME, 'current_period_end': DATETIME},
+    'price': {'price_id': CATEGORY, 'product_id': CATEGORY, 'active': 'bool', 'currency': CATEGORY,
+              'interval': CATEGORY, 'interval_count': 'int32', 'amount': 'int64'},
+    'product': {'product_id': CATEGORY, 'name': CATEGORY, 'active': 'bool'},
+}
+
+rows: Dict[str, Callable[[Mapping[str, Any]], List[Dict[str, Any]]]] = {
+    'subscription': _subscription_rows,
+    'price': _price_rows,
+    'product': _product_rows,
+}
+
+
+class Categories:
+    """
+    Shared mapping of strings to int32 codes for a categorical column.
+    Codes are only ever appended so the same code means the same string in every chunk of an export.
+    Code -1 means the value was missing.
+    """
+    def __init__(self):
+        self.values: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def encode(self, values: Sequence[Optional[str]]) -> np.ndarray:
+        codes = self._codes
+        out = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is None:
+                out[i] = -1
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(self.values)
+                self.values.append(value)
+            out[i] = code
+        return out
+
+    def code(self, value: str) -> int:
+        """
+        The code for value, or -1 if it does not appear in the export.
+        """
+        return self._codes.get(value, -1)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class Chunk:
+    """
+    A block of rows in columnar form.
+    Categorical columns hold int32 codes into categories[name].values, amounts and counts are int64 or int32 with 0
+    for missing values, and timestamps are datetime64[s] with NaT for missing values.
+    """
+    def __init__(self, columns: Dict[str, np.ndarray], categories: Dict[str, Categories]):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def decode(self, name: str) -> np.ndarray:
+        """
+        The values of a categorical column as an object array of strings, with None for missing values.
+        """
+        values = np.array(self.categories[name].values + [None], dtype=object)
+        return values[self.columns[name]]
+
+    def to_arrow(self):
+        """
+        The chunk as a pyarrow RecordBatch, with categorical columns as dictionary arrays.
+        """
+        if pa is None:
+            raise ImportError('pyarrow is required for Arrow export. Install stripe-subscriptions[analytics]')
+        arrays, names = [], []
+        for name, column in self.columns.items():
+            if name in self.categories:
+                mask = column < 0
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(column, mask=mask), pa.array(self.categories[name].values, type=pa.string())))
+            else:
+                arrays.append(pa.array(column, mask=np.isnat(column) if column.dtype.kind == 'M' else None))
+            names.append(name)
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def _build_chunk(batch: List[Dict[str, Any]], schema: Dict[str, str],
+                 categories: Dict[str, Categories]) -> Chunk:
+    columns = {}
+    for name, dtype in schema.items():
+        values = [row[name] for row in batch]
+        if dtype == CATEGORY:
+            columns[name] = categories[name].encode(values)
+        elif dtype == DATETIME:
+            columns[name] = np.array(values, dtype=DATETIME)
+        else:
+            columns[name] = np.array([value or 0 for value in values], dtype=dtype)
+    return Chunk(columns, categories)
+
+
+def _stripe_objects(object_type: str, page_size: int, **filters) -> Iterator[Mapping[str, Any]]:
+    obj_cls, default_filters, _ = sources[object_type]
+    return obj_cls.list(limit=page_size, **{**default_filters, **filters}).auto_paging_iter()
+
+
+def export(object_type: str = 'subscription', store: Optional[SubscriptionStore] = None, chunk_size: int = 100000,
+           columns: Optional[Sequence[str]] = None, page_size: int = 100, **filters) -> Iterator[Chunk]:
+    """
+    Stream all subscriptions, prices or products into columnar chunks of up to chunk_size rows.
+    Subscriptions have a row for each of their items, with the item's price, amount and quantity, so a subscription
+    to several prices has several rows with the same sub_id.
+    Objects are read from the store if one is given, otherwise they are listed from Stripe page by page with filters,
+    so only one chunk and one page are held in memory at a time, besides the categories which are shared by all
+    chunks. Subscriptions are listed with status="all" unless another status is given.
+    Pass columns to export only some of the columns in subscriptions.export.schemas[object_type].
+    Requires numpy, and pyarrow for Chunk.to_arrow. Install with the analytics extra.
+    """
+    schema = schemas[object_type]
+    if columns:
+        schema = {name: schema[name] for name in columns}
+    categories = {name: Categories() for name, dtype in schema.items() if dtype == CATEGORY}
+    objs: Iterable[Mapping[str, Any]] = (store.values(object_type) if store
+                                         else _stripe_objects(object_type, page_size, **filters))
+    to_rows = rows[object_type]
+    batch = []
+    for obj in objs:
+        batch.extend(to_rows(obj))
+        while len(batch) >= chunk_size:
+            yield _build_chunk(batch[:chunk_size], schema, categories)
+            batch = batch[chunk_size:]
+    if batch:
+        yield _build_chunk(batch, schema, categories)
+
+
+def export_subscriptions(store: Optional[SubscriptionStore] = None, chunk_size: int = 100000,
+                         **kwargs) -> Iterator[Chunk]:
+    return export('subscription', store=store, chunk_size=chunk_size, **kwargs)
+
+
+def export_prices(store: Optional[SubscriptionStore] = None, chunk_size: int = 100000,
+                  **kwargs) -> Iterator[Chunk]:
+    return export('price', store=store, chunk_size=chunk_size, **kwargs)
+
+
+def export_products(store: Optional[SubscriptionStore] = None, chunk_size: int = 100000,
+                    **kwargs) -> Iterator[Chunk]:
+    return export('product', store=store, chunk_size=chunk_size, **kwargs)
+
+
+def concatenate(chunks: Iterable[Chunk]) -> Chunk:
+    """
+    Join the chunks of one export into a single chunk.
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return Chunk({}, {})
+    return Chunk({name: np.concatenate([chunk.columns[name] for chunk in chunks]) for name in chunks[0].columns},
+                 chunks[0].categories)
+
+
+def to_arrow_table(chunks: Iterable[Chunk]):
+    """
+    Join the chunks of one export into a pyarrow Table.
+    """
+    if pa is None:
+        raise ImportError('pyarrow is required for Arrow export. Install stripe-subscriptions[analytics]')
+    batches = [chunk.to_arrow() for chunk in chunks]
+    return pa.Table.from_batches(batches)
@@ -0,0 +1,161 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from .http import WrappedHTTPClient, install, uninstall
+from .stats import stats
+
+from typing import Deque, Dict, Optional, Sequence
+
+
+class HedgingHTTPClient(WrappedHTTPClient):
+    """
+    HTTP client which hedges slow GET requests to the given path prefixes.
+    If the first request has not answered within the percentile latency of recent requests to the same endpoint,
+    a second identical request is sent and whichever answers first is used. The other is cancelled if it has not
+    started yet, otherwise its response is discarded.
+    First requests are sent from a long-lived pool of first_workers threads, so each thread keeps its connections to
+    Stripe, and hedges from a separate pool of max_workers threads, so first requests never queue behind hedges.
+    When every first_workers thread is busy, the request is sent from the calling thread without hedging rather than
+    waiting for a thread.
+    Each hedgeable request adds budget to an allowance of hedges so no more than that fraction of requests are
+    hedged, which stops hedging from doubling the load on Stripe when it is slow for everyone.
+    The number of hedgeable requests, hedges sent and hedges which answered first are recorded in stats under "hedge".
+    """
+    def __init__(self, client=None, paths: Sequence[str] = ('/v1/subscriptions', '/v1/customers/'),
+                 percentile: float = 95, initial_delay: float = 0.5, min_samples: int = 20,
+                 samples: int = 500, budget: float = 0.05, max_workers: int = 16, first_workers: int = 32):
+        super().__init__(client)
+        self.paths = tuple(paths)
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.first_workers = first_workers
+        self._samples = samples
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._allowance = 1.0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stripe-hedge')
+        self._first_pool = ThreadPoolExecutor(max_workers=first_workers, thread_name_prefix='stripe-hedge-first')
+        self._first_in_flight = 0
+
+    @staticmethod
+    def _endpoint(path: str) -> str:
+        """
+        Group requests by the resource they are for, e.g. /v1/customers/cus_123 is grouped with other customers.
+        """
+        return '/'.join(path.split('/')[:3])
+
+    def delay(self, endpoint: str) -> float:
+        """
+        How long to wait for the first request to an endpoint before hedging it.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(endpoint, ()))
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def _record_latency(self, endpoint: str, latency: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen=self._samples)).append(latency)
+
+    def _take_allowance(self) -> bool:
+        with self._lock:
+            if self._allowance >= 1:
+                self._allowance -= 1
+                return True
+            return False
+
+    def _request(self, endpoint: str, method, url, headers, post_data) -> tuple:
+        start = time.monotonic()
+        response = self.client.request_with_retries(method, url, headers, post_data)
+        self._record_latency(endpoint, time.monotonic() - start)
+        return response
+
+    def _submit(self, *args) -> Future:
+        return self._pool.submit(contextvars.copy_context().run, self._request, *args)
+
+    def _start(self, *args) -> Optional[Future]:
+        """
+        Send a first request from the pool of first_workers threads, or return None if they are all busy.
+        """
+        with self._lock:
+            if self._first_in_flight >= self.first_workers:
+                return None
+            self._first_in_flight += 1
+        future = self._first_pool.submit(contextvars.copy_context().run, self._request, *args)
+        future.add_done_callback(self._first_done)
+        return future
+
+    def _first_done(self, future: Future) -> None:
+        with self._lock:
+            self._first_in_flight -= 1
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        path = urlparse(url).path
+        if method.lower() != 'get' or not path.startswith(self.paths):
+            return self.client.request_with_retries(method, url, headers, post_data)
+        endpoint = self._endpoint(path)
+        with self._lock:
+            self._allowance = min(self._allowance + self.budget, 10)
+        stats.incr('hedge.requests')
+        first = self._start(endpoint, method, url, dict(headers), post_data)
+        if first is None:
+            stats.incr('hedge.inline')
+            return self._request(endpoint, method, url, headers, post_data)
+        done, _ = wait([first], timeout=self.delay(endpoint))
+        if done or not self._take_allowance():
+            return first.result()
+        stats.incr('hedge.sent')
+        second = self._submit(endpoint, method, url, dict(headers), post_data)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = done.pop()
+            if winner.exception() is None or not pending:
+                break
+        for future in pending:
+            future.cancel()
+        if winner is second:
+            stats.incr('hedge.won')
+        return winner.result()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self._first_pool.shutdown(wait=False)
+
+
+_client: Optional[HedgingHTTPClient] = None
+
+
+def install_hedging(**kwargs) -> HedgingHTTPClient:
+    """
+    Hedge slow idempotent reads such as listing subscriptions and retrieving customers.
+    kwargs are passed to HedgingHTTPClient.
+    """
+    global _client
+    uninstall_hedging()
+    _client = install(HedgingHTTPClient, **kwargs)
+    return _client
+
+
+def uninstall_hedging() -> None:
+    global _client
+    if _client:
+        uninstall(_client)
+        _client.close()
+        _client = None
+
+
+def hedge_rates() -> Dict[str, float]:
+    """
+    The fraction of hedgeable requests which were hedged and the fraction of hedges which answered first.
+    """
+    counters = stats.snapshot()['counters']
+    requests, sent, won = (counters.get(f'hedge.{name}', 0) for name in ('requests', 'sent', 'won'))
+    return {'hedge_rate': sent / requests if requests else 0.0,
+            'win_rate': won / sent if sent else 0.0}
@@ -0,0 +1,246 @@
+import stripe
+import time
+from stripe.http_client import HTTPClient, RequestsClient, new_default_http_client
+from .stats import stats
+
+from typing import Dict, Optional, Type
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+except ImportError:
+    requests = None
+
+try:
+    import httpx
+    import h2  # noqa: F401
+except ImportError:
+    httpx = None
+
+
+def default_client() -> HTTPClient:
+    """
+    A new instance of the client the Stripe library would create itself, with stripe.proxy and stripe.verify_ssl_certs.
+    """
+    return new_default_http_client(proxy=stripe.proxy, verify_ssl_certs=stripe.verify_ssl_certs)
+
+
+class WrappedHTTPClient(HTTPClient):
+    """
+    Base class for Stripe HTTP clients which add behaviour around another client, such as a circuit breaker.
+    All requests made by the library go through stripe.default_http_client so wrapping it is the one place
+    where every Stripe request can be observed. Subclasses override request_with_retries.
+    """
+    def __init__(self, client: Optional[HTTPClient] = None):
+        super().__init__()
+        self.client = client or stripe.default_http_client or default_client()
+
+    @property
+    def name(self) -> str:
+        return self.client.name
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        return self.client.request_with_retries(method, url, headers, post_data)
+
+    def request_stream_with_retries(self, method, url, headers, post_data=None):
+        return self.client.request_stream_with_retries(method, url, headers, post_data)
+
+    def request(self, method, url, headers, post_data=None):
+        return self.client.request(method, url, headers, post_data)
+
+    def request_stream(self, method, url, headers, post_data=None):
+        return self.client.request_stream(method, url, headers, post_data)
+
+    def close(self):
+        self.client.close()
+
+
+def install(client_cls: Type[WrappedHTTPClient], **kwargs) -> WrappedHTTPClient:
+    """
+    Wrap the current stripe.default_http_client with client_cls and make it the default.
+    """
+    client = client_cls(client=stripe.default_http_client or default_client(), **kwargs)
+    stripe.default_http_client = client
+    return client
+
+
+def uninstall(client: WrappedHTTPClient) -> None:
+    """
+    Remove a wrapper added by install from the chain of clients.
+    """
+    if stripe.default_http_client is client:
+        stripe.default_http_client = client.client
+        return
+    parent = stripe.default_http_client
+    while isinstance(parent, WrappedHTTPClient):
+        if parent.client is client:
+            parent.client = client.client
+            return
+        parent = parent.client
+
+
+def base_client() -> Optional[HTTPClient]:
+    """
+    The client which actually sends requests, inside any wrappers added by install.
+    """
+    client = stripe.default_http_client
+    while isinstance(client, WrappedHTTPClient):
+        client = client.client
+    return client
+
+
+def set_base_client(client: HTTPClient) -> None:
+    """
+    Replace the client which actually sends requests, keeping any wrappers added by install.
+    """
+    parent = stripe.default_http_client
+    if not isinstance(parent, WrappedHTTPClient):
+        stripe.default_http_client = client
+        return
+    while isinstance(parent.client, WrappedHTTPClient):
+        parent = parent.client
+    parent.client = client
+
+
+def request_timeout(timeout: float) -> float:
+    """
+    timeout, or the time left before the current deadline if that is sooner.
+    """
+    from .deadline import remaining
+    left = remaining()
+    return timeout if left is None else max(min(timeout, left), 0.001)
+
+
+if requests:
+    class DeadlineRequestsClient(RequestsClient):
+        """
+        Stripe's requests client with the timeout of each request cut to the time left before the current deadline.
+        """
+        @property
+        def _timeout(self) -> float:
+            return request_timeout(self.timeout)
+
+        @_timeout.setter
+        def _timeout(self, timeout: float) -> None:
+            self.timeout = timeout
+
+    class _MeasuredPoolMixin:
+        """
+        Records new connections and time spent waiting for a free connection when the pool is full.
+        """
+        def _new_conn(self):
+            stats.incr('http.pool.connections')
+            return super()._new_conn()
+
+        def _get_conn(self, timeout=None):
+            start = time.monotonic()
+            conn = super()._get_conn(timeout)
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                stats.incr('http.pool.waits')
+                stats.timing('http.pool.wait', waited)
+            return conn
+
+    class MeasuredHTTPConnectionPool(_MeasuredPoolMixin, HTTPConnectionPool):
+        pass
+
+    class MeasuredHTTPSConnectionPool(_MeasuredPoolMixin, HTTPSConnectionPool):
+        pass
+
+    class _MeasuredHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': MeasuredHTTPConnectionPool,
+                                                       'https': MeasuredHTTPSConnectionPool}
+
+    class PooledRequestsClient(DeadlineRequestsClient):
+        """
+        Stripe HTTP client sharing one pool of keep-alive connections between all threads.
+        Stripe's default client opens a separate session, and so separate connections, for each thread.
+        With block=True, threads wait for a free connection rather than opening extra connections which are
+        closed straight after use, so maxsize should be at least the number of threads making requests.
+        """
+        def __init__(self, maxsize: int = 10, block: bool = True, timeout: float = 80, **kwargs):
+            kwargs.setdefault('proxy', stripe.proxy)
+            kwargs.setdefault('verify_ssl_certs', stripe.verify_ssl_certs)
+            session = requests.Session()
+            adapter = _MeasuredHTTPAdapter(pool_connections=2, pool_maxsize=maxsize, pool_block=block)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            super().__init__(timeout=timeout, session=session, **kwargs)
+
+        def request(self, method, url, headers, post_data=None):
+            stats.incr('http.pool.requests')
+            return super().request(method, url, headers, post_data)
+
+        def close(self):
+            self._session.close()
+
+
+if httpx:
+    class HTTP2Client(HTTPClient):
+        """
+        Stripe HTTP client using httpx with HTTP/2, so concurrent requests are multiplexed over a single connection.
+        Requires httpx and h2 to be installed. Uses stripe.proxy and stripe.verify_ssl_certs unless proxy or
+        verify_ssl_certs are given.
+        """
+        name = 'httpx'
+
+        def __init__(self, maxsize: int = 10, timeout: float = 80, **kwargs):
+            kwargs.setdefault('proxy', stripe.proxy)
+            kwargs.setdefault('verify_ssl_certs', stripe.verify_ssl_certs)
+            super().__init__(**kwargs)
+            self.timeout = timeout
+            self._client = httpx.Client(http2=True, timeout=timeout,
+                                        verify=stripe.ca_bundle_path if self._verify_ssl_certs else False,
+                                        proxy=self._proxy['https'] if self._proxy else None,
+                                        limits=httpx.Limits(max_connections=maxsize,
+                                                            max_keepalive_connections=maxsize))
+
+        def request(self, method, url, headers, post_data=None):
+            stats.incr('http.pool.requests')
+            try:
+                response = self._client.request(method, url, headers=headers, content=post_data,
+                                                timeout=request_timeout(self.timeout))
+            except httpx.TransportError as e:
+                raise stripe.error.APIConnectionError(
+                    f"Unexpected error communicating with Stripe. (Network error: {type(e).__name__}: {e})",
+                    should_retry=isinstance(e, (httpx.TimeoutException, httpx.ConnectError)))
+            return response.content, response.status_code, response.headers
+
+        def close(self):
+            self._client.close()
+
+
+def install_connection_pool(maxsize: Optional[int] = None, http2: bool = False, timeout: float = 80) -> HTTPClient:
+    """
+    Send all Stripe requests through a connection pool shared by all threads.
+    maxsize defaults to the number of functions the scheduler runs at once plus a few for requests made directly from
+    calling threads.
+    If http2 is True and httpx and h2 are installed, HTTP/2 is used instead.
+    """
+    from . import scheduler
+    maxsize = maxsize or scheduler.current.max_workers + 4
+    if http2 and httpx:
+        client = HTTP2Client(maxsize=maxsize, timeout=timeout)
+    else:
+        client = PooledRequestsClient(maxsize=maxsize, timeout=timeout)
+    set_base_client(client)
+    return client
+
+
+def pool_stats() -> Dict[str, float]:
+    """
+    Requests sent, connections opened, the fraction of requests which reused an open connection and the number of
+    times a thread had to wait for a free connection, with the total time waited.
+    """
+    snapshot = stats.snapshot()
+    requests_sent = snapshot['counters'].get('http.pool.requests', 0)
+    connections = snapshot['counters'].get('http.pool.connections', 0)
+    wait = snapshot['timings'].get('http.pool.wait', {})
+    return {'requests': requests_sent,
+            'connections': connections,
+            'reuse_ratio': 1 - connections / requests_sent if requests_sent else 0.0,
+            'waits': wait.get('count', 0),
+            'wait_time': wait.get('total', 0.0)}
@@ -0,0 +1,72 @@
+import contextvars
+from .cache import request_cache
+
+from typing import Any, Callable, Iterable, Iterator
+
+
+class _ClosingIterator:
+    """
+    Iterates a WSGI response inside the request's context and discards the request cache when the response is closed.
+    """
+    def __init__(self, ctx: contextvars.Context, response: Iterable[bytes], close: Callable[[], None]):
+        self._ctx = ctx
+        self._iterator: Iterator[bytes] = iter(response)
+        self._response = response
+        self._close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return self._ctx.run(next, self._iterator)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._response, 'close'):
+                self._ctx.run(self._response.close)
+        finally:
+            self._close()
+
+
+class RequestCacheMiddleware:
+    """
+    WSGI middleware which memoizes calls to Stripe for the duration of each request.
+    For example, in Django's wsgi.py:
+
+        application = RequestCacheMiddleware(get_wsgi_application())
+    """
+    def __init__(self, app: Callable, prefetch_subscriptions: bool = True):
+        self.app = app
+        self.prefetch_subscriptions = prefetch_subscriptions
+
+    def __call__(self, environ, start_response) -> Iterable[bytes]:
+        ctx = contextvars.copy_context()
+        cache_context = request_cache(prefetch_subscriptions=self.prefetch_subscriptions)
+        ctx.run(cache_context.__enter__)
+
+        def close():
+            ctx.run(cache_context.__exit__, None, None, None)
+        try:
+            response = ctx.run(self.app, environ, start_response)
+        except BaseException:
+            close()
+            raise
+        return _ClosingIterator(ctx, response, close)
+
+
+class ASGIRequestCacheMiddleware:
+    """
+    ASGI middleware which memoizes calls to Stripe for the duration of each request.
+    Synchronous functions from this library should be called with asyncio.to_thread (or another method which copies
+    the context to the thread) for the cache to be used.
+    """
+    def __init__(self, app: Callable, prefetch_subscriptions: bool = True):
+        self.app = app
+        self.prefetch_subscriptions = prefetch_subscriptions
+
+    async def __call__(self, scope: Any, receive: Callable, send: Callable) -> None:
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        with request_cache(prefetch_subscriptions=self.prefetch_subscriptions):
+            await self.app(scope, receive, send)
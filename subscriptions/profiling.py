@@ -0,0 +1,226 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+from stripe.api_requestor import APIRequestor
+from .http import WrappedHTTPClient, install
+
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+ENV_VAR = 'STRIPE_SUBSCRIPTIONS_PROFILE'
+
+profile_directory = os.environ.get(ENV_VAR)
+
+
+class Span:
+    __slots__ = ('name', 'category', 'stack', 'thread_id', 'start', 'end')
+
+    def __init__(self, name: str, category: str, stack: Tuple[str, ...], thread_id: int, start: float,
+                 end: float = 0.0):
+        self.name = name
+        self.category = category
+        self.stack = stack
+        self.thread_id = thread_id
+        self.start = start
+        self.end = end
+
+
+class Profile:
+    """
+    Timeline of the Stripe requests, executor queueing and waits, JSON decoding and local work done inside a
+    profile() context, including work done in executor threads on its behalf.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def totals(self) -> Dict[str, float]:
+        """
+        Total seconds spent in each category of span.
+        """
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span.category] = totals.get(span.category, 0) + span.end - span.start
+        return totals
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """
+        Spans in Chrome's trace event format, which can be loaded in chrome://tracing or https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        return {'traceEvents': [{'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': pid,
+                                 'tid': span.thread_id, 'ts': (span.start - self.start) * 1e6,
+                                 'dur': (span.end - span.start) * 1e6} for span in self.spans]}
+
+    def to_collapsed(self) -> List[str]:
+        """
+        Spans as collapsed stacks with self time in microseconds, the input format of flamegraph.pl and speedscope.
+        Time spent in a child span on the same thread is subtracted from the parent's self time.
+        Child spans in other threads, such as requests made in the executor, run in parallel so are not subtracted.
+        """
+        self_times: Dict[Tuple[Tuple[str, ...], int], float] = {}
+        for span in self.spans:
+            key = (span.stack, span.thread_id)
+            self_times[key] = self_times.get(key, 0) + span.end - span.start
+        for span in self.spans:
+            parent_key = (span.stack[:-1], span.thread_id)
+            if parent_key in self_times:
+                self_times[parent_key] -= span.end - span.start
+        totals: Dict[str, float] = {}
+        for (stack, _), seconds in self_times.items():
+            folded = ';'.join(stack)
+            totals[folded] = totals.get(folded, 0) + seconds
+        return [f'{stack} {max(int(seconds * 1e6), 0)}' for stack, seconds in totals.items()]
+
+    def dump(self, path: str) -> None:
+        """
+        Write the profile to path, as a Chrome trace if the path ends with .json or as collapsed stacks otherwise.
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_chrome_trace(), f)
+            else:
+                f.write('\n'.join(self.to_collapsed()) + '\n')
+
+
+_profile: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_profile', default=None)
+_stack: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_profile_stack', default=())
+
+
+class _NoOpSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_op_span = _NoOpSpan()
+
+
+def active() -> bool:
+    return _profile.get() is not None
+
+
+@contextmanager
+def _span(profile: Profile, name: str, category: str) -> Iterator[Span]:
+    stack = _stack.get() + (name,)
+    token = _stack.set(stack)
+    span = Span(name, category, stack, threading.get_ident(), time.perf_counter())
+    try:
+        yield span
+    finally:
+        span.end = time.perf_counter()
+        _stack.reset(token)
+        profile.add(span)
+
+
+def span(name: str, category: str = 'local'):
+    """
+    Record the time spent in this context if a profile is active. Does almost nothing otherwise.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return _no_op_span
+    return _span(profile, name, category)
+
+
+def queued(fn: Callable, name: str) -> Callable:
+    """
+    Wrap a function submitted to the executor to record the time it waits in the queue before a thread picks it up.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return fn
+    submitted = time.perf_counter()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        profile.add(Span(f'queue {name}', 'queue', _stack.get() + (f'queue {name}',), threading.get_ident(),
+                         submitted, time.perf_counter()))
+        with _span(profile, name, 'executor'):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class ProfilingHTTPClient(WrappedHTTPClient):
+    """
+    HTTP client which records each Stripe request in the active profile.
+    """
+    def request_with_retries(self, method, url, headers, post_data=None):
+        profile = _profile.get()
+        if profile is None:
+            return self.client.request_with_retries(method, url, headers, post_data)
+        with _span(profile, f'{method.upper()} {urlparse(url).path}', 'stripe'):
+            return self.client.request_with_retries(method, url, headers, post_data)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _install() -> None:
+    """
+    Add the profiling HTTP client and time JSON decoding of responses. Only done the first time a profile is started.
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        install(ProfilingHTTPClient)
+        interpret_response = APIRequestor.interpret_response
+
+        @wraps(interpret_response)
+        def profiled_interpret_response(self, *args, **kwargs):
+            with span('decode', 'json'):
+                return interpret_response(self, *args, **kwargs)
+        APIRequestor.interpret_response = profiled_interpret_response
+        _installed = True
+
+
+@contextmanager
+def profile() -> Iterator[Profile]:
+    """
+    Record a timeline of all work done by the library inside this context.
+    """
+    _install()
+    current = Profile()
+    token = _profile.set(current)
+    try:
+        yield current
+    finally:
+        _profile.reset(token)
+
+
+def profiled(f: Callable):
+    """
+    Decorator recording a span for the function when a profile is active.
+    If the STRIPE_SUBSCRIPTIONS_PROFILE environment variable is set to a directory when the library is imported,
+    calls made outside a profile context are profiled and each profile is written to that directory as a Chrome trace.
+    """
+    name = f.__name__
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        profile_ = _profile.get()
+        if profile_ is not None:
+            with _span(profile_, name, 'function'):
+                return f(*args, **kwargs)
+        if not profile_directory:
+            return f(*args, **kwargs)
+        with profile() as profile_:
+            with _span(profile_, name, 'function'):
+                result = f(*args, **kwargs)
+        profile_.dump(os.path.join(profile_directory, f'{name}-{os.getpid()}-{int(time.time() * 1e6)}.json'))
+        return result
+    return wrapper
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing rate calls per second on average, with bursts of up to burst calls.
+    Used to keep bulk jobs within Stripe's rate limits.
+    """
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens: int = 1) -> bool:
+        """
+        Take tokens if they are available now, without waiting.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: int = 1) -> float:
+        """
+        Wait until tokens are available and take them. Returns the number of seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
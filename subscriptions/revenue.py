@@ -0,0 +1,270 @@
+import numpy as np
+from .export import Chunk, concatenate, export_prices, export_subscriptions
+from .store import SubscriptionStore
+from .types import RevenueMetrics, RevenueMovements
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+months_per_interval = {'day': 12 / 365, 'week': 12 / 52, 'month': 1.0, 'year': 12.0}
+
+excluded_statuses = ('incomplete', 'incomplete_expired', 'trialing')
+
+NEVER = np.datetime64('9999-12-31T00:00:00', 's')
+
+
+def _lookup(categories: Sequence[str], other: Chunk, column: str) -> np.ndarray:
+    """
+    For each category of a column in one export, the row in another export with the same value, or -1.
+    """
+    codes = np.array([other.categories[column].code(value) for value in categories], dtype=np.int64)
+    rows = np.full(len(other.categories[column]) + 1, -1, dtype=np.int64)
+    rows[other[column][other[column] >= 0]] = np.nonzero(other[column] >= 0)[0]
+    return rows[codes]
+
+
+def _interval_months(interval_codes: np.ndarray, interval_categories: Sequence[str],
+                     interval_counts: np.ndarray) -> np.ndarray:
+    factors = np.array([months_per_interval.get(interval, 0.0) for interval in interval_categories] + [0.0])
+    return factors[interval_codes] * np.maximum(interval_counts, 1)
+
+
+def monthly_amount(subs: Chunk, prices: Optional[Chunk] = None) -> np.ndarray:
+    """
+    The monthly recurring amount of each subscription in the smallest currency unit, e.g. cents.
+    Amounts are normalised from the price's recurring interval and interval_count, so a yearly price of 120.00 is
+    10.00 a month and a price billed every 3 months is divided by 3, then multiplied by the quantity.
+    Amount and interval are taken from the prices export where it has the subscription's price and from the
+    subscription's plan otherwise. Subscriptions with an unknown interval, or a tiered or metered price with no
+    unit amount, count as 0.
+    """
+    amount = subs['amount'].astype(np.float64)
+    months = _interval_months(subs['interval'], subs.categories['interval'].values, subs['interval_count'])
+    if prices is not None and len(prices):
+        rows = _lookup(subs.categories['price_id'].values, prices, 'price_id')
+        rows = np.append(rows, -1)[subs['price_id']]
+        found = rows >= 0
+        price_rows = rows[found]
+        amount[found] = prices['amount'][price_rows]
+        price_months = _interval_months(prices['interval'], prices.categories['interval'].values,
+                                        prices['interval_count'])
+        months[found] = price_months[price_rows]
+    monthly = np.zeros(len(subs), dtype=np.float64)
+    np.divide(amount * np.maximum(subs['quantity'], 1), months, out=monthly, where=months > 0)
+    return monthly
+
+
+def end_times(subs: Chunk) -> np.ndarray:
+    """
+    When each subscription stops contributing revenue: cancel_at if it is set, otherwise canceled_at, otherwise never.
+    """
+    ends = np.where(np.isnat(subs['cancel_at']), subs['canceled_at'], subs['cancel_at'])
+    return np.where(np.isnat(ends), NEVER, ends)
+
+
+def _counted(subs: Chunk) -> np.ndarray:
+    excluded = [subs.categories['status'].code(status) for status in excluded_statuses]
+    return ~np.isin(subs['status'], excluded) & ~np.isnat(subs['created'])
+
+
+def _groups(subs: Chunk, by: Sequence[str]) -> Tuple[np.ndarray, list]:
+    """
+    A group number for each subscription and the labels of each group, from one or more categorical columns.
+    """
+    if not by:
+        return np.zeros(len(subs), dtype=np.int64), [()]
+    sizes = [len(subs.categories[column]) + 1 for column in by]
+    keys = np.zeros(len(subs), dtype=np.int64)
+    for column, size in zip(by, sizes):
+        keys = keys * size + subs[column] + 1
+    unique, inverse = np.unique(keys, return_inverse=True)
+    decoded = [np.array([None] + subs.categories[column].values, dtype=object) for column in by]
+    codes = []
+    for size in reversed(sizes):
+        codes.append(unique % size)
+        unique = unique // size
+    codes.reverse()
+    labels = list(zip(*(values[column_codes] for values, column_codes in zip(decoded, codes))))
+    return inverse.reshape(-1), labels
+
+
+def month_starts(start: str, end: str) -> np.ndarray:
+    """
+    The first second of each month from start to end inclusive, e.g. month_starts('2021-01', '2021-12').
+    """
+    return np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1).astype('datetime64[s]')
+
+
+def _label_key(label: tuple) -> str:
+    return '\x1f'.join('' if value is None else str(value) for value in label)
+
+
+def _live_mrr(subs: Chunk, prices: Optional[Chunk], by: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                                                                  List[str]]:
+    """
+    The MRR of each subscription contributing revenue at the time of an export, per group.
+    Returns the subscription id, the group and the MRR of each pair of subscription and group, and the label key of
+    each group.
+    """
+    monthly = monthly_amount(subs, prices)
+    live = _counted(subs) & (subs['status'] != subs.categories['status'].code('canceled')) & (monthly > 0)
+    group, labels = _groups(subs, by)
+    keys, inverse = np.unique(subs['sub_id'][live].astype(np.int64) * len(labels) + group[live], return_inverse=True)
+    mrr = np.bincount(inverse.reshape(-1), weights=monthly[live], minlength=len(keys))
+    sub_ids = np.array(subs.categories['sub_id'].values, dtype=object)[keys // len(labels)].astype(str)
+    return sub_ids, keys % len(labels), mrr, [_label_key(label) for label in labels]
+
+
+def _changes(before: Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]],
+             after: Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]) -> Tuple[List[str], Dict[str, tuple]]:
+    """
+    Compare the MRR per subscription and group of two exports. Returns the label keys of the groups of both exports
+    and, for new, churned, expansion and contraction MRR, the group of each amount as an index into those keys and the
+    amounts. A subscription moving from one group to another, e.g. to another price, is contraction in the first group
+    and expansion in the second.
+    """
+    ids_before, groups_before, mrr_before, label_keys_before = before
+    ids_after, groups_after, mrr_after, label_keys_after = after
+    label_keys = sorted(set(label_keys_before) | set(label_keys_after))
+    codes = {key: code for code, key in enumerate(label_keys)}
+    groups_before = np.array([codes[key] for key in label_keys_before], dtype=np.int64)[groups_before]
+    groups_after = np.array([codes[key] for key in label_keys_after], dtype=np.int64)[groups_after]
+    _, sub_codes = np.unique(np.concatenate([ids_before, ids_after]), return_inverse=True)
+    sub_codes = sub_codes.reshape(-1).astype(np.int64)
+    subs_before, subs_after = sub_codes[:len(ids_before)], sub_codes[len(ids_before):]
+    keys_before = subs_before * len(label_keys) + groups_before
+    keys_after = subs_after * len(label_keys) + groups_after
+    _, index_before, index_after = np.intersect1d(keys_before, keys_after, assume_unique=True, return_indices=True)
+    change = mrr_after[index_after] - mrr_before[index_before]
+    only_before = np.ones(len(keys_before), dtype=bool)
+    only_before[index_before] = False
+    only_after = np.ones(len(keys_after), dtype=bool)
+    only_after[index_after] = False
+    kept_before = np.isin(subs_before, subs_after)
+    kept_after = np.isin(subs_after, subs_before)
+    changed_groups = groups_after[index_after]
+    return label_keys, {
+        'new': (groups_after[only_after & ~kept_after], mrr_after[only_after & ~kept_after]),
+        'churned': (groups_before[only_before & ~kept_before], mrr_before[only_before & ~kept_before]),
+        'expansion': (np.concatenate([changed_groups[change > 0], groups_after[only_after & kept_after]]),
+                      np.concatenate([change[change > 0], mrr_after[only_after & kept_after]])),
+        'contraction': (np.concatenate([changed_groups[change < 0], groups_before[only_before & kept_before]]),
+                        np.concatenate([-change[change < 0], mrr_before[only_before & kept_before]])),
+    }
+
+
+def metrics(subs: Chunk, buckets: np.ndarray, by: Sequence[str] = ('currency',),
+            prices: Optional[Chunk] = None, snapshots: Optional[Sequence[Chunk]] = None) -> RevenueMetrics:
+    """
+    MRR, ARR and active subscriber counts at each time in buckets, and the MRR of new and churned subscriptions
+    between each time and the one before, grouped by categorical columns of the subscriptions export such as
+    currency, product_id, price_id and interval. Group by currency unless all prices use the same currency.
+    Arrays have one row per group and one column per bucket. Subscriptions are counted from created until
+    end_times, except incomplete and trialing subscriptions.
+    An export only has the current price and quantity of each subscription, so MRR is an approximation which applies
+    them to the subscription's whole history. Upgrades, downgrades and seat changes need exports taken over time:
+    pass snapshots, one export of the subscriptions taken at each time in buckets, such as one saved after each
+    nightly sync, to also get the expansion and contraction MRR of each group between each snapshot and the one before.
+    Without snapshots they are 0.
+    Each subscription is placed into its first and last bucket with a binary search and the buckets in between are
+    filled with a cumulative sum, so the cost is linear in the number of subscriptions whatever the number of buckets.
+    """
+    buckets = np.asarray(buckets, dtype='datetime64[s]')
+    counted = _counted(subs)
+    monthly = monthly_amount(subs, prices)[counted]
+    group, labels = _groups(subs, by)
+    group = group[counted]
+    sub_codes = subs['sub_id'][counted]
+    first = np.searchsorted(buckets, subs['created'][counted], side='left')
+    last = np.searchsorted(buckets, end_times(subs)[counted], side='left')
+    has_revenue = first < last
+    first, last, group, monthly = first[has_revenue], last[has_revenue], group[has_revenue], monthly[has_revenue]
+    sub_codes = sub_codes[has_revenue]
+    # A subscription with several items in the same group is one subscriber
+    subscriber = np.zeros(len(group), dtype=np.float64)
+    subscriber[np.unique(sub_codes.astype(np.int64) * max(len(labels), 1) + group, return_index=True)[1]] = 1
+    width = len(buckets) + 1
+    shape = (len(labels), width)
+
+    def bincount(index: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        return np.bincount(group * width + index, weights=weights, minlength=shape[0] * width).reshape(shape)
+
+    mrr = np.cumsum(bincount(first, monthly) - bincount(last, monthly), axis=1)[:, :-1]
+    active = np.cumsum(bincount(first, subscriber) - bincount(last, subscriber), axis=1)[:, :-1].astype(np.int64)
+    result: RevenueMetrics = {'buckets': buckets,
+                              'groups': labels,
+                              'mrr': mrr,
+                              'arr': mrr * 12,
+                              'active': active,
+                              'new_mrr': bincount(first, monthly)[:, :-1],
+                              'churned_mrr': bincount(last, monthly)[:, :-1],
+                              'expansion_mrr': np.zeros((len(labels), len(buckets))),
+                              'contraction_mrr': np.zeros((len(labels), len(buckets)))}
+    if snapshots is not None:
+        _add_movements(result, snapshots, by, prices)
+    return result
+
+
+def _add_movements(result: RevenueMetrics, snapshots: Sequence[Chunk], by: Sequence[str],
+                   prices: Optional[Chunk]) -> None:
+    """
+    Fill in expansion and contraction MRR between each pair of consecutive snapshots, adding rows of zeros to the
+    other arrays for groups which only appear in the snapshots.
+    """
+    if len(snapshots) != len(result['buckets']):
+        raise ValueError(f"{len(snapshots)} snapshots given for {len(result['buckets'])} buckets")
+    rows = {_label_key(label): i for i, label in enumerate(result['groups'])}
+    labels: List[tuple] = list(result['groups'])
+    columns = []
+    previous = None
+    for column, snapshot in enumerate(snapshots):
+        current = _live_mrr(snapshot, prices, by)
+        if previous is not None:
+            columns.append((column, *_changes(previous, current)))
+        previous = current
+        for label in _groups(snapshot, by)[1]:
+            if _label_key(label) not in rows:
+                rows[_label_key(label)] = len(labels)
+                labels.append(label)
+    extra = len(labels) - len(result['groups'])
+    if extra:
+        for name in ('mrr', 'arr', 'active', 'new_mrr', 'churned_mrr', 'expansion_mrr', 'contraction_mrr'):
+            result[name] = np.concatenate(
+                [result[name], np.zeros((extra, result[name].shape[1]), dtype=result[name].dtype)])
+        result['groups'] = labels
+    for column, label_keys, changes in columns:
+        label_rows = np.array([rows[key] for key in label_keys], dtype=np.int64)
+        for name in ('expansion', 'contraction'):
+            groups, amounts = changes[name]
+            np.add.at(result[f'{name}_mrr'][:, column], label_rows[groups], amounts)
+
+
+def movements(before: Chunk, after: Chunk, prices_before: Optional[Chunk] = None,
+              prices_after: Optional[Chunk] = None) -> RevenueMovements:
+    """
+    Changes in MRR between two exports of the same subscriptions taken at different times, such as the store
+    before and after a sync. Subscriptions only contributing revenue in the later export are new, those only in
+    the earlier export are churned and those in both are expansion or contraction if their monthly amount changed.
+    The amounts of a subscription's items are added together.
+    Amounts are totals in the smallest currency unit so both exports should be for a single currency.
+    Use metrics with snapshots for expansion and contraction per group over many exports.
+    """
+    live_before = _live_mrr(before, prices_before, ())
+    live_after = _live_mrr(after, prices_after, ())
+    _, changes = _changes(live_before, live_after)
+    return {'mrr_before': float(live_before[2].sum()),
+            'mrr_after': float(live_after[2].sum()),
+            'new_mrr': float(changes['new'][1].sum()),
+            'churned_mrr': float(changes['churned'][1].sum()),
+            'expansion_mrr': float(changes['expansion'][1].sum()),
+            'contraction_mrr': float(changes['contraction'][1].sum()),
+            'new': len(changes['new'][1]),
+            'churned': len(changes['churned'][1])}
+
+
+def store_metrics(store: SubscriptionStore, buckets: np.ndarray, by: Sequence[str] = ('currency',)) -> RevenueMetrics:
+    """
+    metrics for all subscriptions in a store filled by subscriptions.sync.sync_account, using its prices.
+    """
+    return metrics(concatenate(export_subscriptions(store)), buckets, by=by,
+                   prices=concatenate(export_prices(store)))
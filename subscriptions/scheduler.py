@@ -0,0 +1,245 @@
+import abc
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import CancelledError, Executor, ThreadPoolExecutor, Future, TimeoutError
+
+from typing import Any, Callable, Generator, Optional
+
+try:
+    import gevent
+    import gevent.pool
+except ImportError:
+    gevent = None
+
+
+def iterate_in_context(ctx: contextvars.Context, gen: Generator[Any, Any, Any]) -> Generator[Any, Any, Any]:
+    """
+    Run each step of a generator in ctx, so context variables it sets around its yields, such as the active account
+    or deadline, are not seen by the caller between steps, and are reset in the context they were set in even when
+    the generator is closed from another one.
+    """
+    try:
+        value = ctx.run(next, gen)
+        while True:
+            try:
+                sent = yield value
+            except GeneratorExit:
+                ctx.run(gen.close)
+                raise
+            except BaseException as e:
+                value = ctx.run(gen.throw, e)
+            else:
+                value = ctx.run(gen.send, sent)
+    except StopIteration as e:
+        return e.value
+
+
+class Scheduler(abc.ABC):
+    """
+    Runs the requests which functions such as get_subscription_prices and list_payment_methods send to Stripe at the
+    same time. submit returns an object with the same result, done and cancel methods as concurrent.futures.Future.
+    max_workers is how many functions can run at once.
+    """
+    name = ''
+    max_workers = 1
+
+    @abc.abstractmethod
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        pass
+
+    def queued(self) -> int:
+        """
+        The number of functions submitted which are waiting for a worker, or 0 if the scheduler does not know.
+        """
+        return 0
+
+    def shutdown(self) -> None:
+        pass
+
+
+class ThreadScheduler(Scheduler):
+    """
+    Runs functions in a thread pool. The default, suitable for servers using OS threads or processes.
+    """
+    name = 'thread'
+
+    def __init__(self, max_workers: Optional[int] = None, executor: Optional[ThreadPoolExecutor] = None):
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.max_workers = self.executor._max_workers
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def _dequeued(self) -> None:
+        with self._lock:
+            self._queued -= 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        started = False
+
+        def run() -> Any:
+            nonlocal started
+            started = True
+            self._dequeued()
+            return fn(*args, **kwargs)
+
+        def cancelled(future: Future) -> None:
+            if not started:
+                self._dequeued()
+
+        with self._lock:
+            self._queued += 1
+        future = self.executor.submit(run)
+        future.add_done_callback(cancelled)
+        return future
+
+    def queued(self) -> int:
+        with self._lock:
+            return self._queued
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class SynchronousScheduler(Scheduler):
+    """
+    Runs functions straight away in the calling thread, so requests are sent one after another.
+    Has the least overhead, for scripts and tests, or servers where one request is handled per process at a time.
+    """
+    name = 'sync'
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class AsyncioScheduler(Scheduler):
+    """
+    Runs functions in the default executor of an asyncio event loop, so an asyncio application's library calls
+    share the threads the application already uses for blocking work instead of starting another pool.
+    The loop must be running in another thread, as the library's functions block while they wait for results.
+    Defaults to the loop running when the scheduler is created, so without a loop it must be created in a coroutine.
+    submit raises RuntimeError if the loop is not running or is running in the calling thread, instead of waiting
+    forever for a result.
+    """
+    name = 'asyncio'
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, max_workers: int = 32):
+        self.loop = loop or asyncio.get_running_loop()
+        self.max_workers = max_workers
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self.loop.is_running():
+            raise RuntimeError('The event loop of the asyncio scheduler is not running')
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            raise RuntimeError('Library functions cannot be called from the thread running the event loop of the '
+                               'asyncio scheduler, use loop.run_in_executor')
+
+        async def run() -> Any:
+            return await self.loop.run_in_executor(None, lambda: fn(*args, **kwargs))
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+
+class _GreenletFuture:
+    """
+    A greenlet with the methods of concurrent.futures.Future used by the library.
+    """
+    def __init__(self, greenlet):
+        self.greenlet = greenlet
+        self._cancelled = False
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        if self._cancelled:
+            raise CancelledError()
+        try:
+            return self.greenlet.get(timeout=timeout)
+        except gevent.Timeout:
+            raise TimeoutError() from None
+
+    def exception(self, timeout: Optional[float] = None) -> Optional[BaseException]:
+        if self._cancelled:
+            raise CancelledError()
+        self.greenlet.join(timeout=timeout)
+        return self.greenlet.exception
+
+    def done(self) -> bool:
+        return self.greenlet.ready()
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> bool:
+        # Greenlet.started is already True once spawned; a greenlet which has not run yet has no frame.
+        if self._cancelled:
+            return True
+        if self.greenlet.dead or self.greenlet.gr_frame is not None:
+            return False
+        self.greenlet.kill(block=False)
+        self._cancelled = True
+        return True
+
+
+class GeventScheduler(Scheduler):
+    """
+    Runs functions in greenlets from a gevent pool, for servers such as gunicorn with gevent workers where OS threads
+    would block the event loop. Requires gevent, and the socket module to be monkey patched so requests yield.
+    """
+    name = 'gevent'
+
+    def __init__(self, max_workers: int = 100):
+        if gevent is None:
+            raise ImportError('gevent is required for the gevent scheduler')
+        self.max_workers = max_workers
+        self.pool = gevent.pool.Pool(max_workers)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> _GreenletFuture:
+        return _GreenletFuture(self.pool.spawn(fn, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        self.pool.kill(block=False)
+
+
+schedulers = {
+    'thread': ThreadScheduler,
+    'sync': SynchronousScheduler,
+    'asyncio': AsyncioScheduler,
+    'gevent': GeventScheduler,
+}
+
+current: Scheduler = ThreadScheduler()
+
+
+class SchedulerExecutor(Executor):
+    """
+    A concurrent.futures.Executor which submits to the scheduler configured at the time of each call, so it stays
+    usable after configure replaces the scheduler.
+    """
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return current.submit(fn, *args, **kwargs)
+
+
+executor = SchedulerExecutor()
+
+_lock = threading.Lock()
+
+
+def configure(backend: str = 'thread', **kwargs) -> Scheduler:
+    """
+    Choose how requests to Stripe are run concurrently: 'thread', 'sync', 'asyncio' or 'gevent'. Call once when the
+    application starts. kwargs are passed to the scheduler class.
+    """
+    global current
+    with _lock:
+        previous = current
+        current = schedulers[backend](**kwargs)
+    previous.shutdown()
+    return current
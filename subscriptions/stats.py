@@ -0,0 +1,63 @@
+import threading
+
+from typing import Any, Callable, Dict, List
+
+
+Listener = Callable[[str, str, float], None]
+
+
+class Stats:
+    """
+    Thread-safe counters, gauges and timings recorded by the library, e.g. by bulk jobs and the circuit breaker.
+    Listeners added with add_listener receive every value as it is recorded, (kind, name, value), so they can be
+    forwarded to statsd, Prometheus or similar.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+        self._listeners: List[Listener] = []
+
+    def add_listener(self, listener: Listener) -> None:
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Listener) -> None:
+        self._listeners.remove(listener)
+
+    def _notify(self, kind: str, name: str, value: float) -> None:
+        for listener in self._listeners:
+            listener(kind, name, value)
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        self._notify('counter', name, value)
+
+    def gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+        self._notify('gauge', name, value)
+
+    def timing(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timing = self._timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+        self._notify('timing', name, seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'timings': {name: dict(timing) for name, timing in self._timings.items()}}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timings.clear()
+
+
+stats = Stats()
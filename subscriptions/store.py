@@ -0,0 +1,137 @@
+import threading
+from . import _subscription_items_info
+from .types import UserProtocol, ProductSubscription, ProductIsSubscribed, Price, Product
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+object_types = ('customer', 'subscription', 'price', 'product')
+
+
+class SubscriptionStore:
+    """
+    Thread-safe in-memory copy of the customers, subscriptions, prices and products in a Stripe account.
+    It is populated by subscriptions.sync.sync_account and allows entitlement checks to be answered without calling Stripe.
+    Objects are stored as plain dicts keyed by object type and id.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._objects: Dict[str, Dict[str, Dict[str, Any]]] = {object_type: {} for object_type in object_types}
+        self._runs: Dict[str, Dict[str, str]] = {object_type: {} for object_type in object_types}
+        self._customer_subscriptions: Dict[str, Set[str]] = {}
+
+    def upsert(self, object_type: str, objs: Iterable[Dict[str, Any]],
+               run_id: Optional[str] = None) -> Tuple[List[str], List[str]]:
+        """
+        Insert or replace a batch of objects of the same type.
+        run_id marks the objects as seen by a sync run so objects missing from that run can be found with stale_ids.
+        Returns the ids which were created and the ids which changed.
+        """
+        created, updated = [], []
+        with self._lock:
+            objects = self._objects[object_type]
+            for obj in objs:
+                obj_id = obj['id']
+                existing = objects.get(obj_id)
+                if existing is None:
+                    created.append(obj_id)
+                elif existing != obj:
+                    updated.append(obj_id)
+                    if object_type == 'subscription':
+                        self._unindex_subscription(existing)
+                objects[obj_id] = obj
+                if object_type == 'subscription':
+                    self._customer_subscriptions.setdefault(obj['customer'], set()).add(obj_id)
+                if run_id:
+                    self._runs[object_type][obj_id] = run_id
+        return created, updated
+
+    def delete(self, object_type: str, ids: Iterable[str]) -> None:
+        with self._lock:
+            for obj_id in ids:
+                obj = self._objects[object_type].pop(obj_id, None)
+                self._runs[object_type].pop(obj_id, None)
+                if obj and object_type == 'subscription':
+                    self._unindex_subscription(obj)
+
+    def _unindex_subscription(self, sub: Dict[str, Any]) -> None:
+        sub_ids = self._customer_subscriptions.get(sub['customer'])
+        if sub_ids:
+            sub_ids.discard(sub['id'])
+            if not sub_ids:
+                del self._customer_subscriptions[sub['customer']]
+
+    def stale_ids(self, object_type: str, run_id: str) -> List[str]:
+        """
+        Ids of objects which were not seen during the given sync run, i.e. deleted from Stripe since the previous run.
+        """
+        with self._lock:
+            runs = self._runs[object_type]
+            return [obj_id for obj_id in self._objects[object_type] if runs.get(obj_id) != run_id]
+
+    def seen(self, object_type: str, run_id: str) -> int:
+        """
+        The number of objects in the store which were last seen during the given sync run.
+        """
+        with self._lock:
+            return sum(1 for seen_run_id in self._runs[object_type].values() if seen_run_id == run_id)
+
+    def get(self, object_type: str, obj_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._objects[object_type].get(obj_id)
+
+    def ids(self, object_type: str) -> Set[str]:
+        with self._lock:
+            return set(self._objects[object_type])
+
+    def values(self, object_type: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._objects[object_type].values())
+
+    def count(self, object_type: str) -> int:
+        with self._lock:
+            return len(self._objects[object_type])
+
+    # Local equivalents of the entitlement functions in the subscriptions module
+
+    def list_subscriptions(self, user: Optional[UserProtocol], status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        List the stored subscriptions for a user, optionally filtered by status.
+        """
+        if not user or not user.stripe_customer_id:
+            return []
+        with self._lock:
+            subscriptions = self._objects['subscription']
+            subs = [subscriptions[sub_id] for sub_id in self._customer_subscriptions.get(user.stripe_customer_id, ())]
+        return [sub for sub in subs if not status or sub['status'] == status]
+
+    def list_products_prices_subscribed_to(self, user: Optional[UserProtocol]) -> List[ProductSubscription]:
+        """
+        Same as subscriptions.list_products_prices_subscribed_to but served from the store.
+        """
+        return [info for sub in self.list_subscriptions(user, status='active')
+                for info in _subscription_items_info(sub)]
+
+    def is_subscribed_and_cancelled_time(self, user: Optional[UserProtocol], product_id: Optional[str] = None,
+                                         price_id: Optional[str] = None) -> ProductIsSubscribed:
+        """
+        Same as subscriptions.is_subscribed_and_cancelled_time but served from the store.
+        """
+        sub: ProductIsSubscribed
+        for sub in self.list_products_prices_subscribed_to(user):
+            if sub['product_id'] == product_id or sub['price_id'] == price_id:
+                return sub
+        return {'sub_id': None, 'cancel_at': None, 'current_period_end': None, 'product_id': None, 'price_id': None}
+
+    def is_subscribed(self, user: Optional[UserProtocol], product_id: Optional[str] = None,
+                      price_id: Optional[str] = None) -> bool:
+        """
+        Same as subscriptions.is_subscribed but served from the store.
+        """
+        return bool(self.is_subscribed_and_cancelled_time(user, product_id, price_id)['sub_id'])
+
+    def get_active_prices(self) -> List[Price]:
+        return [price for price in self.values('price') if price.get('active', True)]
+
+    def get_active_products(self) -> List[Product]:
+        return [product for product in self.values('product') if product.get('active', True)]
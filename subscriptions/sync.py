@@ -0,0 +1,152 @@
+import stripe
+import uuid
+from . import _minimize_price, _minimize_product, _result, _submit
+from .checkpoint import Checkpoint
+from .store import SubscriptionStore, object_types as all_object_types
+from .types import SyncReport
+
+from typing import Any, Dict, List, Optional, Sequence
+
+
+def _minimize_customer(customer: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return only the keys and values of a customer needed to serve requests locally.
+    """
+    return {'id': customer['id'],
+            'email': customer.get('email'),
+            'name': customer.get('name'),
+            'metadata': customer.get('metadata', {}),
+            'default_payment_method': (customer.get('invoice_settings') or {}).get('default_payment_method')}
+
+
+def _minimize_subscription_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    price = item['price']
+    recurring = price.get('recurring') or {}
+    return {'id': item['id'],
+            'price': price['id'],
+            'product': price.get('product'),
+            'quantity': item.get('quantity'),
+            'amount': price.get('unit_amount'),
+            'currency': price.get('currency'),
+            'interval': recurring.get('interval'),
+            'interval_count': recurring.get('interval_count')}
+
+
+def _minimize_subscription(sub: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return only the keys and values of a subscription needed to serve entitlement checks locally.
+    """
+    plan = sub.get('plan')
+    items = (sub.get('items') or {}).get('data', [])
+    return {'id': sub['id'],
+            'customer': sub['customer'],
+            'status': sub['status'],
+            'plan': {k: plan.get(k) for k in ('id', 'product', 'amount', 'currency', 'interval', 'interval_count')}
+            if plan else {},
+            'items': [_minimize_subscription_item(item) for item in items],
+            'quantity': sub.get('quantity'),
+            'default_payment_method': sub.get('default_payment_method'),
+            'cancel_at': sub.get('cancel_at'),
+            'canceled_at': sub.get('canceled_at'),
+            'current_period_start': sub.get('current_period_start'),
+            'current_period_end': sub.get('current_period_end'),
+            'created': sub.get('created')}
+
+
+def _minimize_catalog_object(minimize):
+    def minimize_with_active(obj: Dict[str, Any]) -> Dict[str, Any]:
+        minimized = minimize(obj)
+        minimized['active'] = obj.get('active', True)
+        return minimized
+    return minimize_with_active
+
+
+sources = {
+    'customer': (stripe.Customer, {}, _minimize_customer),
+    'subscription': (stripe.Subscription, {'status': 'all'}, _minimize_subscription),
+    'price': (stripe.Price, {}, _minimize_catalog_object(_minimize_price)),
+    'product': (stripe.Product, {}, _minimize_catalog_object(_minimize_product)),
+}
+
+
+updated_sample_size = 100
+
+
+def _list_page(obj_cls, page_size: int, cursor: Optional[str], **filters) -> List[Dict[str, Any]]:
+    if cursor:
+        filters['starting_after'] = cursor
+    response = obj_cls.list(limit=page_size, **filters)
+    return [obj.to_dict_recursive() for obj in response['data']]
+
+
+def sync_object_type(store: SubscriptionStore, object_type: str, page_size: int = 100, batch_size: int = 1000,
+                     checkpoint: Optional[Checkpoint] = None) -> SyncReport:
+    """
+    Stream all objects of one type from Stripe into the store.
+    The next page is requested with the scheduler while the current one is being stored, so only two pages are held in
+    memory at a time. Called from a function already running in the scheduler, such as sync_account, pages are
+    fetched one after another instead.
+    Objects are upserted in batches of batch_size and progress is saved to the checkpoint after every batch.
+    If the checkpoint contains progress from an unfinished run for this object type, the sync continues from there,
+    provided the store still holds every object stored by that run. Otherwise, such as in a new process with an empty
+    store, the sync starts again from the beginning.
+    Objects in the store which were not returned by Stripe are deleted from the store once the whole list has been read.
+    """
+    checkpoint = checkpoint or Checkpoint()
+    obj_cls, filters, minimize = sources[object_type]
+    state = checkpoint.get(object_type)
+    if state and store.seen(object_type, state['run_id']) < state['report']['fetched']:
+        state = None
+    state = state or {
+        'run_id': uuid.uuid4().hex,
+        'cursor': None,
+        'report': {'object_type': object_type, 'fetched': 0, 'created': 0, 'updated': 0, 'updated_sample': [],
+                   'deleted': []}
+    }
+    run_id = state['run_id']
+    report: SyncReport = state['report']
+    batch = []
+
+    def flush():
+        created, updated = store.upsert(object_type, batch, run_id=run_id)
+        report['fetched'] += len(batch)
+        report['created'] += len(created)
+        report['updated'] += len(updated)
+        report['updated_sample'] += updated[:updated_sample_size - len(report['updated_sample'])]
+        state['cursor'] = batch[-1]['id']
+        checkpoint.set(object_type, state)
+        batch.clear()
+
+    page = _list_page(obj_cls, page_size, state['cursor'], **filters)
+    while page:
+        next_page_future = _submit(_list_page, obj_cls, page_size, page[-1]['id'], **filters)
+        for obj in page:
+            batch.append(minimize(obj))
+            if len(batch) >= batch_size:
+                flush()
+        page = _result(next_page_future, 'sync list page')
+    if batch:
+        flush()
+
+    deleted = store.stale_ids(object_type, run_id)
+    store.delete(object_type, deleted)
+    report['deleted'] = deleted
+    checkpoint.clear(object_type)
+    return report
+
+
+def sync_account(store: SubscriptionStore, object_types: Sequence[str] = all_object_types, page_size: int = 100,
+                 batch_size: int = 1000, checkpoint: Optional[Checkpoint] = None) -> Dict[str, SyncReport]:
+    """
+    Pull every customer, subscription, price and product in the Stripe account into the store, syncing the object types
+    at the same time with the configured scheduler.
+    Returns a report per object type of how many objects were fetched, created and updated, with the ids of up to
+    updated_sample_size of the objects the store had out of date, and which objects no longer exist in Stripe (deleted).
+    Pass a Checkpoint with a path to make the sync restartable: rerunning after a failure with the same store continues
+    from the last batch.
+    """
+    checkpoint = checkpoint or Checkpoint()
+    futures = {object_type: _submit(sync_object_type, store, object_type, page_size=page_size,
+                                    batch_size=batch_size, checkpoint=checkpoint)
+               for object_type in object_types}
+    return {object_type: _result(f, f'sync {object_type}') for object_type, f in futures.items()}
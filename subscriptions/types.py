@@ -102,3 +102,82 @@ class Product(TypedDict):
 class ProductDetail(Product):
     subscription_info: SubscriptionInfo
     prices: List[PriceNoProductSubscriptionInfo]
+
+
+class SyncReport(TypedDict):
+    object_type: str
+    fetched: int
+    created: int
+    updated: int
+    updated_sample: List[str]
+    deleted: List[str]
+
+
+class BulkResult(TypedDict):
+    user_id: Any
+    customer_id: Optional[str]
+    status: Literal["updated", "skipped", "failed"]
+    subscriptions_updated: int
+    error: Optional[str]
+
+
+class RevenueMetrics(TypedDict):
+    buckets: Any
+    groups: List[tuple]
+    mrr: Any
+    arr: Any
+    active: Any
+    new_mrr: Any
+    churned_mrr: Any
+    expansion_mrr: Any
+    contraction_mrr: Any
+
+
+class RevenueMovements(TypedDict):
+    mrr_before: float
+    mrr_after: float
+    new_mrr: float
+    churned_mrr: float
+    expansion_mrr: float
+    contraction_mrr: float
+    new: int
+    churned: int
+
+
+class WriteJob(TypedDict):
+    id: int
+    operation: str
+    customer_id: str
+    args: List[Any]
+    kwargs: Dict[str, Any]
+    idempotency_key: str
+    status: Literal["pending", "running", "done", "failed"]
+    attempts: int
+    enqueued: float
+    error: Optional[str]
+
+
+class PurgeResult(TypedDict):
+    user_id: Any
+    customer_id: Optional[str]
+    status: Literal["deleted", "skipped", "failed"]
+    subscriptions_canceled: int
+    payment_methods_detached: int
+    error: Optional[str]
+
+
+class SubscriptionItemChange(TypedDict, total=False):
+    subscription_id: str
+    item_id: str
+    price_id: str
+    quantity: int
+    deleted: bool
+
+
+class SubscriptionItemsResult(TypedDict):
+    subscription_id: str
+    customer_id: Optional[str]
+    status: Literal["updated", "failed"]
+    changes: int
+    items_updated: int
+    error: Optional[str]
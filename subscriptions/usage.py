@@ -0,0 +1,228 @@
+import sqlite3
+import stripe
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from . import list_active_subscriptions
+from .cache import TTLCache
+from .exceptions import BaseStripeSubscriptionsError, StripeSubscriptionRequired, StripeUsageBackpressure
+from .ratelimit import RateLimiter
+from .stats import stats
+from .types import UserProtocol
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+retryable_errors = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError,
+                    BaseStripeSubscriptionsError)
+
+
+class UsageReporter:
+    """
+    Reports metered usage to Stripe in batches instead of with a request per event.
+    Events are added up for each subscription item and window of window seconds in a SQLite database, in memory or at
+    path so events are not lost if the process stops. Every flush_interval seconds the totals for windows which have
+    ended are sent as usage records with action increment, timestamped at the start of the window, by workers threads
+    at no more than rate requests per second. Each total is sent with its own idempotency key, kept until Stripe
+    accepts it, so totals are never counted twice when sending is retried or the process restarts.
+    At most max_pending totals can wait to be sent. When there are more, record blocks until a flush makes room, or
+    raises StripeUsageBackpressure if block is False or block_timeout passes.
+    """
+    def __init__(self, path: str = ':memory:', window: int = 60, flush_interval: float = 10, workers: int = 4,
+                 rate: float = 25, max_pending: int = 100000, block: bool = True,
+                 block_timeout: Optional[float] = None, max_attempts: int = 8, items_ttl: float = 300,
+                 start: bool = True):
+        self.window = window
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block = block
+        self.block_timeout = block_timeout
+        self.max_attempts = max_attempts
+        self.items = TTLCache(ttl=items_ttl)
+        self._limiter = RateLimiter(rate)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._closed = False
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL,
+                window INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'open',
+                idempotency_key TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS usage_open ON usage (item_id, window) WHERE status = 'open';
+        """)
+        self._open: Set[Tuple[str, int]] = {
+            (row[0], row[1]) for row in self._db.execute("SELECT item_id, window FROM usage WHERE status = 'open'")}
+        self._sending = self._db.execute("SELECT COUNT(*) FROM usage WHERE status = 'sending'").fetchone()[0]
+        self._thread = threading.Thread(target=self._run, name='stripe-usage-reporter', daemon=True)
+        if start:
+            self._thread.start()
+
+    def subscription_item(self, user: UserProtocol, price_id: Optional[str] = None,
+                          product_id: Optional[str] = None) -> str:
+        """
+        The id of the item of the user's active subscriptions for the given price or product, or the only item if
+        neither is given. Items are looked up with list_active_subscriptions and cached for items_ttl seconds.
+        Raises StripeSubscriptionRequired if the user has no such item.
+        """
+        customer_id = user.stripe_customer_id
+        items: Optional[List[Tuple[str, str, str]]] = self.items.get(customer_id) if customer_id else None
+        if items is None:
+            items = [(item['id'], item['price']['id'], item['price']['product'])
+                     for sub in list_active_subscriptions(user) for item in sub['items']['data']]
+            if customer_id:
+                self.items.set(customer_id, items)
+        matches = [item_id for item_id, item_price_id, item_product_id in items
+                   if (price_id is None or item_price_id == price_id)
+                   and (product_id is None or item_product_id == product_id)]
+        if len(matches) != 1:
+            raise StripeSubscriptionRequired(f'No single subscription item for price {price_id} or product '
+                                             f'{product_id} for customer {customer_id}')
+        return matches[0]
+
+    def record(self, user: UserProtocol, quantity: int = 1, price_id: Optional[str] = None,
+               product_id: Optional[str] = None, timestamp: Optional[float] = None) -> None:
+        """
+        Add quantity of usage at timestamp, defaulting to now, to the user's subscription item for the price or
+        product.
+        """
+        self.record_item(self.subscription_item(user, price_id, product_id), quantity, timestamp)
+
+    def record_item(self, item_id: str, quantity: int = 1, timestamp: Optional[float] = None) -> None:
+        """
+        Add quantity of usage at timestamp, defaulting to now, to a subscription item.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        window = int(timestamp) // self.window * self.window
+        key = (item_id, window)
+        deadline = None if self.block_timeout is None else time.monotonic() + self.block_timeout
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Usage reporter is closed')
+            while key not in self._open and len(self._open) + self._sending >= self.max_pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not self.block or (remaining is not None and remaining <= 0):
+                    stats.incr('usage.rejected')
+                    raise StripeUsageBackpressure(f'{self.max_pending} usage totals are waiting to be sent')
+                stats.incr('usage.blocked')
+                self._room.wait(remaining)
+            self._db.execute(
+                "INSERT INTO usage (item_id, window, quantity) VALUES (?, ?, ?) "
+                "ON CONFLICT (item_id, window) WHERE status = 'open' DO UPDATE SET quantity = quantity + ?",
+                (item_id, window, quantity, quantity))
+            self._open.add(key)
+        stats.incr('usage.events')
+
+    def _claim(self, before: Optional[int]) -> List[Tuple[int, str, int, int, str]]:
+        """
+        Mark the open totals for windows starting before the given time, or all of them, as sending, giving each an
+        idempotency key. Returns those and the totals which failed to send before.
+        """
+        prefix = f'usage-{uuid.uuid4().hex}-'
+        with self._lock:
+            claimed = self._db.execute(
+                "UPDATE usage SET status = 'sending', idempotency_key = ? || id "
+                "WHERE status = 'open' AND (? IS NULL OR window < ?)", (prefix, before, before)).rowcount
+            self._sending += claimed
+            self._open = {key for key in self._open if before is not None and key[1] >= before}
+            return self._db.execute("SELECT id, item_id, window, quantity, idempotency_key FROM usage "
+                                    "WHERE status = 'sending'").fetchall()
+
+    def _send(self, row: Tuple[int, str, int, int, str]) -> None:
+        row_id, item_id, window, quantity, idempotency_key = row
+        self._limiter.acquire()
+        try:
+            stripe.SubscriptionItem.create_usage_record(item_id, quantity=quantity, timestamp=window,
+                                                        action='increment', idempotency_key=idempotency_key)
+        except retryable_errors as e:
+            with self._lock:
+                self._db.execute('UPDATE usage SET attempts = attempts + 1, error = ? WHERE id = ?', (str(e), row_id))
+                attempts = self._db.execute('SELECT attempts FROM usage WHERE id = ?', (row_id,)).fetchone()[0]
+                if attempts < self.max_attempts:
+                    stats.incr('usage.retried')
+                    return
+                self._db.execute("UPDATE usage SET status = 'failed' WHERE id = ?", (row_id,))
+                self._sending -= 1
+                self._room.notify_all()
+            stats.incr('usage.failed')
+        except stripe.error.StripeError as e:
+            with self._lock:
+                self._db.execute("UPDATE usage SET status = 'failed', error = ? WHERE id = ?", (str(e), row_id))
+                self._sending -= 1
+                self._room.notify_all()
+            stats.incr('usage.failed')
+        else:
+            with self._lock:
+                self._db.execute('DELETE FROM usage WHERE id = ?', (row_id,))
+                self._sending -= 1
+                self._room.notify_all()
+            stats.incr('usage.records_sent')
+            stats.incr('usage.quantity_sent', quantity)
+
+    def flush(self, all_windows: bool = False) -> int:
+        """
+        Send the totals for windows which have ended, or for all windows if all_windows is True, and retry totals
+        which failed to send before. Returns the number of totals still waiting to be sent.
+        """
+        with self._flush_lock:
+            start = time.monotonic()
+            before = None if all_windows else int(time.time()) // self.window * self.window
+            rows = self._claim(before)
+            list(self._pool.map(self._send, rows))
+            stats.timing('usage.flush', time.monotonic() - start)
+            pending = self.metrics()['pending']
+        return pending
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        The number of totals which are open or waiting to be sent and the number which failed.
+        The number pending is also recorded in stats as usage.pending.
+        """
+        with self._lock:
+            pending = len(self._open) + self._sending
+            failed = self._db.execute("SELECT COUNT(*) FROM usage WHERE status = 'failed'").fetchone()[0]
+        stats.gauge('usage.pending', pending)
+        return {'pending': pending, 'failed': failed}
+
+    def close(self, timeout: Optional[float] = None) -> int:
+        """
+        Stop accepting usage and send all totals, including those for windows which have not ended yet, retrying
+        until they are sent or timeout seconds pass. Returns the number of totals which could not be sent. With a path,
+        they stay in the database and are sent by the next reporter using the same path.
+        """
+        with self._lock:
+            self._closed = True
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempts = 0
+        pending = self.flush(all_windows=True)
+        while pending and attempts < self.max_attempts and (deadline is None or time.monotonic() < deadline):
+            attempts += 1
+            time.sleep(min(2 ** attempts * 0.1, 5))
+            pending = self.flush(all_windows=True)
+        self._pool.shutdown()
+        self._db.close()
+        return pending
+
+    def __enter__(self) -> 'UsageReporter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,109 @@
+import stripe
+import threading
+import time
+from . import get_active_prices, get_active_products, scheduler, _submit, _result
+from .cache import catalog
+
+from typing import Any, Dict, Iterable, Optional
+
+
+ready = threading.Event()
+
+_status: Dict[str, Any] = {'ready': False, 'error': None, 'duration': None}
+
+
+def _open_connection(barrier: Optional[threading.Barrier], barrier_timeout: float) -> None:
+    """
+    Wait until all warm-up tasks are running in separate executor threads, then make a cheap request, so each thread
+    is started and a connection is opened for each of them at the same time.
+    """
+    if barrier:
+        try:
+            barrier.wait(timeout=barrier_timeout)
+        except threading.BrokenBarrierError:
+            pass
+    stripe.Product.list(limit=1)
+
+
+def warm_up(connections: Optional[int] = None, catalog_ttl: Optional[float] = None,
+            price_kwargs: Optional[Dict[str, Any]] = None,
+            product_kwargs: Optional[Dict[str, Any]] = None, fail_open: bool = False,
+            barrier_timeout: float = 5) -> None:
+    """
+    Prepare a worker to serve requests quickly after it starts.
+    All executor threads are started and each opens a connection to the Stripe API, so the first users do not wait
+    for TLS handshakes. connections defaults to the number of executor threads. Each thread waits up to
+    barrier_timeout seconds for the others to start before making its request.
+    Active products and prices are fetched into the catalog cache, with the given filters.
+    If catalog_ttl is given, the catalog cache is enabled with that ttl. If the catalog cache is disabled,
+    fetching the products and prices still opens connections but the results are not kept.
+    Sets the ready event when finished. If a request fails the worker stays not ready and the error is raised and
+    available from status(), unless fail_open is True, in which case it is marked ready anyway so a worker is not
+    kept out of service while Stripe is unavailable.
+    """
+    start = time.monotonic()
+    if catalog_ttl is not None:
+        catalog.ttl = catalog_ttl
+    connections = connections or scheduler.current.max_workers
+    threaded = isinstance(scheduler.current, scheduler.ThreadScheduler)
+    barrier = threading.Barrier(max(connections - 2, 1)) if threaded else None
+    futures = [_submit(get_active_products, **(product_kwargs or {})),
+               _submit(get_active_prices, **(price_kwargs or {}))]
+    futures += [_submit(_open_connection, barrier, barrier_timeout) for _ in range(connections - 2)]
+    succeeded = False
+    try:
+        for future in futures:
+            _result(future, 'warm_up')
+        succeeded = True
+        _status['error'] = None
+    except Exception as e:
+        _status['error'] = str(e)
+        raise
+    finally:
+        _status['duration'] = time.monotonic() - start
+        if succeeded or fail_open:
+            _status['ready'] = True
+            ready.set()
+
+
+def warm_up_in_background(retry_interval: Optional[float] = 10, **kwargs) -> threading.Thread:
+    """
+    Run warm_up in a background thread, e.g. when a worker process starts. kwargs are passed to warm_up.
+    If warm-up fails, it is tried again every retry_interval seconds until it succeeds, unless retry_interval is None.
+    Use is_ready or readiness_app to tell when it has finished.
+    """
+    def run():
+        while True:
+            try:
+                warm_up(**kwargs)
+                return
+            except Exception:
+                if retry_interval is None or is_ready():
+                    return
+            time.sleep(retry_interval)
+    thread = threading.Thread(target=run, name='stripe-subscriptions-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready() -> bool:
+    return ready.is_set()
+
+
+def status() -> Dict[str, Any]:
+    """
+    Whether warm-up has finished, how long it took and the error if it failed.
+    """
+    return dict(_status)
+
+
+def readiness_app(environ, start_response) -> Iterable[bytes]:
+    """
+    WSGI app for a load balancer readiness check. Returns 200 once warm-up has succeeded and 503 before or if it
+    failed.
+    """
+    if is_ready():
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ready']
+    start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+    return [b'warm-up failed' if _status['error'] else b'warming up']
@@ -0,0 +1,51 @@
+import logging
+import stripe
+
+from typing import Any, Callable, Dict, List, Mapping, Optional, Union
+
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Mapping[str, Any]], None]
+
+handlers: Dict[str, List[Handler]] = {}
+
+
+def on(*event_types: str) -> Callable[[Handler], Handler]:
+    """
+    Decorator to register a function to be called with each Stripe event of the given types passed to handle_event.
+    The library registers its own handlers to keep its caches up to date.
+    """
+    def decorator(f: Handler) -> Handler:
+        for event_type in event_types:
+            handlers.setdefault(event_type, []).append(f)
+        return f
+    return decorator
+
+
+def handle_event(event: Mapping[str, Any]) -> None:
+    """
+    Call the handlers registered for the event's type.
+    Pass every event received by the webhook endpoint, after verifying it with construct_event.
+    A handler which raises does not stop the handlers after it being called. Each exception is logged and the first
+    one is raised again once every handler has run.
+    """
+    error: Optional[BaseException] = None
+    for handler in handlers.get(event['type'], []):
+        try:
+            handler(event)
+        except Exception as e:
+            logger.exception('Webhook handler %r failed for %s event %s', handler, event['type'], event.get('id'))
+            error = error or e
+    if error is not None:
+        raise error
+
+
+def construct_event(payload: Union[bytes, str], sig_header: str, secret: str) -> stripe.Event:
+    """
+    Verify the signature of a webhook request, then call the handlers for the event.
+    Raises stripe.error.SignatureVerificationError if the signature is invalid.
+    """
+    event = stripe.Webhook.construct_event(payload, sig_header, secret)
+    handle_event(event)
+    return event
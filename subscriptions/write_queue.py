@@ -0,0 +1,311 @@
+import contextvars
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import stripe
+import threading
+import time
+import uuid
+from . import User, modify_subscription, update_default_payment_method_all_subscriptions, detach_all_payment_methods
+from .entitlements import entitlements
+from .exceptions import BaseStripeSubscriptionsError, StripeCircuitOpen, StripeDeadlineExceeded
+from .http import WrappedHTTPClient, install
+from .ratelimit import RateLimiter
+from .stats import stats
+from .store import SubscriptionStore
+from .types import UserProtocol, WriteJob
+
+from typing import Any, Callable, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+_idempotency_key: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_idempotency_key',
+                                                                  default=None)
+_limiter: contextvars.ContextVar = contextvars.ContextVar('stripe_subscriptions_write_queue_limiter', default=None)
+
+
+class IdempotencyHTTPClient(WrappedHTTPClient):
+    """
+    While a queued write runs, sets the Idempotency-Key of each POST request to the write's key combined with a hash of
+    the request. When a write is retried after some of its requests succeeded, Stripe returns the saved responses for
+    those requests instead of making the changes again.
+    Each request also takes a token from the queue's rate limiter, as one write can make several requests.
+    """
+    def request_with_retries(self, method, url, headers, post_data=None):
+        limiter = _limiter.get()
+        if limiter is not None:
+            limiter.acquire()
+        key = _idempotency_key.get()
+        if key is not None and method.lower() == 'post':
+            digest = hashlib.sha256(f'{url}?{post_data or ""}'.encode()).hexdigest()[:16]
+            headers = {**headers, 'Idempotency-Key': f'{key}-{digest}'}
+        return self.client.request_with_retries(method, url, headers, post_data)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _install() -> None:
+    global _installed
+    with _install_lock:
+        if not _installed:
+            install(IdempotencyHTTPClient)
+            _installed = True
+
+
+def _optimistic_update_default_payment_method(store: SubscriptionStore, customer_id: str,
+                                              default_payment_method: str) -> None:
+    customer = store.get('customer', customer_id)
+    if customer:
+        store.upsert('customer', [{**customer, 'default_payment_method': default_payment_method}])
+    subs = store.list_subscriptions(User(None, None, customer_id))
+    store.upsert('subscription', [{**sub, 'default_payment_method': default_payment_method} for sub in subs])
+
+
+def _optimistic_modify_subscription(store: SubscriptionStore, customer_id: str, subscription_id: str,
+                                    set_as_default_payment_method: bool = False, **kwargs) -> None:
+    sub = store.get('subscription', subscription_id)
+    if sub and sub['customer'] == customer_id:
+        store.upsert('subscription', [{**sub, **{k: v for k, v in kwargs.items() if k in sub}}])
+    if set_as_default_payment_method and kwargs.get('default_payment_method'):
+        _optimistic_update_default_payment_method(store, customer_id, kwargs['default_payment_method'])
+
+
+operations: Dict[str, Callable] = {
+    'modify_subscription': modify_subscription,
+    'update_default_payment_method_all_subscriptions': update_default_payment_method_all_subscriptions,
+    'detach_all_payment_methods': detach_all_payment_methods,
+}
+
+optimistic_updates: Dict[str, Callable] = {
+    'modify_subscription': _optimistic_modify_subscription,
+    'update_default_payment_method_all_subscriptions': _optimistic_update_default_payment_method,
+}
+
+retryable_errors = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError,
+                    StripeCircuitOpen, StripeDeadlineExceeded)
+
+
+def register_operation(name: str, f: Callable, optimistic_update: Optional[Callable] = None) -> None:
+    """
+    Allow a function taking a user as its first argument to be queued with WriteQueue.enqueue.
+    optimistic_update is called with the store, the customer id and the same arguments when the write is enqueued.
+    """
+    operations[name] = f
+    if optimistic_update:
+        optimistic_updates[name] = optimistic_update
+
+
+class WriteQueue:
+    """
+    Durable queue of writes to Stripe which do not need to finish before responding to the user, stored in the SQLite
+    database at path.
+    Writes are run by background threads, sending no more than rate requests per second. Writes failing with a
+    connection error, rate limit error, Stripe server error, open circuit breaker or exceeded deadline are retried
+    with exponential backoff up to max_attempts times. Other errors fail the write straight away. Each write has an
+    idempotency key which is sent with its requests to Stripe, so a write can safely run again after a retry or after
+    the process restarts part way through.
+    Writes for the same customer run one at a time in the order they were enqueued, so a later write waits while an
+    earlier one is retried. A write which fails does not stop later ones.
+    Writes which were running when the process stopped are run again when a queue is created with the same path.
+    If a store is given, it is updated as soon as a write is enqueued so local reads reflect the change, and the
+    user's cached entitlements are cleared.
+    """
+    def __init__(self, path: str, workers: int = 2, rate: float = 25, max_attempts: int = 8,
+                 backoff: float = 1, max_backoff: float = 300, store: Optional[SubscriptionStore] = None,
+                 start: bool = True):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.store = store
+        self.listeners: List[Callable[[WriteJob], None]] = []
+        self._callbacks: Dict[int, Callable[[WriteJob], None]] = {}
+        self._limiter = RateLimiter(rate)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS writes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                operation TEXT NOT NULL,
+                customer_id TEXT NOT NULL,
+                args TEXT NOT NULL,
+                kwargs TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued REAL NOT NULL,
+                next_attempt REAL NOT NULL,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS writes_pending ON writes (status, next_attempt);
+            CREATE INDEX IF NOT EXISTS writes_customer ON writes (customer_id, status, id);
+            UPDATE writes SET status = 'pending' WHERE status = 'running';
+        """)
+        _install()
+        self._threads = [threading.Thread(target=self._work, name=f'stripe-write-queue-{i}', daemon=True)
+                         for i in range(workers)]
+        if start:
+            self.start()
+
+    def start(self) -> None:
+        for thread in self._threads:
+            if not thread.is_alive():
+                thread.start()
+
+    def enqueue(self, operation: str, user: UserProtocol, *args, idempotency_key: Optional[str] = None,
+                callback: Optional[Callable[[WriteJob], None]] = None, **kwargs) -> int:
+        """
+        Queue operation(user, *args, **kwargs) and return the write's id. args and kwargs must be JSON serializable.
+        Enqueuing again with the same idempotency_key returns the id of the existing write instead of adding another.
+        callback is called with the finished write when it is done or has failed. Callbacks are not stored in the
+        database so are lost if the process stops; add a listener to be told about writes from before a restart.
+        """
+        if operation not in operations:
+            raise ValueError(f'{operation} is not a queueable operation')
+        if not user.stripe_customer_id:
+            raise ValueError('A customer id is required to queue writes for a user')
+        now = time.time()
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+        with self._lock:
+            row = self._db.execute('SELECT id FROM writes WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+            if row:
+                return row['id']
+            job_id = self._db.execute(
+                'INSERT INTO writes (operation, customer_id, args, kwargs, idempotency_key, enqueued, next_attempt) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (operation, user.stripe_customer_id, json.dumps(args), json.dumps(kwargs), idempotency_key, now,
+                 now)).lastrowid
+            if callback:
+                self._callbacks[job_id] = callback
+            self._wake.notify()
+        stats.incr('write_queue.enqueued')
+        if self.store and operation in optimistic_updates:
+            optimistic_updates[operation](self.store, user.stripe_customer_id, *args, **kwargs)
+        entitlements.delete(user.stripe_customer_id)
+        return job_id
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """
+        Mark the next write which is due as running and return it, waiting until one is due or the queue is closed.
+        Only the oldest unfinished write for each customer can be claimed.
+        """
+        with self._lock:
+            while not self._closed:
+                now = time.time()
+                row = self._db.execute(
+                    "SELECT * FROM writes AS w WHERE status = 'pending' AND NOT EXISTS ("
+                    "SELECT 1 FROM writes AS o WHERE o.customer_id = w.customer_id AND o.id < w.id "
+                    "AND o.status IN ('pending', 'running')) ORDER BY next_attempt LIMIT 1").fetchone()
+                if row and row['next_attempt'] <= now:
+                    self._db.execute("UPDATE writes SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+                                     (row['id'],))
+                    return row
+                self._wake.wait(timeout=min(row['next_attempt'] - now, 1) if row else 1)
+        return None
+
+    def _finish(self, row: sqlite3.Row, status: str, error: Optional[str] = None,
+                next_attempt: Optional[float] = None) -> None:
+        with self._lock:
+            self._db.execute('UPDATE writes SET status = ?, error = ?, next_attempt = COALESCE(?, next_attempt) '
+                             'WHERE id = ?', (status, error, next_attempt, row['id']))
+            self._wake.notify()
+            if status == 'pending':
+                return
+            callback = self._callbacks.pop(row['id'], None)
+        job = self.get(row['id'])
+        for listener in ([callback] if callback else []) + self.listeners:
+            try:
+                listener(job)
+            except Exception:
+                stats.incr('write_queue.listener_errors')
+                logger.exception('Write queue listener %r failed for write %s', listener, row['id'])
+
+    def _run(self, row: sqlite3.Row) -> None:
+        stats.timing('write_queue.lag', time.time() - row['enqueued'])
+        _limiter.set(self._limiter)
+        token = _idempotency_key.set(row['idempotency_key'])
+        try:
+            f = operations[row['operation']]
+            f(User(None, None, row['customer_id']), *json.loads(row['args']), **json.loads(row['kwargs']))
+        except retryable_errors as e:
+            attempts = row['attempts'] + 1
+            if attempts >= self.max_attempts:
+                stats.incr('write_queue.failed')
+                self._finish(row, 'failed', str(e))
+            else:
+                stats.incr('write_queue.retried')
+                delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff) * random.uniform(0.5, 1)
+                self._finish(row, 'pending', str(e), time.time() + delay)
+        except (Exception, BaseStripeSubscriptionsError) as e:
+            stats.incr('write_queue.failed')
+            self._finish(row, 'failed', str(e))
+        else:
+            stats.incr('write_queue.done')
+            self._finish(row, 'done')
+        finally:
+            _idempotency_key.reset(token)
+
+    def _work(self) -> None:
+        while True:
+            row = self._claim()
+            if row is None:
+                return
+            contextvars.copy_context().run(self._run, row)
+
+    def get(self, job_id: int) -> Optional[WriteJob]:
+        with self._lock:
+            row = self._db.execute('SELECT * FROM writes WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'id': row['id'], 'operation': row['operation'], 'customer_id': row['customer_id'],
+                'args': json.loads(row['args']), 'kwargs': json.loads(row['kwargs']),
+                'idempotency_key': row['idempotency_key'], 'status': row['status'],
+                'attempts': row['attempts'], 'enqueued': row['enqueued'], 'error': row['error']}
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        The number of writes waiting to run, the age in seconds of the oldest one and the numbers done and failed.
+        Queue depth and lag are also recorded in stats as write_queue.depth and write_queue.lag.
+        """
+        with self._lock:
+            counts = dict(self._db.execute('SELECT status, COUNT(*) FROM writes GROUP BY status').fetchall())
+            oldest = self._db.execute(
+                "SELECT MIN(enqueued) FROM writes WHERE status IN ('pending', 'running')").fetchone()[0]
+        depth = counts.get('pending', 0) + counts.get('running', 0)
+        stats.gauge('write_queue.depth', depth)
+        return {'depth': depth,
+                'lag': time.time() - oldest if oldest else 0.0,
+                'done': counts.get('done', 0),
+                'failed': counts.get('failed', 0)}
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until no writes are pending or running. Returns False if the timeout passed first.
+        Writes waiting to be retried count as pending.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.metrics()['depth']:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the worker threads once they finish their current write. Pending writes stay in the database.
+        """
+        with self._lock:
+            self._closed = True
+            self._wake.notify_all()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout)
+        self._db.close()
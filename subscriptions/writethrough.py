@@ -0,0 +1,118 @@
+import copy
+from functools import wraps
+from .cache import current_request_cache, no_subscriptions, owners
+from .entitlements import entitlements
+
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+
+def _matches_status(sub: Mapping[str, Any], kwargs: Dict[str, Any]) -> Optional[bool]:
+    """
+    Whether a subscription belongs in the results of list_subscriptions with the given filters, or None if that
+    cannot be known without asking Stripe. Stripe leaves out canceled subscriptions unless a status is given.
+    """
+    if set(kwargs) - {'status'}:
+        return None
+    status = kwargs.get('status')
+    if status is None:
+        return sub['status'] not in ('canceled', 'incomplete_expired')
+    return status == 'all' or sub['status'] == status
+
+
+def _replace(objs: List[Mapping[str, Any]], obj: Mapping[str, Any], include: bool) -> List[Mapping[str, Any]]:
+    """
+    Put obj in place of the object with the same id, or first as Stripe lists the newest objects first, or remove it
+    if include is False.
+    """
+    ids = [o['id'] for o in objs]
+    if obj['id'] in ids:
+        index = ids.index(obj['id'])
+        return objs[:index] + ([obj] if include else []) + objs[index + 1:]
+    return [obj] + objs if include else objs
+
+
+def _subscription_written(customer_id: str, sub: Mapping[str, Any]) -> None:
+    from . import list_subscriptions, _subscription_items_info
+    cache = current_request_cache()
+    if cache:
+        def update(kwargs: Dict[str, Any], args: tuple, subs: List[Mapping[str, Any]]):
+            include = _matches_status(sub, kwargs)
+            return None if include is None else _replace(subs, sub, include)
+        cache.update(list_subscriptions, customer_id, update)
+    subscribed_to = entitlements.get(customer_id)
+    if subscribed_to is not None:
+        subscribed_to = [s for s in subscribed_to if s['sub_id'] != sub['id']]
+        if sub['status'] == 'active':
+            subscribed_to.extend(_subscription_items_info(sub))
+        entitlements.set(customer_id, subscribed_to)
+    if sub['status'] != 'canceled':
+        no_subscriptions.delete(customer_id)
+
+
+def _payment_method_written(customer_id: str, payment_method: Mapping[str, Any]) -> None:
+    from . import list_payment_methods
+    cache = current_request_cache()
+    if cache:
+        def update(kwargs: Dict[str, Any], args: tuple, payment_methods: List[Mapping[str, Any]]):
+            ids = [pm['id'] for pm in payment_methods]
+            if payment_method['customer'] != customer_id:
+                return _replace(payment_methods, payment_method, False)
+            if payment_method['id'] not in ids:
+                return None
+            previous = payment_methods[ids.index(payment_method['id'])]
+            return _replace(payment_methods, {**payment_method, 'default': previous.get('default', False)}, True)
+        cache.update(list_payment_methods, customer_id, update)
+
+
+def _customer_written(customer_id: str, customer: Mapping[str, Any]) -> None:
+    from . import list_payment_methods
+    cache = current_request_cache()
+    if cache:
+        default_payment_method = (customer.get('invoice_settings') or {}).get('default_payment_method')
+
+        def update(kwargs: Dict[str, Any], args: tuple, payment_methods: List[Mapping[str, Any]]):
+            return [{**pm, 'default': pm['id'] == default_payment_method} for pm in payment_methods]
+        cache.update(list_payment_methods, customer_id, update)
+
+
+object_handlers: Dict[str, Callable[[str, Mapping[str, Any]], None]] = {
+    'subscription': _subscription_written,
+    'payment_method': _payment_method_written,
+    'customer': _customer_written,
+}
+
+
+def write_through(customer_id: str, obj: Mapping[str, Any]) -> None:
+    """
+    Apply an object returned by a Stripe write for a customer to the local caches: the results memoized in the active
+    request cache, the entitlements cache, the negative cache and the ownership cache.
+    Writes of other types of object clear the request cache instead.
+    """
+    obj = copy.deepcopy(obj)
+    owner = obj.get('customer')
+    owners.set((obj['object'], obj['id']), owner if isinstance(owner, str) or owner is None else owner['id'])
+    handler = object_handlers.get(obj['object'])
+    if handler:
+        handler(customer_id, obj)
+    else:
+        cache = current_request_cache()
+        if cache:
+            cache.clear()
+
+
+def writes_through(f: Callable):
+    """
+    Decorator for functions taking a user and returning the Stripe object, or list of objects, they created, changed or
+    deleted. The objects are fed into the local caches with write_through instead of clearing them, so reads right
+    after the write are still served locally.
+    """
+    @wraps(f)
+    def wrapper(user: Any, *args, **kwargs):
+        result = f(user, *args, **kwargs)
+        customer_id = getattr(user, 'stripe_customer_id', None)
+        if customer_id:
+            for obj in result if isinstance(result, list) else [result]:
+                if isinstance(obj, Mapping) and 'object' in obj and 'id' in obj:
+                    write_through(customer_id, obj)
+        return result
+    return wrapper
@@ -0,0 +1,186 @@
+import json
+import stripe
+import threading
+import time
+
+from subscriptions import User, scheduler
+from subscriptions.bulk import (run_bulk, bulk_update_default_payment_method, purge_customers, batches,
+                               update_subscription_items, _coalesce_item_changes, _group_by_subscription, _list_all)
+from subscriptions.cache import no_subscriptions, owners, request_cache
+from subscriptions.checkpoint import Checkpoint
+from subscriptions.entitlements import entitlements
+
+
+def test_run_bulk_resumes_from_checkpoint(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.set('test', 5)
+    results = run_bulk(range(10), lambda i: i * 2, 'test', max_workers=2, checkpoint=checkpoint)
+    assert sorted(results) == [10, 12, 14, 16, 18]
+    assert checkpoint.get('test') is None
+
+
+def test_bulk_update_default_payment_method(user_with_customer_id, payment_method_for_customer,
+                                            default_payment_method_for_customer, subscription):
+    results = list(bulk_update_default_payment_method([(user_with_customer_id, payment_method_for_customer['id'])]))
+    assert results == [{'user_id': user_with_customer_id.id, 'customer_id': user_with_customer_id.stripe_customer_id,
+                        'status': 'updated', 'subscriptions_updated': 1, 'error': None}]
+    customer = stripe.Customer.retrieve(user_with_customer_id.stripe_customer_id)
+    assert customer['invoice_settings']['default_payment_method'] == payment_method_for_customer['id']
+    subscription = stripe.Subscription.retrieve(subscription['id'])
+    assert subscription['default_payment_method'] == payment_method_for_customer['id']
+    results = list(bulk_update_default_payment_method([(user_with_customer_id, payment_method_for_customer['id'])]))
+    assert results[0]['status'] == 'skipped'
+
+
+def test_purge_customers_resumes_from_log(tmp_path):
+    log_path = tmp_path / 'purge.jsonl'
+    result = {'user_id': None, 'customer_id': 'cus_1', 'status': 'deleted', 'subscriptions_canceled': 0,
+              'payment_methods_detached': 0, 'error': None}
+    log_path.write_text(json.dumps(result) + '\n')
+    assert list(purge_customers(['cus_1'], log_path=str(log_path))) == [result]
+    assert [len(batch) for batch in batches(range(5), size=2)] == [2, 2, 1]
+
+
+def test_purge_customers(user_with_customer_id, subscription, tmp_path):
+    customer_id = user_with_customer_id.stripe_customer_id
+    log_path = str(tmp_path / 'purge.jsonl')
+    results = list(purge_customers([user_with_customer_id], cancel_subscriptions=True, log_path=log_path))
+    assert results == [{'user_id': user_with_customer_id.id, 'customer_id': customer_id, 'status': 'deleted',
+                        'subscriptions_canceled': 1, 'payment_methods_detached': 0, 'error': None}]
+    assert user_with_customer_id.stripe_customer_id is None
+    assert stripe.Customer.retrieve(customer_id)['deleted']
+    assert list(purge_customers([customer_id]))[0]['status'] == 'skipped'
+
+
+def test_subscription_item_changes_coalesced():
+    changes = [{'subscription_id': 'sub_1', 'item_id': 'si_1', 'quantity': 2},
+               {'subscription_id': 'sub_2', 'price_id': 'price_1', 'quantity': 1},
+               {'subscription_id': 'sub_1', 'price_id': 'price_2', 'quantity': 3},
+               {'subscription_id': 'sub_1', 'item_id': 'si_1', 'quantity': 5}]
+    assert list(_group_by_subscription(changes, window=10)) == [('sub_1', [changes[0], changes[2], changes[3]]),
+                                                                ('sub_2', [changes[1]])]
+    assert _coalesce_item_changes([changes[0], changes[2], changes[3]]) == [
+        {'subscription_id': 'sub_1', 'item_id': 'si_1', 'quantity': 5},
+        {'subscription_id': 'sub_1', 'price_id': 'price_2', 'quantity': 3}]
+
+
+def test_update_subscription_items(subscription, stripe_price_id, stripe_unsubscribed_price_id):
+    changes = [{'subscription_id': subscription['id'], 'price_id': stripe_price_id, 'quantity': 2},
+               {'subscription_id': subscription['id'], 'price_id': stripe_unsubscribed_price_id, 'quantity': 1},
+               {'subscription_id': subscription['id'], 'price_id': stripe_price_id, 'quantity': 3}]
+    results = list(update_subscription_items(changes, proration_behavior='none'))
+    assert results == [{'subscription_id': subscription['id'], 'customer_id': subscription['customer'],
+                        'status': 'updated', 'changes': 3, 'items_updated': 2, 'error': None}]
+    items = stripe.Subscription.retrieve(subscription['id'])['items']['data']
+    assert sorted((item['price']['id'], item['quantity']) for item in items) == sorted(
+        [(stripe_price_id, 3), (stripe_unsubscribed_price_id, 1)])
+
+
+def test_update_subscription_items_in_order_and_merged_by_item(monkeypatch):
+    requests = []
+
+    def retrieve(subscription_id):
+        return {'items': {'data': [{'id': 'si_1', 'price': {'id': 'price_1'}}]}}
+
+    def modify(subscription_id, items, **kwargs):
+        if not requests:
+            time.sleep(0.1)
+        requests.append((subscription_id, items))
+        return {'customer': 'cus_1'}
+
+    monkeypatch.setattr(stripe.Subscription, 'retrieve', retrieve)
+    monkeypatch.setattr(stripe.Subscription, 'modify', modify)
+    changes = [{'subscription_id': 'sub_1', 'item_id': 'si_1', 'quantity': 2},
+               {'subscription_id': 'sub_1', 'price_id': 'price_1', 'quantity': 3},
+               {'subscription_id': 'sub_1', 'item_id': 'si_1', 'quantity': 4}]
+    results = list(update_subscription_items(changes, window=2, max_workers=4))
+    assert [result['status'] for result in results] == ['updated', 'updated']
+    assert requests == [('sub_1', [{'id': 'si_1', 'quantity': 3}]), ('sub_1', [{'id': 'si_1', 'quantity': 4}])]
+
+
+def test_run_bulk_nested_submissions_do_not_deadlock(monkeypatch):
+    from subscriptions import _result, _submit
+    monkeypatch.setattr(scheduler, 'current', scheduler.ThreadScheduler(max_workers=2))
+
+    def nested(i):
+        return _result(_submit(lambda: i * 2), 'nested')
+
+    try:
+        assert sorted(run_bulk(range(6), nested, 'test.nested', max_workers=4)) == [0, 2, 4, 6, 8, 10]
+    finally:
+        scheduler.current.shutdown()
+
+
+def test_list_all_waits_for_limiter_per_page():
+    pages = [{'data': [{'id': 'sub_1'}, {'id': 'sub_2'}], 'has_more': True},
+             {'data': [{'id': 'sub_3'}], 'has_more': False}]
+    calls = []
+
+    class Limiter:
+        acquired = 0
+
+        def acquire(self):
+            self.acquired += 1
+
+    class Subscription:
+        @staticmethod
+        def list(**params):
+            calls.append(params)
+            return pages[len(calls) - 1]
+
+    limiter = Limiter()
+    assert [sub['id'] for sub in _list_all(limiter, Subscription, customer='cus_1')] == ['sub_1', 'sub_2', 'sub_3']
+    assert limiter.acquired == 2
+    assert calls[1] == {'limit': 100, 'starting_after': 'sub_2', 'customer': 'cus_1'}
+
+
+def test_purge_customers_clears_customer_caches(monkeypatch):
+    user = User(1, 'user@example.com', 'cus_1')
+    monkeypatch.setattr(stripe.Subscription, 'list', lambda **params: {'data': [{'id': 'sub_1'}], 'has_more': False})
+    monkeypatch.setattr(stripe.Subscription, 'delete', lambda sub_id: {'id': sub_id})
+    monkeypatch.setattr(stripe.PaymentMethod, 'list', lambda **params: {'data': [], 'has_more': False})
+    monkeypatch.setattr(stripe.Customer, 'delete', lambda customer_id: {'id': customer_id, 'deleted': True})
+    monkeypatch.setattr(entitlements, 'ttl', 300)
+    no_subscriptions.ttl = owners.ttl = 60
+    try:
+        with request_cache() as cache:
+            cache.call(lambda user: ['sub_1'], user)
+            entitlements.set('cus_1', [])
+            no_subscriptions.add('cus_1', 'key')
+            owners.set(('subscription', 'sub_1'), 'cus_1')
+            results = list(purge_customers([user], cancel_subscriptions=True))
+            assert results[0]['status'] == 'deleted'
+            assert not cache._futures
+        assert entitlements.get('cus_1') is None
+        assert not no_subscriptions.contains('cus_1', 'key')
+        assert owners.get(('subscription', 'sub_1')) is None
+    finally:
+        no_subscriptions.ttl = owners.ttl = 0
+
+
+def test_update_subscription_items_resumes_from_checkpoint(monkeypatch):
+    requests = []
+    monkeypatch.setattr(stripe.Subscription, 'retrieve', lambda subscription_id: {'items': {'data': []}})
+
+    def modify(subscription_id, items, **kwargs):
+        requests.append((subscription_id, items))
+        return {'customer': 'cus_1'}
+
+    monkeypatch.setattr(stripe.Subscription, 'modify', modify)
+    checkpoint = Checkpoint()
+    checkpoint.set('bulk.subscription_items', 1)
+    changes = [{'subscription_id': 'sub_A', 'item_id': 'si_1', 'quantity': 2},
+               {'subscription_id': 'sub_B', 'item_id': 'si_2', 'quantity': 3},
+               {'subscription_id': 'sub_A', 'item_id': 'si_1', 'quantity': 4}]
+    results = []
+
+    def consume():
+        results.extend(update_subscription_items(changes, window=1, max_workers=2, checkpoint=checkpoint))
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [result['status'] for result in results] == ['updated', 'updated']
+    assert sorted(requests) == [('sub_A', [{'id': 'si_1', 'quantity': 4}]), ('sub_B', [{'id': 'si_2', 'quantity': 3}])]
+    assert checkpoint.get('bulk.subscription_items') is None
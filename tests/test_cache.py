@@ -0,0 +1,126 @@
+import subscriptions
+from subscriptions import webhooks
+from subscriptions.cache import (TTLCache, NegativeCache, request_cache, request_memoize, clears_request_cache,
+                                 negative_memoize, no_subscriptions)
+
+
+calls = []
+
+
+@request_memoize
+def memoized(user, value):
+    calls.append(value)
+    return {'value': value}
+
+
+@request_memoize
+def memoized_generator(user, values):
+    calls.append(values)
+    yield from values
+
+
+@clears_request_cache
+def mutation(user):
+    pass
+
+
+def setup_function():
+    calls.clear()
+
+
+def test_request_memoize_outside_request_cache():
+    memoized(None, 1)
+    memoized(None, 1)
+    assert calls == [1, 1]
+
+
+def test_request_memoize():
+    with request_cache():
+        result = memoized(None, 1)
+        result['value'] = 2
+        assert memoized(None, 1) == {'value': 1}
+        memoized(None, 2)
+    memoized(None, 1)
+    assert calls == [1, 2, 1]
+
+
+def test_request_memoize_generator():
+    with request_cache():
+        assert list(memoized_generator(None, [1, 2])) == [1, 2]
+        assert list(memoized_generator(None, [1, 2])) == [1, 2]
+    assert calls == [[1, 2]]
+
+
+def test_request_memoize_threads():
+    with request_cache():
+        futures = [subscriptions._submit(memoized, None, 1) for _ in range(10)]
+        results = [f.result() for f in futures]
+    assert results == [{'value': 1}] * 10
+    assert calls == [1]
+
+
+def test_clears_request_cache():
+    with request_cache():
+        memoized(None, 1)
+        mutation(None)
+        memoized(None, 1)
+    assert calls == [1, 1]
+
+
+def test_is_subscribed_request_cache(user_with_customer_id, subscription, stripe_subscription_product_id,
+                                     stripe_unsubscribed_product_id):
+    with request_cache() as cache:
+        assert subscriptions.is_subscribed(user_with_customer_id, stripe_subscription_product_id)
+        assert not subscriptions.is_subscribed(user_with_customer_id, stripe_unsubscribed_product_id)
+        assert len(cache._futures) == 1
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.get('b', max_age=0) is None
+    cache.delete('b')
+    assert cache.get('b') is None
+    assert len(cache) == 1
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache(ttl=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+def test_negative_memoize():
+    cache = NegativeCache(ttl=60)
+    results = {'cus_1': []}
+
+    @negative_memoize(cache)
+    def list_things(user, **kwargs):
+        calls.append(user.stripe_customer_id)
+        return results[user.stripe_customer_id]
+
+    calls.clear()
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    assert list_things(user, status='active') == []
+    results['cus_1'] = ['thing']
+    assert list_things(user, status='active') == []
+    assert list_things(user, status='all') == ['thing']
+    cache.delete('cus_1')
+    assert list_things(user, status='active') == ['thing']
+    assert calls == ['cus_1', 'cus_1', 'cus_1']
+
+
+def test_no_subscriptions_invalidated_by_webhook():
+    no_subscriptions.ttl = 60
+    try:
+        no_subscriptions.add('cus_1', 'key')
+        webhooks.handle_event({'type': 'customer.subscription.created',
+                               'data': {'object': {'object': 'subscription', 'customer': 'cus_1'}}})
+        assert not no_subscriptions.contains('cus_1', 'key')
+    finally:
+        no_subscriptions.ttl = 0
+        no_subscriptions.clear()
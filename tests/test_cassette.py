@@ -0,0 +1,27 @@
+import json
+import pytest
+import stripe
+
+import subscriptions
+from subscriptions import cassette
+
+
+def test_replay_matches_normalised_params(tmp_path):
+    path = str(tmp_path / 'cassette.json')
+    body = json.dumps({'object': 'list', 'data': [{'id': 'price_1', 'object': 'price'}], 'has_more': False,
+                       'url': '/v1/prices'})
+    with open(path, 'w') as f:
+        json.dump({'version': 1, 'interactions': [{'request': 'GET /v1/prices?active=True&limit=3', 'status': 200,
+                                                   'body': body, 'latency': 0.5, 'headers': {}}]}, f)
+    with cassette.replaying(path, latency_scale=0):
+        assert stripe.Price.list(limit=3, active=True, api_key='sk_test_replay')['data'][0]['id'] == 'price_1'
+        with pytest.raises(subscriptions.exceptions.StripeCassetteMiss):
+            stripe.Price.list(limit=4, api_key='sk_test_replay')
+
+
+def test_record_and_replay(tmp_path, user_with_customer_id, subscription):
+    path = str(tmp_path / 'cassette.json.gz')
+    with cassette.recording(path):
+        recorded = subscriptions.get_subscription_products_and_prices(user_with_customer_id)
+    with cassette.replaying(path, latency_scale=0):
+        assert subscriptions.get_subscription_products_and_prices(user_with_customer_id) == recorded
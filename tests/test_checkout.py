@@ -0,0 +1,78 @@
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+import subscriptions
+from subscriptions import webhooks
+from subscriptions.checkout import CheckoutSessionIndex, checkout_sessions
+
+
+def test_checkout_session_evicted_by_webhook():
+    index = CheckoutSessionIndex(ttl=60)
+    session = {'id': 'cs_1', 'status': 'open', 'expires_at': time.time() + 3600}
+    index.add('key', {**session, 'expires_at': time.time() + 60})
+    assert index.find('key') is None
+    checkout_sessions.ttl = 60
+    try:
+        checkout_sessions.add('key', session)
+        assert checkout_sessions.find('key') == session
+        webhooks.handle_event({'type': 'checkout.session.completed', 'data': {'object': {'id': 'cs_1'}}})
+        assert checkout_sessions.find('key') is None
+    finally:
+        checkout_sessions.ttl = 0
+        checkout_sessions.clear()
+
+
+def test_create_subscription_checkout_reuses_session(user_with_customer_id, stripe_price_id, checkout_success_url,
+                                                     checkout_cancel_url, payment_method_types):
+    checkout_sessions.ttl = 3600
+    try:
+        checkouts = [subscriptions.create_subscription_checkout(user_with_customer_id, stripe_price_id,
+                                                                success_url=checkout_success_url,
+                                                                cancel_url=checkout_cancel_url,
+                                                                payment_method_types=payment_method_types)
+                     for _ in range(2)]
+    finally:
+        checkout_sessions.ttl = 0
+        checkout_sessions.clear()
+    assert checkouts[0]['id'] == checkouts[1]['id']
+
+
+def test_concurrent_checkouts_create_one_session(monkeypatch):
+    created = []
+
+    def create(**kwargs):
+        time.sleep(0.1)
+        created.append(kwargs)
+        return {'id': f'cs_{len(created)}', 'status': 'open', 'expires_at': time.time() + 3600}
+
+    monkeypatch.setattr(subscriptions.stripe.checkout.Session, 'create', create)
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    checkout_sessions.ttl = 60
+    try:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            sessions = list(pool.map(lambda _: subscriptions.create_subscription_checkout(user, 'price_1'), range(4)))
+    finally:
+        checkout_sessions.ttl = 0
+        checkout_sessions.clear()
+    assert len(created) == 1
+    assert {session['id'] for session in sessions} == {'cs_1'}
+
+
+def test_failing_webhook_handler_does_not_stop_others():
+    called = []
+
+    @webhooks.on('test.event')
+    def failing(event):
+        raise ValueError('Handler failed')
+
+    @webhooks.on('test.event')
+    def succeeding(event):
+        called.append(event['id'])
+
+    try:
+        with pytest.raises(ValueError):
+            webhooks.handle_event({'id': 'evt_1', 'type': 'test.event', 'data': {'object': {}}})
+    finally:
+        del webhooks.handlers['test.event']
+    assert called == ['evt_1']
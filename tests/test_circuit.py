@@ -0,0 +1,60 @@
+import time
+import pytest
+
+import subscriptions
+from subscriptions import circuit
+
+
+def test_circuit_breaker_opens_and_closes():
+    breaker = circuit.CircuitBreaker(min_requests=2, open_for=0.1)
+    breaker.record(True, 0.1)
+    breaker.record(False, 0.1)
+    assert breaker.state == circuit.OPEN
+    with pytest.raises(subscriptions.exceptions.StripeCircuitOpen):
+        breaker.before_request()
+    time.sleep(0.1)
+    assert breaker.state == circuit.HALF_OPEN
+    trial = breaker.before_request()
+    with pytest.raises(subscriptions.exceptions.StripeCircuitOpen):
+        breaker.before_request()
+    breaker.record(True, 0.1, trial)
+    assert breaker.state == circuit.CLOSED
+
+
+def test_circuit_breaker_half_open_needs_all_trials():
+    breaker = circuit.CircuitBreaker(min_requests=1, open_for=0.05, half_open_requests=2)
+    breaker.record(False, 0.1)
+    time.sleep(0.05)
+    trials = [breaker.before_request(), breaker.before_request()]
+    breaker.record(True, 0.1)
+    assert breaker.state == circuit.HALF_OPEN
+    breaker.record(True, 0.1, trials[0])
+    assert breaker.state == circuit.HALF_OPEN
+    breaker.record(True, 0.1, trials[1])
+    assert breaker.state == circuit.CLOSED
+
+
+def test_circuit_open_is_exception():
+    assert issubclass(subscriptions.exceptions.StripeCircuitOpen, Exception)
+    assert issubclass(subscriptions.exceptions.StripeWrongCustomer, Exception)
+
+
+def test_circuit_breaker_slow_requests_fail():
+    breaker = circuit.CircuitBreaker(min_requests=2, latency_threshold=1)
+    breaker.record(True, 2)
+    breaker.record(True, 2)
+    assert breaker.state == circuit.OPEN
+
+
+def test_circuit_breaker_stale_reads(user_with_customer_id, subscription, stripe_subscription_product_id):
+    breaker = circuit.install_circuit_breaker()
+    try:
+        assert subscriptions.is_subscribed(user_with_customer_id, stripe_subscription_product_id)
+        breaker._transition(circuit.OPEN)
+        with circuit.track_stale() as stale:
+            assert subscriptions.is_subscribed(user_with_customer_id, stripe_subscription_product_id)
+        assert stale == ['list_subscriptions']
+        with pytest.raises(subscriptions.exceptions.StripeCircuitOpen):
+            subscriptions.cancel_subscription(user_with_customer_id, subscription['id'])
+    finally:
+        circuit.uninstall_circuit_breaker()
@@ -0,0 +1,132 @@
+import json
+import pytest
+import stripe
+from stripe.http_client import HTTPClient
+
+import subscriptions
+from subscriptions import circuit, client
+from subscriptions.cache import catalog, no_subscriptions, owners
+from subscriptions.entitlements import entitlements
+from subscriptions.exceptions import StripeCircuitOpen
+
+
+class AccountStub(HTTPClient):
+    name = 'stub'
+
+    def __init__(self, account):
+        super().__init__()
+        self.account = account
+        self.headers = []
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        self.headers.append(headers)
+        body = {'object': 'list', 'url': '/v1/prices', 'has_more': False,
+                'data': [{'id': f'price_{self.account}', 'object': 'price', 'recurring': None, 'type': 'one_time',
+                          'currency': 'usd', 'unit_amount': 100, 'unit_amount_decimal': '100', 'nickname': None,
+                          'product': 'prod_1', 'metadata': {}}]}
+        return json.dumps(body), 200, {}
+
+
+@pytest.fixture
+def restore_http_client(monkeypatch):
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.default_http_client)
+    monkeypatch.setattr(stripe, 'api_key', stripe.api_key or 'sk_test_platform')
+    monkeypatch.setattr(client, '_installed', False)
+
+
+def test_account_clients_headers_and_cache_partitions(restore_http_client):
+    connected = subscriptions.AccountClient(stripe_account='acct_1', http_client=AccountStub('acct_1'))
+    other = subscriptions.AccountClient(api_key='sk_test_other', http_client=AccountStub('other'))
+    catalog.ttl = 60
+    try:
+        for _ in range(2):
+            assert connected.get_active_prices()[0]['id'] == 'price_acct_1'
+            assert other.get_active_prices()[0]['id'] == 'price_other'
+    finally:
+        catalog.ttl = 0
+        catalog.clear()
+    assert len(connected.http_client.headers) == 1
+    assert connected.http_client.headers[0]['Stripe-Account'] == 'acct_1'
+    assert other.http_client.headers[0]['Authorization'] == 'Bearer sk_test_other'
+    assert 'Stripe-Account' not in other.http_client.headers[0]
+    assert client.account_id() is None
+
+
+def test_account_client_only_exposes_public_functions(restore_http_client):
+    account = subscriptions.AccountClient(stripe_account='acct_1', http_client=AccountStub('acct_1'))
+    assert account.is_subscribed.__name__ == 'is_subscribed'
+    with pytest.raises(AttributeError):
+        account._submit
+    with pytest.raises(AttributeError):
+        account.customer_id_required
+
+
+def test_account_client_without_global_api_key(restore_http_client, monkeypatch):
+    monkeypatch.setattr(stripe, 'api_key', None)
+    other = subscriptions.AccountClient(api_key='sk_test_other', http_client=AccountStub('other'))
+    assert other.get_active_prices()[0]['id'] == 'price_other'
+    assert other.http_client.headers[0]['Authorization'] == 'Bearer sk_test_other'
+    with other.activate():
+        assert client.request_params() == {'api_key': 'sk_test_other'}
+    assert client.request_params() == {}
+
+
+def test_customer_caches_partitioned_by_account(restore_http_client, monkeypatch):
+    connected = subscriptions.AccountClient(stripe_account='acct_1', http_client=AccountStub('acct_1'))
+    monkeypatch.setattr(entitlements, 'ttl', 300)
+    no_subscriptions.ttl = owners.ttl = 60
+    try:
+        with connected.activate():
+            entitlements.set('cus_1', [])
+            no_subscriptions.add('cus_1', 'key')
+            owners.set(('subscription', 'sub_1'), 'cus_1')
+            assert no_subscriptions.contains('cus_1', 'key')
+        assert entitlements.get('cus_1') is None
+        assert not no_subscriptions.contains('cus_1', 'key')
+        assert owners.get(('subscription', 'sub_1')) is None
+        no_subscriptions.invalidate('cus_1')
+        with connected.activate():
+            assert entitlements.get('cus_1') == []
+            assert owners.get(('subscription', 'sub_1')) == 'cus_1'
+            assert not no_subscriptions.contains('cus_1', 'key')
+    finally:
+        no_subscriptions.ttl = owners.ttl = 0
+        for cache in (entitlements, no_subscriptions, owners):
+            cache.clear()
+
+
+def test_circuit_breaker_per_account(restore_http_client):
+    connected = subscriptions.AccountClient(stripe_account='acct_1', http_client=AccountStub('acct_1'))
+    breaker = circuit.install_circuit_breaker()
+    try:
+        account_breaker = circuit._client.breaker_for('acct_1')
+        account_breaker._transition(circuit.OPEN)
+        with pytest.raises(StripeCircuitOpen):
+            connected.get_active_prices()
+        assert breaker.state == circuit.CLOSED
+        assert circuit._client.breaker_for(connected.id) is account_breaker
+    finally:
+        circuit.uninstall_circuit_breaker()
+
+
+class PaymentMethodsStub(HTTPClient):
+    name = 'stub'
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        if '/v1/customers/' in url:
+            body = {'id': 'cus_1', 'object': 'customer', 'invoice_settings': {'default_payment_method': 'pm_1'}}
+        else:
+            body = {'object': 'list', 'url': '/v1/payment_methods', 'has_more': False,
+                    'data': [{'id': f'pm_{i}', 'object': 'payment_method', 'customer': 'cus_1'} for i in (1, 2)]}
+        return json.dumps(body), 200, {}
+
+
+def test_account_not_active_in_caller_between_yields(restore_http_client):
+    connected = subscriptions.AccountClient(stripe_account='acct_1', http_client=PaymentMethodsStub())
+    user = subscriptions.User(1, 'user@example.com', 'cus_1')
+    payment_methods = connected.list_payment_methods(user, types=['card'])
+    assert next(payment_methods)['id'] == 'pm_1'
+    assert client.current_account() is None
+    assert next(payment_methods)['id'] == 'pm_2'
+    assert client.current_account() is None
+    payment_methods.close()
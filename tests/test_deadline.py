@@ -0,0 +1,90 @@
+import contextvars
+import json
+import pytest
+import stripe
+import time
+from stripe.http_client import RequestsClient
+
+import subscriptions
+from subscriptions import cassette, deadline
+from subscriptions.http import DeadlineRequestsClient, base_client, set_base_client
+
+
+@pytest.fixture(autouse=True)
+def restore_http_client(monkeypatch):
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.default_http_client)
+    monkeypatch.setattr(stripe, 'api_key', stripe.api_key or 'sk_test_deadline')
+    monkeypatch.setattr(deadline, '_installed', False)
+
+
+def _write_cassette(path, products_latency):
+    products = json.dumps({'object': 'list', 'url': '/v1/products', 'has_more': False, 'data': []})
+    prices = json.dumps({'object': 'list', 'url': '/v1/prices', 'has_more': False, 'data': []})
+    with open(path, 'w') as f:
+        json.dump({'version': 1, 'interactions': [
+            {'request': 'GET /v1/products?active=True', 'status': 200, 'body': products,
+             'latency': products_latency, 'headers': {}},
+            {'request': 'GET /v1/prices?active=True', 'status': 200, 'body': prices, 'latency': 0.01,
+             'headers': {}}]}, f)
+
+
+def test_deadline_exceeded_reports_sub_call(tmp_path):
+    path = str(tmp_path / 'cassette.json')
+    _write_cassette(path, products_latency=1)
+    with cassette.replaying(path):
+        start = time.monotonic()
+        with pytest.raises(subscriptions.exceptions.StripeDeadlineExceeded) as exc_info:
+            subscriptions.get_subscription_products_and_prices(None, deadline=0.2)
+        assert time.monotonic() - start < 0.5
+        assert exc_info.value.call == 'get_active_products'
+        assert exc_info.value.budget == 0.2
+        assert subscriptions.get_subscription_products_and_prices(None, deadline=5) == []
+
+
+def test_no_requests_after_deadline(tmp_path):
+    path = str(tmp_path / 'cassette.json')
+    _write_cassette(path, products_latency=0)
+    with cassette.replaying(path), deadline.within(0):
+        with pytest.raises(subscriptions.exceptions.StripeDeadlineExceeded) as exc_info:
+            stripe.Product.list(active=True)
+    assert exc_info.value.call == 'GET /v1/products'
+
+
+def test_inner_deadline_does_not_extend():
+    with deadline.within(1) as outer:
+        with deadline.within(10) as inner:
+            assert inner.expires == outer.expires
+            assert deadline.remaining() <= 1
+        with deadline.within(0.5):
+            assert deadline.remaining() <= 0.5
+    assert deadline.remaining() is None
+
+
+def test_only_stripe_requests_client_replaced():
+    class CustomClient(RequestsClient):
+        pass
+
+    set_base_client(RequestsClient(timeout=30))
+    deadline._install()
+    assert type(base_client()) is DeadlineRequestsClient
+    assert base_client().timeout == 30
+    custom = CustomClient()
+    set_base_client(custom)
+    deadline._installed = False
+    deadline._install()
+    assert base_client() is custom
+
+
+def test_generator_deadline_not_set_in_caller_between_yields():
+    @deadline.accepts_deadline
+    def numbers():
+        for i in range(2):
+            assert deadline.current() is not None
+            yield i
+
+    gen = numbers(deadline=0.5)
+    assert next(gen) == 0
+    assert deadline.current() is None
+    closer = contextvars.copy_context()
+    closer.run(gen.close)
+    assert list(numbers(deadline=0.5)) == [0, 1]
@@ -0,0 +1,47 @@
+import numpy as np
+
+from subscriptions import export
+from subscriptions.store import SubscriptionStore
+
+
+def test_export_subscriptions_from_store():
+    store = SubscriptionStore()
+    store.upsert('subscription', [
+        {'id': f'sub_{i}', 'customer': f'cus_{i % 2}', 'status': 'active', 'quantity': 1,
+         'plan': {'id': 'price_1', 'product': 'prod_1', 'amount': 1000 + i, 'currency': 'eur', 'interval': 'month',
+                  'interval_count': 1},
+         'created': 1600000000, 'cancel_at': None if i else 1700000000, 'current_period_end': 1650000000}
+        for i in range(5)])
+    chunks = list(export.export_subscriptions(store, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    table = export.concatenate(chunks)
+    assert table['customer_id'].dtype == np.int32
+    assert list(table.decode('customer_id')) == ['cus_0', 'cus_1', 'cus_0', 'cus_1', 'cus_0']
+    assert table['amount'].dtype == np.int64
+    assert table['amount'].sum() == 5010
+    assert table['cancel_at'].dtype == np.dtype('datetime64[s]')
+    assert np.isnat(table['cancel_at']).sum() == 4
+    assert (table['price_id'] == table.categories['price_id'].code('price_1')).all()
+
+
+def test_export_prices(stripe_price_id):
+    table = export.concatenate(export.export_prices(active=True))
+    assert stripe_price_id in table.decode('price_id')
+
+
+def test_export_multi_item_subscription():
+    store = SubscriptionStore()
+    store.upsert('subscription', [
+        {'id': 'sub_1', 'customer': 'cus_1', 'status': 'active', 'quantity': None, 'plan': {},
+         'items': [{'id': 'si_1', 'price': 'price_1', 'product': 'prod_1', 'quantity': 2, 'amount': 1000,
+                    'currency': 'eur', 'interval': 'month', 'interval_count': 1},
+                   {'id': 'si_2', 'price': 'price_2', 'product': 'prod_2', 'quantity': 1, 'amount': 12000,
+                    'currency': 'eur', 'interval': 'year', 'interval_count': 1}],
+         'created': 1600000000}])
+    table = export.concatenate(export.export_subscriptions(store))
+    assert list(table.decode('sub_id')) == ['sub_1', 'sub_1']
+    assert list(table.decode('item_id')) == ['si_1', 'si_2']
+    assert list(table.decode('price_id')) == ['price_1', 'price_2']
+    assert list(table.decode('product_id')) == ['prod_1', 'prod_2']
+    assert table['amount'].tolist() == [1000, 12000]
+    assert table['quantity'].tolist() == [2, 1]
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from stripe.http_client import HTTPClient
+
+from subscriptions import hedge
+from subscriptions.stats import stats
+
+import subscriptions
+
+
+def test_hedged_list_payment_methods(user_with_customer_id, default_payment_method_saved):
+    stats.reset()
+    hedge.install_hedging(initial_delay=0, budget=1)
+    try:
+        payment_methods = list(subscriptions.list_payment_methods(user_with_customer_id, types=["card"]))
+    finally:
+        hedge.uninstall_hedging()
+    assert [p['id'] for p in payment_methods] == [default_payment_method_saved['id']]
+    assert stats.snapshot()['counters']['hedge.requests'] == 1
+    assert hedge.hedge_rates()['hedge_rate'] == 1
+
+
+class SlowFirstClient(HTTPClient):
+    name = 'slow_first'
+
+    def __init__(self, first_latency):
+        super().__init__()
+        self.first_latency = first_latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.first_latency if call == 1 else 0.01)
+        return json.dumps({'call': call}), 200, {}
+
+
+def test_hedge_answers_first_when_first_request_slow():
+    stats.reset()
+    client = hedge.HedgingHTTPClient(SlowFirstClient(first_latency=1), initial_delay=0.05, budget=1)
+    try:
+        start = time.monotonic()
+        content, status_code, _ = client.request_with_retries('get', 'https://api.stripe.com/v1/customers/cus_1', {})
+        assert time.monotonic() - start < 0.5
+    finally:
+        client.close()
+    assert json.loads(content) == {'call': 2}
+    counters = stats.snapshot()['counters']
+    assert (counters['hedge.requests'], counters['hedge.sent'], counters['hedge.won']) == (1, 1, 1)
+
+
+def test_no_hedge_when_first_request_fast():
+    stats.reset()
+    client = hedge.HedgingHTTPClient(SlowFirstClient(first_latency=0.01), initial_delay=0.5, budget=1)
+    try:
+        content, _, _ = client.request_with_retries('get', 'https://api.stripe.com/v1/subscriptions', {})
+        client.request_with_retries('post', 'https://api.stripe.com/v1/subscriptions', {}, 'items[0][price]=p')
+    finally:
+        client.close()
+    assert json.loads(content) == {'call': 1}
+    assert client.client.calls == 2
+    assert stats.snapshot()['counters'].get('hedge.sent', 0) == 0
+
+
+def test_first_requests_reuse_threads_and_run_inline_when_busy():
+    stats.reset()
+    threads = set()
+
+    class RecordingClient(SlowFirstClient):
+        def request_with_retries(self, method, url, headers, post_data=None):
+            threads.add(threading.current_thread().name)
+            return super().request_with_retries(method, url, headers, post_data)
+
+    client = hedge.HedgingHTTPClient(RecordingClient(first_latency=0.01), initial_delay=1, first_workers=1)
+    try:
+        for _ in range(5):
+            client.request_with_retries('get', 'https://api.stripe.com/v1/subscriptions', {})
+        assert len(threads) == 1
+        client._first_in_flight = client.first_workers
+        client.request_with_retries('get', 'https://api.stripe.com/v1/subscriptions', {})
+    finally:
+        client.close()
+    assert threading.current_thread().name in threads
+    assert stats.snapshot()['counters']['hedge.inline'] == 1
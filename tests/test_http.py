@@ -0,0 +1,68 @@
+import json
+import pytest
+import stripe
+
+import subscriptions
+from subscriptions import http
+from subscriptions.stats import stats
+
+
+def test_connection_pool(user_with_customer_id, default_payment_method_saved):
+    stats.reset()
+    default_http_client = stripe.default_http_client
+    http.install_connection_pool(maxsize=2)
+    try:
+        for _ in range(3):
+            list(subscriptions.list_payment_methods(user_with_customer_id, types=["card", "alipay"]))
+    finally:
+        stripe.default_http_client = default_http_client
+    pool_stats = http.pool_stats()
+    assert pool_stats['requests'] == 9
+    assert pool_stats['connections'] <= 2
+    assert pool_stats['reuse_ratio'] >= 0.7
+
+
+def test_set_base_client():
+    default_http_client = stripe.default_http_client
+    client = http.install(http.WrappedHTTPClient)
+    base_client = http.PooledRequestsClient()
+    try:
+        http.set_base_client(base_client)
+        assert stripe.default_http_client is client
+        assert client.client is base_client
+    finally:
+        stripe.default_http_client = default_http_client
+
+
+def test_clients_use_stripe_proxy_and_verify_settings(monkeypatch):
+    monkeypatch.setattr(stripe, 'proxy', 'http://proxy.example.com:3128')
+    monkeypatch.setattr(stripe, 'verify_ssl_certs', False)
+    for client in (http.default_client(), http.PooledRequestsClient()):
+        assert client._proxy == {'http': 'http://proxy.example.com:3128', 'https': 'http://proxy.example.com:3128'}
+        assert client._verify_ssl_certs is False
+
+
+def test_http2_client():
+    httpx = pytest.importorskip('httpx')
+    pytest.importorskip('h2')
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request)
+        if request.url.path == '/v1/fail':
+            raise httpx.ConnectError('Connection refused')
+        return httpx.Response(200, json={'id': 'prod_1'}, headers={'Request-Id': 'req_1'})
+
+    client = http.HTTP2Client(maxsize=2, timeout=5)
+    client._client = httpx.Client(transport=httpx.MockTransport(handler))
+    content, status_code, headers = client.request('post', 'https://api.stripe.com/v1/products',
+                                                   {'Authorization': 'Bearer sk_test'}, 'name=Product')
+    assert status_code == 200
+    assert json.loads(content) == {'id': 'prod_1'}
+    assert headers['Request-Id'] == 'req_1'
+    assert requests_seen[0].content == b'name=Product'
+    assert requests_seen[0].headers['Authorization'] == 'Bearer sk_test'
+    with pytest.raises(stripe.error.APIConnectionError) as exc_info:
+        client.request('get', 'https://api.stripe.com/v1/fail', {})
+    assert exc_info.value.should_retry
+    client.close()
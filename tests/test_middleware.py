@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+import stripe
+
+import subscriptions
+from subscriptions.cache import current_request_cache
+from subscriptions.circuit import last_known_good
+from subscriptions.middleware import ASGIRequestCacheMiddleware, RequestCacheMiddleware
+
+
+@pytest.fixture
+def subscription_calls(monkeypatch):
+    calls = []
+
+    def list_subscriptions(customer, **kwargs):
+        calls.append(customer)
+        return {'object': 'list', 'data': [{'id': 'sub_1', 'plan': {'id': 'price_1', 'product': 'prod_1'},
+                                            'items': {'data': []}, 'cancel_at': None,
+                                            'current_period_end': None}]}
+
+    monkeypatch.setattr(stripe.Subscription, 'list', list_subscriptions)
+    yield calls
+    last_known_good.clear()
+
+
+@pytest.fixture
+def user():
+    return subscriptions.User(1, 'a@example.com', 'cus_1')
+
+
+def test_wsgi_middleware_one_stripe_call_per_request(subscription_calls, user):
+    caches = []
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        caches.append(current_request_cache())
+        subscribed = [subscriptions.is_subscribed(user, product_id='prod_1') for _ in range(3)]
+
+        def body():
+            yield str(all(subscribed)).encode()
+            yield str(subscriptions.is_subscribed(user, price_id='price_1')).encode()
+        return body()
+
+    application = RequestCacheMiddleware(app)
+    response = application({}, lambda status, headers: None)
+    assert b''.join(response) == b'TrueTrue'
+    assert subscription_calls == ['cus_1']
+    assert caches[0]._futures
+    response.close()
+    assert not caches[0]._futures
+    assert current_request_cache() is None
+    response = application({}, lambda status, headers: None)
+    b''.join(response)
+    response.close()
+    assert subscription_calls == ['cus_1', 'cus_1']
+
+
+def test_asgi_middleware_http_and_lifespan(subscription_calls, user):
+    seen = []
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            seen.append(('lifespan', current_request_cache()))
+            return
+        seen.append(('http', current_request_cache()))
+        for _ in range(3):
+            assert subscriptions.is_subscribed(user, product_id='prod_1')
+
+    application = ASGIRequestCacheMiddleware(app)
+
+    async def receive():
+        return {}
+
+    async def send(message):
+        pass
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application({'type': 'lifespan'}, receive, send))
+        loop.run_until_complete(application({'type': 'http'}, receive, send))
+    finally:
+        loop.close()
+    assert seen[0] == ('lifespan', None)
+    assert seen[1][0] == 'http' and seen[1][1] is not None
+    assert not seen[1][1]._futures
+    assert subscription_calls == ['cus_1']
+    assert current_request_cache() is None
@@ -0,0 +1,32 @@
+import json
+
+import subscriptions
+from subscriptions import profiling
+
+
+def test_profile_spans(tmp_path):
+    with profiling.profile() as profile:
+        with profiling.span('outer'):
+            with profiling.span('inner'):
+                pass
+    assert [span.stack for span in profile.spans] == [('outer', 'inner'), ('outer',)]
+    assert [line.rsplit(' ', 1)[0] for line in profile.to_collapsed()] == ['outer;inner', 'outer']
+    path = str(tmp_path / 'profile.json')
+    profile.dump(path)
+    with open(path) as f:
+        assert [event['name'] for event in json.load(f)['traceEvents']] == ['inner', 'outer']
+
+
+def test_span_without_profile():
+    with profiling.span('outer') as span:
+        assert not profiling.active()
+    assert span is profiling._no_op_span
+
+
+def test_profile_get_subscription_products_and_prices(user_with_customer_id, stripe_subscription_product_id):
+    with profiling.profile() as profile:
+        subscriptions.get_subscription_products_and_prices(user_with_customer_id, ids=[stripe_subscription_product_id])
+    names = {span.name for span in profile.spans}
+    assert {'GET /v1/products', 'GET /v1/prices', 'GET /v1/subscriptions', 'wait get_active_prices',
+            'join products and prices'} <= names
+    assert set(profile.totals()) == {'function', 'executor', 'queue', 'wait', 'stripe', 'json', 'local'}
@@ -0,0 +1,74 @@
+import numpy as np
+
+from subscriptions import export, revenue
+from subscriptions.store import SubscriptionStore
+
+
+def _subscription(sub_id, amount, interval='month', interval_count=1, quantity=1, created='2021-01-15',
+                  canceled_at=None, status='active'):
+    def timestamp(date):
+        return int(np.datetime64(date, 's').astype(int)) if date else None
+    return {'id': sub_id, 'customer': 'cus_1', 'status': status, 'quantity': quantity, 'created': timestamp(created),
+            'canceled_at': timestamp(canceled_at), 'cancel_at': None,
+            'plan': {'id': f'price_{interval}', 'product': 'prod_1', 'amount': amount, 'currency': 'eur',
+                     'interval': interval, 'interval_count': interval_count}}
+
+
+def _export(subs):
+    store = SubscriptionStore()
+    store.upsert('subscription', subs)
+    return export.concatenate(export.export_subscriptions(store))
+
+
+def test_monthly_amount():
+    subs = _export([_subscription('sub_1', 1000), _subscription('sub_2', 12000, 'year'),
+                    _subscription('sub_3', 3000, interval_count=3, quantity=2)])
+    assert list(revenue.monthly_amount(subs)) == [1000, 1000, 2000]
+
+
+def test_metrics():
+    subs = _export([_subscription('sub_1', 1000), _subscription('sub_2', 12000, 'year', created='2021-02-10'),
+                    _subscription('sub_3', 500, canceled_at='2021-03-20', status='canceled'),
+                    _subscription('sub_4', 500, status='incomplete')])
+    result = revenue.metrics(subs, revenue.month_starts('2021-01', '2021-05'), by=('currency', 'interval'))
+    assert result['groups'] == [('eur', 'month'), ('eur', 'year')]
+    assert result['mrr'].tolist() == [[0, 1500, 1500, 1000, 1000], [0, 0, 1000, 1000, 1000]]
+    assert result['active'].sum(axis=0).tolist() == [0, 2, 3, 2, 2]
+    assert result['churned_mrr'].sum(axis=0).tolist() == [0, 0, 0, 500, 0]
+
+
+def test_movements():
+    before = _export([_subscription('sub_1', 1000), _subscription('sub_2', 1000)])
+    after = _export([_subscription('sub_1', 1500), _subscription('sub_2', 1000, status='canceled'),
+                     _subscription('sub_3', 200)])
+    result = revenue.movements(before, after)
+    assert result['new_mrr'] == 200
+    assert result['churned_mrr'] == 1000
+    assert result['expansion_mrr'] == 500
+    assert result['contraction_mrr'] == 0
+
+
+def test_metrics_expansion_and_contraction_from_snapshots():
+    buckets = revenue.month_starts('2021-02', '2021-04')
+    snapshots = [_export([_subscription('sub_1', 1000), _subscription('sub_2', 1000)]),
+                 _export([_subscription('sub_1', 1000, quantity=3), _subscription('sub_2', 12000, 'year')]),
+                 _export([_subscription('sub_1', 1000, quantity=2), _subscription('sub_2', 12000, 'year')])]
+    result = revenue.metrics(snapshots[-1], buckets, by=('interval',), snapshots=snapshots)
+    assert result['groups'] == [('month',), ('year',)]
+    assert result['expansion_mrr'].tolist() == [[0, 2000, 0], [0, 1000, 0]]
+    assert result['contraction_mrr'].tolist() == [[0, 1000, 1000], [0, 0, 0]]
+    assert result['active'].tolist() == [[1, 1, 1], [1, 1, 1]]
+
+
+def test_multi_item_subscription_counted_once():
+    sub = {**_subscription('sub_1', 0), 'plan': {},
+           'items': [{'id': 'si_1', 'price': 'price_1', 'product': 'prod_1', 'quantity': 2, 'amount': 1000,
+                      'currency': 'eur', 'interval': 'month', 'interval_count': 1},
+                     {'id': 'si_2', 'price': 'price_2', 'product': 'prod_2', 'quantity': 1, 'amount': 500,
+                      'currency': 'eur', 'interval': 'month', 'interval_count': 1}]}
+    subs = _export([sub])
+    result = revenue.metrics(subs, revenue.month_starts('2021-02', '2021-02'))
+    assert result['mrr'].tolist() == [[2500]]
+    assert result['active'].tolist() == [[1]]
+    more = _export([{**sub, 'items': [{**sub['items'][0], 'quantity': 3}, sub['items'][1]]}])
+    assert revenue.movements(subs, more)['expansion_mrr'] == 1000
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import pytest
+from concurrent.futures import CancelledError, TimeoutError
+
+import subscriptions
+from subscriptions import scheduler
+
+
+def _raise():
+    raise ValueError('failed')
+
+
+@pytest.mark.parametrize('backend', ['thread', 'sync'])
+def test_scheduler(backend):
+    previous = scheduler.current
+    scheduler.current = scheduler.schedulers[backend]()
+    try:
+        future = subscriptions._submit(threading.get_ident)
+        assert (future.result() == threading.get_ident()) == (backend == 'sync')
+        with pytest.raises(ValueError):
+            subscriptions._result(subscriptions._submit(_raise), 'raise')
+    finally:
+        scheduler.current.shutdown()
+        scheduler.current = previous
+
+
+def test_asyncio_scheduler():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        assert scheduler.AsyncioScheduler(loop).submit(sum, [1, 2]).result(timeout=5) == 3
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_asyncio_scheduler_requires_running_loop():
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(RuntimeError):
+            scheduler.AsyncioScheduler(loop).submit(sum, [1, 2])
+    finally:
+        loop.close()
+    with pytest.raises(RuntimeError):
+        scheduler.AsyncioScheduler()
+
+
+def test_gevent_scheduler():
+    gevent = pytest.importorskip('gevent')
+    sched = scheduler.GeventScheduler(max_workers=2)
+    try:
+        assert sched.submit(sum, [1, 2]).result(timeout=5) == 3
+        with pytest.raises(TimeoutError):
+            sched.submit(gevent.sleep, 1).result(timeout=0.01)
+        future = sched.submit(_raise)
+        assert isinstance(future.exception(timeout=5), ValueError)
+        with pytest.raises(ValueError):
+            future.result()
+        assert future.done()
+    finally:
+        sched.shutdown()
+
+
+def test_gevent_scheduler_cancel():
+    gevent = pytest.importorskip('gevent')
+    sched = scheduler.GeventScheduler(max_workers=2)
+    calls = []
+    try:
+        future = sched.submit(calls.append, 1)
+        assert future.cancel()
+        assert future.cancelled()
+        with pytest.raises(CancelledError):
+            future.result()
+        running = sched.submit(gevent.sleep, 0.1)
+        gevent.sleep(0)
+        assert not running.cancel()
+        assert running.result(timeout=5) is None
+        assert sched.submit(sum, [1]).result(timeout=5) == 1
+        assert calls == []
+    finally:
+        sched.shutdown()
+
+
+def test_executor_follows_configured_scheduler():
+    previous = scheduler.current
+    scheduler.current = scheduler.SynchronousScheduler()
+    try:
+        assert subscriptions.executor.submit(threading.get_ident).result() == threading.get_ident()
+    finally:
+        scheduler.current = previous
+
+
+def test_thread_scheduler_queued():
+    sched = scheduler.ThreadScheduler(max_workers=1)
+    started, release = threading.Event(), threading.Event()
+    try:
+        running = sched.submit(lambda: started.set() or release.wait())
+        started.wait()
+        waiting = [sched.submit(lambda: None) for _ in range(3)]
+        assert sched.queued() == 3
+        waiting[0].cancel()
+        assert sched.queued() == 2
+        release.set()
+        running.result()
+        for future in waiting[1:]:
+            future.result()
+        assert sched.queued() == 0
+    finally:
+        sched.shutdown()
@@ -1,3 +1,4 @@
+import json
 import pytest
 import stripe
 
@@ -339,3 +340,130 @@ def test_subscription_lifecycle(user, stripe_price_id, stripe_subscription_produ
     response = subscriptions.is_subscribed_and_cancelled_time(user, stripe_subscription_product_id)
     assert response['sub_id'] is None
     assert response['cancel_at'] is None
+
+
+def test_subscription_required(user_with_customer_id, subscription, stripe_subscription_product_id,
+                               stripe_unsubscribed_product_id, monkeypatch):
+    monkeypatch.setattr(subscriptions.entitlements.entitlements, 'ttl', 300)
+
+    @subscriptions.subscription_required(product_id=stripe_subscription_product_id)
+    def paid_view(user):
+        return user.stripe_customer_id
+
+    @subscriptions.subscription_required(product_id=stripe_unsubscribed_product_id)
+    def other_paid_view(user):
+        return user.stripe_customer_id
+
+    assert paid_view(user_with_customer_id) == user_with_customer_id.stripe_customer_id
+    assert subscriptions.entitlements.entitlements.get(user_with_customer_id.stripe_customer_id)
+    with pytest.raises(subscriptions.exceptions.StripeSubscriptionRequired):
+        other_paid_view(user_with_customer_id)
+
+
+def test_subscription_required_no_customer_id(none_or_user, stripe_subscription_product_id):
+    @subscriptions.subscription_required(product_id=stripe_subscription_product_id)
+    def paid_view(user):
+        return user.stripe_customer_id
+
+    with pytest.raises(subscriptions.exceptions.StripeSubscriptionRequired):
+        paid_view(none_or_user)
+
+
+def test_subscription_required_caches_for_ttl(wrong_customer_id, monkeypatch):
+    calls = []
+
+    def subscribed_to(user):
+        calls.append(user.stripe_customer_id)
+        return [{'sub_id': 'sub_1', 'product_id': 'prod_1', 'price_id': 'price_1', 'cancel_at': None,
+                 'current_period_end': None}]
+
+    monkeypatch.setattr(subscriptions, 'list_products_prices_subscribed_to', subscribed_to)
+
+    @subscriptions.subscription_required(product_id='prod_1', ttl=60)
+    def paid_view(user):
+        return user.stripe_customer_id
+
+    try:
+        assert paid_view(wrong_customer_id) == wrong_customer_id.stripe_customer_id
+        assert paid_view(wrong_customer_id) == wrong_customer_id.stripe_customer_id
+        assert calls == [wrong_customer_id.stripe_customer_id]
+    finally:
+        subscriptions.entitlements.entitlements.delete(wrong_customer_id.stripe_customer_id)
+
+
+def test_create_setup_intent_reuse(user_with_customer_id):
+    setup_intent = subscriptions.create_setup_intent(user_with_customer_id, payment_method_types=["card"])
+    reused = subscriptions.create_setup_intent(user_with_customer_id, payment_method_types=["card"], reuse=True)
+    assert reused['id'] == setup_intent['id']
+
+
+def test_create_setup_intent_reuse_only_open(wrong_customer_id, monkeypatch):
+    intents = [{'id': 'seti_succeeded', 'status': 'succeeded', 'payment_method_types': ['card'],
+                'usage': 'off_session'},
+               {'id': 'seti_open', 'status': 'requires_payment_method', 'payment_method_types': ['card'],
+                'usage': 'off_session'}]
+    created = []
+
+    def create(**kwargs):
+        created.append(kwargs)
+        return {'id': 'seti_new', 'status': 'requires_payment_method', **kwargs}
+
+    monkeypatch.setattr(stripe.SetupIntent, 'list', lambda **kwargs: {'object': 'list', 'data': intents})
+    monkeypatch.setattr(stripe.SetupIntent, 'create', create)
+    assert subscriptions.create_setup_intent(wrong_customer_id, payment_method_types=["card"],
+                                             reuse=True)['id'] == 'seti_open'
+    assert created == []
+    intents[1]['status'] = 'canceled'
+    assert subscriptions.create_setup_intent(wrong_customer_id, payment_method_types=["card"],
+                                             reuse=True)['id'] == 'seti_new'
+    assert created[0]['customer'] == wrong_customer_id.stripe_customer_id
+
+
+def test_precreate_setup_intent(user_with_customer_id):
+    future = subscriptions.precreate_setup_intent(user_with_customer_id, payment_method_types=["card"])
+    setup_intent = subscriptions.create_setup_intent(user_with_customer_id, payment_method_types=["card"], reuse=True)
+    assert setup_intent['id'] == future.result()['id']
+    assert len(subscriptions.precreated_setup_intents) == 0
+
+
+def test_minimize_price_plain_dicts():
+    price = stripe.Price.construct_from({'id': 'price_1', 'object': 'price', 'type': 'recurring', 'currency': 'usd',
+                                         'unit_amount': 1000, 'unit_amount_decimal': '1000', 'nickname': None,
+                                         'product': 'prod_1', 'metadata': {'tier': 'gold'},
+                                         'recurring': {'interval': 'month', 'interval_count': 1}}, 'sk_test')
+    minimized = subscriptions._minimize_price(price)
+    assert type(minimized['recurring']) is dict
+    assert type(minimized['metadata']) is dict
+    assert minimized['recurring'] == {'interval': 'month', 'interval_count': 1}
+
+
+def test_create_multi_item_subscription(user_with_customer_id, default_payment_method_for_customer, stripe_price_id,
+                                        stripe_unsubscribed_price_id, stripe_subscription_product_id,
+                                        stripe_unsubscribed_product_id):
+    sub = subscriptions.create_subscription(user_with_customer_id, stripe_price_id, quantity=5,
+                                            items=[{'price': stripe_unsubscribed_price_id}],
+                                            default_payment_method=default_payment_method_for_customer['id'])
+    assert sorted((item['price']['id'], item['quantity']) for item in sub['items']['data']) == sorted(
+        [(stripe_price_id, 5), (stripe_unsubscribed_price_id, 1)])
+    assert subscriptions.is_subscribed(user_with_customer_id, product_id=stripe_subscription_product_id)
+    assert subscriptions.is_subscribed(user_with_customer_id, product_id=stripe_unsubscribed_product_id)
+
+
+def test_subscription_items_info():
+    sub = {'id': 'sub_1', 'plan': None, 'cancel_at': None, 'current_period_end': 100,
+           'items': {'data': [{'id': 'si_1', 'price': {'id': 'price_1', 'product': 'prod_1'}},
+                              {'id': 'si_2', 'price': {'id': 'price_2', 'product': 'prod_2'}}]}}
+    assert [(info['product_id'], info['price_id']) for info in subscriptions._subscription_items_info(sub)] == [
+        ('prod_1', 'price_1'), ('prod_2', 'price_2')]
+
+
+def test_minimize_product_plain_dicts():
+    product = stripe.Product.construct_from({'id': 'prod_1', 'object': 'product', 'images': [], 'type': 'service',
+                                             'name': 'Gold', 'shippable': None, 'unit_label': None, 'url': None,
+                                             'metadata': {'tier': 'gold'}}, 'sk_test')
+    minimized = subscriptions._minimize_product(product)
+    assert type(minimized['metadata']) is dict
+    assert minimized['metadata'] == {'tier': 'gold'}
+    with pytest.raises(AttributeError):
+        minimized['metadata'].tier
+    assert json.loads(json.dumps(minimized)) == minimized
@@ -0,0 +1,61 @@
+from subscriptions.checkpoint import Checkpoint
+from subscriptions.store import SubscriptionStore
+from subscriptions import sync
+from subscriptions.sync import sync_account
+
+
+def test_sync_account(user_with_customer_id, subscription, stripe_subscription_product_id, stripe_price_id):
+    store = SubscriptionStore()
+    reports = sync_account(store)
+    assert reports['subscription']['fetched'] >= 1
+    assert store.get('customer', user_with_customer_id.stripe_customer_id)['email'] == user_with_customer_id.email
+    assert store.get('price', stripe_price_id)['product'] == stripe_subscription_product_id
+    assert store.is_subscribed(user_with_customer_id, product_id=stripe_subscription_product_id)
+    assert store.list_products_prices_subscribed_to(user_with_customer_id)[0]['sub_id'] == subscription['id']
+
+
+def test_sync_account_detects_deleted(user_with_customer_id, tmp_path):
+    store = SubscriptionStore()
+    store.upsert('customer', [{'id': 'cus_deleted'}])
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    reports = sync_account(store, object_types=['customer'], checkpoint=checkpoint)
+    assert reports['customer']['deleted'] == ['cus_deleted']
+    assert store.get('customer', 'cus_deleted') is None
+    assert checkpoint.get('customer') is None
+
+
+def test_store_stale_ids():
+    store = SubscriptionStore()
+    store.upsert('subscription', [{'id': 'sub_1', 'customer': 'cus_1', 'status': 'active', 'plan': {}},
+                                  {'id': 'sub_2', 'customer': 'cus_1', 'status': 'active', 'plan': {}}], run_id='a')
+    created, updated = store.upsert('subscription', [{'id': 'sub_1', 'customer': 'cus_1', 'status': 'canceled',
+                                                      'plan': {}}], run_id='b')
+    assert created == []
+    assert updated == ['sub_1']
+    assert store.stale_ids('subscription', 'b') == ['sub_2']
+    store.delete('subscription', ['sub_2'])
+    assert [sub['id'] for sub in store.values('subscription')] == ['sub_1']
+
+
+def test_sync_restarts_when_store_lost_checkpointed_objects(monkeypatch):
+    customers = [{'id': f'cus_{i}', 'email': None, 'name': None, 'metadata': {}} for i in range(5)]
+
+    def list_page(obj_cls, page_size, cursor, **filters):
+        start = 0 if cursor is None else [c['id'] for c in customers].index(cursor) + 1
+        return customers[start:start + page_size]
+
+    monkeypatch.setattr(sync, '_list_page', list_page)
+    checkpoint = Checkpoint()
+    checkpoint.set('customer', {'run_id': 'lost', 'cursor': 'cus_2',
+                                'report': {'object_type': 'customer', 'fetched': 3, 'created': 3, 'updated': 0,
+                                           'updated_sample': [], 'deleted': []}})
+    store = SubscriptionStore()
+    report = sync.sync_object_type(store, 'customer', page_size=2, batch_size=2, checkpoint=checkpoint)
+    assert report['fetched'] == 5
+    assert store.ids('customer') == {c['id'] for c in customers}
+
+    customers[0]['email'] = 'changed@example.com'
+    report = sync.sync_object_type(store, 'customer', page_size=2, batch_size=2, checkpoint=checkpoint)
+    assert report['created'] == 0
+    assert report['updated'] == 1
+    assert report['updated_sample'] == ['cus_0']
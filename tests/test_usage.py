@@ -0,0 +1,68 @@
+import json
+import pytest
+import stripe
+from stripe.http_client import HTTPClient
+from urllib.parse import parse_qsl, urlparse
+
+import subscriptions
+from subscriptions.usage import UsageReporter
+
+
+class UsageRecordStub(HTTPClient):
+    name = 'stub'
+
+    def __init__(self, fail_first: int = 0):
+        super().__init__()
+        self.fail_first = fail_first
+        self.requests = []
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        self.requests.append((urlparse(url).path, dict(parse_qsl(post_data)), headers.get('Idempotency-Key')))
+        if len(self.requests) <= self.fail_first:
+            return json.dumps({'error': {'type': 'api_error', 'message': 'Try again'}}), 500, {}
+        return json.dumps({'id': 'mbur_1', 'object': 'usage_record'}), 200, {}
+
+
+@pytest.fixture
+def usage_record_stub(monkeypatch):
+    stub = UsageRecordStub(fail_first=1)
+    monkeypatch.setattr(stripe, 'default_http_client', stub)
+    monkeypatch.setattr(stripe, 'api_key', stripe.api_key or 'sk_test_usage')
+    return stub
+
+
+def test_usage_aggregated_per_item_and_window(usage_record_stub, tmp_path):
+    path = str(tmp_path / 'usage.db')
+    reporter = UsageReporter(path, window=60, start=False)
+    for _ in range(100):
+        reporter.record_item('si_1', 2, timestamp=120)
+    reporter.record_item('si_1', 1, timestamp=185)
+    reporter.record_item('si_2', 5, timestamp=130)
+    assert reporter.flush() == 1
+    assert reporter.flush() == 0
+    assert len(usage_record_stub.requests) == 4
+    assert {(path, data['quantity'], data['timestamp']) for path, data, _ in usage_record_stub.requests} == {
+        ('/v1/subscription_items/si_1/usage_records', '200', '120'),
+        ('/v1/subscription_items/si_1/usage_records', '1', '180'),
+        ('/v1/subscription_items/si_2/usage_records', '5', '120')}
+    keys = {}
+    for path, data, key in usage_record_stub.requests:
+        keys.setdefault((path, data['timestamp']), set()).add(key)
+    assert all(len(key) == 1 for key in keys.values())
+    assert reporter.close() == 0
+
+
+def test_usage_backpressure_and_close(usage_record_stub, tmp_path):
+    path = str(tmp_path / 'usage.db')
+    reporter = UsageReporter(path, max_pending=1, block=False, start=False)
+    reporter.record_item('si_1', 1, timestamp=60)
+    reporter.record_item('si_1', 1, timestamp=61)
+    with pytest.raises(subscriptions.exceptions.StripeUsageBackpressure):
+        reporter.record_item('si_2', 1, timestamp=60)
+    reporter._db.close()
+    reporter = UsageReporter(path, max_pending=1, start=False)
+    assert reporter.metrics()['pending'] == 1
+    assert reporter.close() == 0
+    assert [data['quantity'] for _, data, _ in usage_record_stub.requests] == ['2', '2']
+    with pytest.raises(RuntimeError):
+        reporter.record_item('si_1', 1)
@@ -0,0 +1,43 @@
+import pytest
+import stripe
+
+from subscriptions import warmup
+from subscriptions.cache import catalog
+
+
+def test_warm_up(stripe_price_id):
+    try:
+        warmup.warm_up(catalog_ttl=60)
+        assert warmup.is_ready()
+        assert warmup.status()['error'] is None
+        assert len(catalog) == 2
+    finally:
+        catalog.ttl = 0
+        catalog.clear()
+
+
+def test_readiness_app():
+    statuses = []
+    warmup.ready.clear()
+    assert warmup.readiness_app({}, lambda status, headers: statuses.append(status)) == [b'warming up']
+    warmup.ready.set()
+    assert warmup.readiness_app({}, lambda status, headers: statuses.append(status)) == [b'ready']
+    assert statuses == ['503 Service Unavailable', '200 OK']
+
+
+def test_warm_up_failure_not_ready(monkeypatch):
+    def fail(**kwargs):
+        raise stripe.error.APIConnectionError('Connection failed')
+
+    monkeypatch.setattr(warmup, 'get_active_products', fail)
+    monkeypatch.setattr(warmup, 'get_active_prices', lambda **kwargs: [])
+    monkeypatch.setattr(warmup, '_status', {'ready': False, 'error': None, 'duration': None})
+    warmup.ready.clear()
+    with pytest.raises(stripe.error.APIConnectionError):
+        warmup.warm_up(connections=2)
+    assert not warmup.is_ready()
+    assert warmup.status()['error'] == 'Connection failed'
+    assert warmup.readiness_app({}, lambda status, headers: None) == [b'warm-up failed']
+    with pytest.raises(stripe.error.APIConnectionError):
+        warmup.warm_up(connections=2, fail_open=True)
+    assert warmup.is_ready()
@@ -0,0 +1,105 @@
+import stripe
+
+import subscriptions
+from subscriptions import write_queue
+from subscriptions.store import SubscriptionStore
+
+
+def test_write_queue_retries_and_persists(tmp_path):
+    calls = []
+
+    def flaky(user, value):
+        calls.append((user.stripe_customer_id, value, write_queue._idempotency_key.get()))
+        if len(calls) == 1:
+            raise stripe.error.APIConnectionError('Connection failed')
+
+    write_queue.register_operation('flaky', flaky)
+    path = str(tmp_path / 'writes.db')
+    queue = write_queue.WriteQueue(path, backoff=0.01, start=False)
+    completed = []
+    job_id = queue.enqueue('flaky', subscriptions.User(1, 'a@example.com', 'cus_1'), 'x', callback=completed.append)
+    assert queue.enqueue('flaky', subscriptions.User(1, 'a@example.com', 'cus_1'), 'x',
+                         idempotency_key=queue.get(job_id)['idempotency_key']) == job_id
+    queue.close()
+    queue = write_queue.WriteQueue(path, backoff=0.01)
+    queue.listeners.append(completed.append)
+    assert queue.join(timeout=5)
+    queue.close()
+    assert len(calls) == 2
+    assert calls[0][2] == calls[1][2]
+    assert [job['status'] for job in completed] == ['done']
+    assert completed[0]['attempts'] == 2
+
+
+def test_write_queue_runs_writes_for_a_customer_in_order(tmp_path):
+    calls = []
+
+    def step(user, value):
+        if value == 1 and 1 not in calls:
+            calls.append(1)
+            raise stripe.error.APIConnectionError('Connection failed')
+        calls.append(value)
+
+    write_queue.register_operation('step', step)
+    queue = write_queue.WriteQueue(str(tmp_path / 'writes.db'), backoff=0.05, start=False)
+    queue.enqueue('step', subscriptions.User(1, 'a@example.com', 'cus_1'), 1)
+    queue.enqueue('step', subscriptions.User(1, 'a@example.com', 'cus_1'), 2)
+    queue.enqueue('step', subscriptions.User(2, 'b@example.com', 'cus_2'), 3)
+    queue.start()
+    assert queue.join(timeout=5)
+    queue.close()
+    assert [value for value in calls if value != 3] == [1, 1, 2]
+    assert 3 in calls
+
+
+def test_write_queue_optimistic_update(tmp_path):
+    store = SubscriptionStore()
+    store.upsert('subscription', [{'id': 'sub_1', 'customer': 'cus_1', 'status': 'active', 'plan': {},
+                                   'default_payment_method': None}])
+    queue = write_queue.WriteQueue(str(tmp_path / 'writes.db'), store=store, start=False)
+    queue.enqueue('update_default_payment_method_all_subscriptions', subscriptions.User(1, 'a@example.com', 'cus_1'),
+                  'pm_1')
+    assert store.get('subscription', 'sub_1')['default_payment_method'] == 'pm_1'
+    assert queue.metrics()['depth'] == 1
+    queue.close()
+
+
+def test_write_queue_modify_subscription(user_with_customer_id, subscription, tmp_path):
+    queue = write_queue.WriteQueue(str(tmp_path / 'writes.db'))
+    done = []
+    queue.enqueue('modify_subscription', user_with_customer_id, subscription['id'], metadata={'queued': 'yes'},
+                  callback=done.append)
+    assert queue.join(timeout=30)
+    queue.close()
+    assert done[0]['status'] == 'done'
+    assert stripe.Subscription.retrieve(subscription['id'])['metadata']['queued'] == 'yes'
+
+
+def test_write_queue_library_errors_fail_job(tmp_path):
+    calls = []
+
+    def wrong_customer(user):
+        calls.append('wrong_customer')
+        raise subscriptions.exceptions.StripeWrongCustomer('Wrong customer')
+
+    def ok(user):
+        calls.append('ok')
+
+    def broken_listener(job):
+        raise ValueError('Listener failed')
+
+    write_queue.register_operation('wrong_customer', wrong_customer)
+    write_queue.register_operation('ok', ok)
+    queue = write_queue.WriteQueue(str(tmp_path / 'writes.db'), workers=1)
+    queue.listeners.append(broken_listener)
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    failed_id = queue.enqueue('wrong_customer', user)
+    assert queue.join(timeout=5)
+    ok_id = queue.enqueue('ok', user)
+    assert queue.join(timeout=5)
+    assert queue.get(failed_id)['status'] == 'failed'
+    assert queue.get(failed_id)['error'] == 'Wrong customer'
+    assert queue.get(ok_id)['status'] == 'done'
+    assert all(thread.is_alive() for thread in queue._threads)
+    queue.close()
+    assert calls == ['wrong_customer', 'ok']
@@ -0,0 +1,84 @@
+import stripe
+import subscriptions
+from subscriptions.cache import request_cache
+from subscriptions.entitlements import entitlements
+from subscriptions.writethrough import write_through
+
+
+calls = []
+
+
+def list_subscriptions(user, **kwargs):
+    calls.append(kwargs)
+    return [{'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': 'active', 'plan': {}}]
+
+
+def test_write_through_updates_request_cache(monkeypatch):
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    new_sub = {'id': 'sub_2', 'object': 'subscription', 'customer': 'cus_1', 'status': 'active',
+               'plan': {'id': 'price_1', 'product': 'prod_1'}}
+    canceled_sub = {'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': 'canceled', 'plan': {}}
+    calls.clear()
+    monkeypatch.setattr(entitlements, 'ttl', 300)
+    entitlements.set('cus_1', [])
+    with request_cache(prefetch_subscriptions=False) as cache:
+        cache.call(list_subscriptions, user, status='active')
+        cache.call(list_subscriptions, user, status='all')
+        cache.call(list_subscriptions, user, price='price_1')
+        write_through('cus_1', new_sub)
+        write_through('cus_1', canceled_sub)
+        active = cache.call(list_subscriptions, user, status='active')
+        all_subs = cache.call(list_subscriptions, user, status='all')
+        cache.call(list_subscriptions, user, price='price_1')
+    assert [sub['id'] for sub in active] == ['sub_2']
+    assert [(sub['id'], sub['status']) for sub in all_subs] == [('sub_2', 'active'), ('sub_1', 'canceled')]
+    assert calls == [{'status': 'active'}, {'status': 'all'}, {'price': 'price_1'}, {'price': 'price_1'}]
+    assert [sub['sub_id'] for sub in entitlements.get('cus_1')] == ['sub_2']
+    entitlements.delete('cus_1')
+
+
+def test_create_subscription_writes_through(user_with_customer_id, default_payment_method_for_customer,
+                                            stripe_price_id):
+    with request_cache(prefetch_subscriptions=False):
+        assert subscriptions.list_active_subscriptions(user_with_customer_id) == []
+        sub = subscriptions.create_subscription(user_with_customer_id, stripe_price_id)
+        assert [s['id'] for s in subscriptions.list_active_subscriptions(user_with_customer_id)] == [sub['id']]
+        subscriptions.cancel_subscription(user_with_customer_id, sub['id'])
+        assert subscriptions.list_active_subscriptions(user_with_customer_id) == []
+
+
+def test_update_default_payment_method_writes_through(monkeypatch):
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    payment_methods = [{'id': 'pm_1', 'object': 'payment_method', 'customer': 'cus_1'},
+                       {'id': 'pm_2', 'object': 'payment_method', 'customer': 'cus_1'}]
+    monkeypatch.setattr(stripe.Customer, 'retrieve', lambda customer_id, **params: {
+        'invoice_settings': {'default_payment_method': 'pm_1'}})
+    monkeypatch.setattr(stripe.PaymentMethod, 'list', lambda **params: list(payment_methods))
+    monkeypatch.setattr(stripe.Subscription, 'list', lambda **params: {'data': [
+        {'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': 'active', 'plan': {},
+         'default_payment_method': 'pm_1'}]})
+    monkeypatch.setattr(stripe.Subscription, 'modify', lambda sub_id, **params: {
+        'id': sub_id, 'object': 'subscription', 'customer': 'cus_1', 'status': 'active', 'plan': {}, **params})
+    monkeypatch.setattr(stripe.Customer, 'modify', lambda customer_id, **params: {
+        'id': customer_id, 'object': 'customer', **params})
+    with request_cache(prefetch_subscriptions=False):
+        assert [pm['default'] for pm in subscriptions.list_payment_methods(user, types=['card'])] == [True, False]
+        assert subscriptions.list_subscriptions(user)[0]['default_payment_method'] == 'pm_1'
+        monkeypatch.setattr(stripe.PaymentMethod, 'list', None)
+        monkeypatch.setattr(stripe.Subscription, 'list', None)
+        subscriptions.update_default_payment_method_all_subscriptions(user, 'pm_2')
+        assert [pm['default'] for pm in subscriptions.list_payment_methods(user, types=['card'])] == [False, True]
+        assert subscriptions.list_subscriptions(user)[0]['default_payment_method'] == 'pm_2'
+
+
+def test_cancel_subscription_for_product_writes_through(monkeypatch):
+    user = subscriptions.User(1, 'a@example.com', 'cus_1')
+    sub = {'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': 'active',
+           'plan': {'product': 'prod_1'}}
+    monkeypatch.setattr(stripe.Subscription, 'list', lambda **params: {'data': [sub]})
+    monkeypatch.setattr(stripe.Subscription, 'delete', lambda sub_id, **params: {**sub, 'status': 'canceled'})
+    with request_cache(prefetch_subscriptions=False):
+        assert len(subscriptions.list_subscriptions(user)) == 1
+        monkeypatch.setattr(stripe.Subscription, 'list', None)
+        assert subscriptions.cancel_subscription_for_product(user, 'prod_1')
+        assert subscriptions.list_subscriptions(user) == []